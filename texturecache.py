@@ -31,11 +31,12 @@
 ################################################################################
 
 import os, sys, platform, re, datetime, time
-import socket, base64, hashlib
-import threading, random
+import socket, select, base64, hashlib
+import threading, random, collections, heapq
 import errno, codecs
 import subprocess
 import tempfile
+import email.utils
 
 try:
   import json
@@ -52,6 +53,11 @@ if sys.version_info >= (3, 0):
 else:
   import ConfigParser, StringIO, httplib, urllib2, Queue
 
+try:
+  import ssl
+except ImportError:
+  ssl = None
+
 lock = threading.RLock()
 
 #
@@ -60,7 +66,7 @@ lock = threading.RLock()
 class MyConfiguration(object):
   def __init__(self, argv):
 
-    self.VERSION = "2.3.5"
+    self.VERSION = "2.3.6"
 
     self.GITHUB = "https://raw.github.com/MilhouseVH/texturecache.py/master"
     self.ANALYTICS_GOOD = "http://goo.gl/BjH6Lj"
@@ -200,6 +206,11 @@ class MyConfiguration(object):
 
     # Read library and textures data in chunks to minimise server/client memory usage
     self.CHUNKED = self.getBoolean(config, "chunked", "yes")
+    # Ask Kodi to sort library data - when disabled, data is retrieved in database order
+    # and only sorted (client-side) for those actions where output order matters
+    self.CHUNKED_SORT = self.getBoolean(config, "chunked.sort", "yes")
+    # Index texture cache rows by 64-bit hash (requires numpy) rather than by full url
+    self.INDEX_HASHED = self.getBoolean(config, "index.hashed", "no")
 
     self.DBJSON = self.getValue(config, "dbjson", "auto")
     self.USEJSONDB = self.getBoolean(config, "dbjson", "yes")
@@ -245,7 +256,12 @@ class MyConfiguration(object):
     self.QUERY_EPISODES = self.getBoolean(config, "query.episodes", "yes") if self.QUERY_SEASONS else False
 
     self.DOWNLOAD_THREADS_DEFAULT = int(self.getValue(config, "download.threads", "2"))
+    # Adjust the number of concurrent downloads at runtime, using download.threads as the maximum
+    self.DOWNLOAD_THREADS_AUTO = self.getBoolean(config, "download.threads.auto", "no")
     self.DOWNLOAD_RETRY = int(self.getValue(config, "download.retry", "3"))
+    # Initial and maximum delay (seconds) between retries - doubled after each retry, with jitter
+    self.DOWNLOAD_RETRY_DELAY = float(self.getValue(config, "download.retry.delay", "0.5"))
+    self.DOWNLOAD_RETRY_MAXDELAY = float(self.getValue(config, "download.retry.maxdelay", "30"))
     self.DOWNLOAD_PRIME = self.getBoolean(config, "download.prime", "yes")
 
     # It seems that Files.Preparedownload is sufficient to populate the texture cache
@@ -253,6 +269,14 @@ class MyConfiguration(object):
     # v0.8.8: Leave enabled for now, may only be sufficient in recent builds.
     self.DOWNLOAD_PAYLOAD = self.getBoolean(config, "download.payload","yes")
 
+    # Build the download URL locally rather than calling Files.PrepareDownload for each item,
+    # falling back to Files.PrepareDownload should the URL not be found. Requires download.payload.
+    self.DOWNLOAD_DIRECT = self.getBoolean(config, "download.direct","no")
+
+    # Number of concurrent requests made by a single event-loop download thread, instead
+    # of using download.threads threads. 0 to disable.
+    self.DOWNLOAD_ASYNC = int(self.getValue(config, "download.async", "0"))
+
     self.DOWNLOAD_THREADS = {}
     for x in ["addons", "albums", "artists", "songs", "movies", "sets", "tags", "tvshows", "pvr.tv", "pvr.radio"]:
       temp = int(self.getValue(config, "download.threads.%s" % x, self.DOWNLOAD_THREADS_DEFAULT))
@@ -260,6 +284,24 @@ class MyConfiguration(object):
 
     self.SINGLETHREAD_URLS = self.getPatternFromList(config, "singlethread.urls", serial_urls, allowundefined=True)
 
+    # Per-host download limits, as host=concurrency[/requests per second[/bytes per second]],
+    # eg. "image.tmdb.org=4/10" or "assets.fanart.tv=2/5/500K"
+    self.DOWNLOAD_HOSTS = {}
+    for x in self.getSimpleList(config, "download.hosts", ""):
+      (host, limits) = [y.strip() for y in x.split("=", 1)] if "=" in x else (x, "0")
+      (limit, rate, bandwidth) = ([y.strip() for y in limits.split("/", 2)] + ["0", "0"])[:3]
+      self.DOWNLOAD_HOSTS[host.lower()] = (int(limit or 0), float(rate or 0), self.getBandwidth(bandwidth))
+
+    # Overall limits on downloads per second and bytes per second, across all download threads
+    self.DOWNLOAD_RATE = float(self.getValue(config, "download.rate", "0"))
+    self.DOWNLOAD_BANDWIDTH = self.getBandwidth(self.getValue(config, "download.bandwidth", "0"))
+
+    # Concurrent downloads while video is playing ("pause" for none), and delay (seconds) after
+    # playback stops before downloads are no longer limited. Playback is not monitored by default.
+    temp = self.getValue(config, "download.playback", "")
+    self.DOWNLOAD_PLAYBACK = (0 if temp.lower() == "pause" else int(temp)) if temp else None
+    self.DOWNLOAD_PLAYBACK_DELAY = float(self.getValue(config, "download.playback.delay", "5"))
+
     self.XTRAJSON = {}
     self.QA_FIELDS = {}
 
@@ -330,6 +372,10 @@ class MyConfiguration(object):
     self.CACHE_CAST_THUMB = self.getBoolean(config, "cache.castthumb", "no")
 
     (self.CACHE_REFRESH, self.cache_refresh_date, self.cache_refresh_date_fmt) = self.getRelativeDateAndFormat(config, "cache.refresh", "")
+    # Number of directories listed concurrently when checking for stale artwork
+    self.CACHE_REFRESH_THREADS = int(self.getValue(config, "cache.refresh.threads", 4))
+    self.CACHE_REFRESH_THREADS = 1 if self.CACHE_REFRESH_THREADS < 1 else self.CACHE_REFRESH_THREADS
+    self.CACHE_REFRESH_THREADS = 20 if self.CACHE_REFRESH_THREADS > 20 else self.CACHE_REFRESH_THREADS
 
     yn = "yes" if self.getBoolean(config, "cache.extra", "no") else "no"
     self.CACHE_EXTRA_FANART = self.getBoolean(config, "cache.extrafanart", yn)
@@ -349,6 +395,37 @@ class MyConfiguration(object):
 
     self.CACHE_DROP_INVALID_FILE = self.getValue(config, "cache.dropfile", "")
 
+    # Stream library chunks through parse, match and download rather than loading the entire
+    # library first. Download queues are bounded by cache.stream.queue items.
+    self.CACHE_STREAM = self.getBoolean(config, "cache.stream", "no")
+    self.CACHE_STREAM_QUEUE = int(self.getValue(config, "cache.stream.queue", "1000"))
+    # Number of media classes to load concurrently when caching several media classes,
+    # sharing a single set of download threads
+    self.CACHE_CONCURRENT = int(self.getValue(config, "cache.concurrent", "1"))
+    # Journal (SQLite) of items queued and downloaded by c/C, used by cache.resume to
+    # continue an interrupted run no more than cache.journal.maxage hours old
+    self.CACHE_JOURNAL = self.getValue(config, "cache.journal", "")
+    self.CACHE_JOURNAL_MAXAGE = float(self.getValue(config, "cache.journal.maxage", "24"))
+    self.CACHE_RESUME = self.getBoolean(config, "cache.resume", "no")
+    # Confirm that downloaded items are present in the texture cache, querying cache.verify.batch
+    # urls at a time, downloading once more any items that are not present
+    self.CACHE_VERIFY = self.getBoolean(config, "cache.verify", "no")
+    self.CACHE_VERIFY_BATCH = int(self.getValue(config, "cache.verify.batch", "100"))
+    # Match library items against the texture cache by querying only their urls (targeted),
+    # by loading all texture cache rows (all), or choose between them by size (auto)
+    self.CACHE_LOOKUP = self.getValue(config, "cache.lookup", "auto").lower()
+    if self.CACHE_LOOKUP not in ["auto", "all", "targeted"]: self.CACHE_LOOKUP = "auto"
+    # Download artwork types in this order (eg. poster, fanart, thumb) and, within each type,
+    # artwork of items played in the last cache.priority.days days first then most recently added
+    self.CACHE_PRIORITY = self.getSimpleList(config, "cache.priority", "")
+    self.CACHE_PRIORITY_DAYS = int(self.getValue(config, "cache.priority.days", "30"))
+    self.CACHE_PRIORITY_PLAYED = (datetime.datetime.now() - datetime.timedelta(days=self.CACHE_PRIORITY_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    # Stop starting downloads at a time of day (HH:MM) or after a number of minutes, and
+    # after a maximum number of items. Remaining items are deferred.
+    self.CACHE_DEADLINE = self.getValue(config, "cache.deadline", "")
+    self.CACHE_DEADLINE_TIME = self.getDeadline(self.CACHE_DEADLINE)
+    self.CACHE_BUDGET = int(self.getValue(config, "cache.budget", "0"))
+
     # Fix patterns as we now strip image:// from the URLs, so we need to remove
     # this prefix from any legacy patterns that may be specified by the user
     for index, r in enumerate(self.CACHE_IGNORE_TYPES):
@@ -359,6 +436,13 @@ class MyConfiguration(object):
     self.PRUNE_RETAIN_PREVIEWS = self.getBoolean(config, "prune.retain.previews", "yes")
     self.PRUNE_RETAIN_PICTURES = self.getBoolean(config, "prune.retain.pictures", "no")
     self.PRUNE_RETAIN_CHAPTERS = self.getBoolean(config, "prune.retain.chapters", "yes")
+    # Number of concurrent connections used to load the media library when pruning
+    self.PRUNE_THREADS = int(self.getValue(config, "prune.threads", 4))
+    self.PRUNE_THREADS = 1 if self.PRUNE_THREADS < 1 else self.PRUNE_THREADS
+    self.PRUNE_THREADS = 20 if self.PRUNE_THREADS > 20 else self.PRUNE_THREADS
+    # Maximum number of library urls and texture cache rows held in memory when pruning,
+    # beyond which they are sorted and spilled to temporary files (0 to prune in memory)
+    self.PRUNE_SPILL = int(self.getValue(config, "prune.spill", "0"))
 
     self.MISSING_IGNORE_PATTERNS = self.getPatternFromList(config, "missing.ignore.patterns", "", allowundefined=True)
 
@@ -386,6 +470,8 @@ class MyConfiguration(object):
 
     self.LASTRUNFILE = self.getValue(config, "lastrunfile", "")
     self.LASTRUNFILE_DATETIME = None
+    self.LASTRUN_SNAPSHOT = self.getValue(config, "lastrun.snapshot", "")
+    self.LASTRUN_SNAPSHOT_ITEMS = int(self.getValue(config, "lastrun.snapshot.items", "250"))
     if self.LASTRUNFILE and os.path.exists(self.LASTRUNFILE):
         temp = datetime.datetime.fromtimestamp(os.path.getmtime(self.LASTRUNFILE))
         self.LASTRUNFILE_DATETIME = temp.strftime("%Y-%m-%d %H:%M:%S")
@@ -609,6 +695,24 @@ class MyConfiguration(object):
     temp = self.getValue(config, aKey, default).lower()
     return temp in ["yes", "true"]
 
+  # Convert a time of day (HH:MM, the next occurrence) or a number of minutes to a time, or None
+  def getDeadline(self, value):
+    if not value: return None
+    m = re.match("^([0-9]{1,2}):([0-9]{2})$", value)
+    if m:
+      now = datetime.datetime.now()
+      deadline = now.replace(hour=int(m.group(1)), minute=int(m.group(2)), second=0, microsecond=0)
+      if deadline <= now: deadline += datetime.timedelta(days=1)
+      return time.mktime(deadline.timetuple())
+    return time.time() + float(value) * 60
+
+  # Bytes per second, optionally with a K or M suffix, eg. "500K" or "2M"
+  def getBandwidth(self, value):
+    if not value: return 0
+    m = re.match("^([0-9.]+)\\s*([KkMm]?)[Bb]?$", value.strip())
+    if not m: return int(value)
+    return int(float(m.group(1)) * {"": 1, "K": 1024, "M": 1024 * 1024}[m.group(2).upper()])
+
   def getSimpleList(self, config, aKey, default="", allowundefined=False, delimiter=",", strip=True):
     aStr = self.getValue(config, aKey, default, allowundefined)
 
@@ -774,19 +878,34 @@ class MyConfiguration(object):
     print("  rpc.retry = %s" % self.RPC_RETRY)
     print("  rpc.ctimeout = %s" % self.NoneIsBlank(self.RPC_CONNECTTIMEOUT))
     print("  chunked = %s" % self.BooleanIsYesNo(self.CHUNKED))
+    print("  chunked.sort = %s" % self.BooleanIsYesNo(self.CHUNKED_SORT))
+    print("  index.hashed = %s" % self.BooleanIsYesNo(self.INDEX_HASHED))
     print("  modifieddate.mdy = %s" % self.BooleanIsYesNo(self.MDATE_MDY))
     print("  query.seasons = %s" % self.BooleanIsYesNo(self.QUERY_SEASONS))
     print("  query.episodes = %s" % self.BooleanIsYesNo(self.QUERY_EPISODES))
     print("  download.predelete = %s" % self.BooleanIsYesNo(self.DOWNLOAD_PREDELETE))
     print("  download.payload = %s" % self.BooleanIsYesNo(self.DOWNLOAD_PAYLOAD))
+    print("  download.direct = %s" % self.BooleanIsYesNo(self.DOWNLOAD_DIRECT))
+    print("  download.async = %d" % self.DOWNLOAD_ASYNC)
     print("  download.retry = %d" % self.DOWNLOAD_RETRY)
+    print("  download.retry.delay = %s" % self.DOWNLOAD_RETRY_DELAY)
+    print("  download.retry.maxdelay = %s" % self.DOWNLOAD_RETRY_MAXDELAY)
     print("  download.prime = %s" % self.BooleanIsYesNo(self.DOWNLOAD_PRIME))
     print("  download.threads = %d" % self.DOWNLOAD_THREADS_DEFAULT)
+    print("  download.threads.auto = %s" % self.BooleanIsYesNo(self.DOWNLOAD_THREADS_AUTO))
     if self.DOWNLOAD_THREADS != {}:
       for dt in self.DOWNLOAD_THREADS:
         if self.DOWNLOAD_THREADS[dt] != self.DOWNLOAD_THREADS_DEFAULT:
           print("  %s = %d" % (dt, self.DOWNLOAD_THREADS[dt]))
     print("  singlethread.urls = %s" % self.NoneIsBlank(self.getListFromPattern(self.SINGLETHREAD_URLS)))
+    print("  download.hosts = %s" % ", ".join(["%s=%d%s%s" % (h, self.DOWNLOAD_HOSTS[h][0],
+                                                              "/%g" % self.DOWNLOAD_HOSTS[h][1] if self.DOWNLOAD_HOSTS[h][1] or self.DOWNLOAD_HOSTS[h][2] else "",
+                                                              "/%d" % self.DOWNLOAD_HOSTS[h][2] if self.DOWNLOAD_HOSTS[h][2] else "")
+                                             for h in sorted(self.DOWNLOAD_HOSTS)]))
+    print("  download.rate = %g" % self.DOWNLOAD_RATE)
+    print("  download.bandwidth = %d" % self.DOWNLOAD_BANDWIDTH)
+    print("  download.playback = %s" % ("" if self.DOWNLOAD_PLAYBACK is None else "pause" if self.DOWNLOAD_PLAYBACK == 0 else self.DOWNLOAD_PLAYBACK))
+    print("  download.playback.delay = %s" % self.DOWNLOAD_PLAYBACK_DELAY)
     print("  extrajson.addons  = %s" % self.NoneIsBlank(self.XTRAJSON["extrajson.addons"]))
     print("  extrajson.agenres = %s" % self.NoneIsBlank(self.XTRAJSON["extrajson.agenres"]))
     print("  extrajson.vgenres = %s" % self.NoneIsBlank(self.XTRAJSON["extrajson.vgenres"]))
@@ -820,11 +939,27 @@ class MyConfiguration(object):
     print("  cache.extrathumbs = %s" % self.BooleanIsYesNo(self.CACHE_EXTRA_THUMBS))
     print("  cache.videoextras = %s" % self.BooleanIsYesNo(self.CACHE_VIDEO_EXTRAS))
     print("  cache.refresh = %s%s" % (self.NoneIsBlank(self.CACHE_REFRESH), " (%s)" % self.cache_refresh_date_fmt if self.cache_refresh_date_fmt else ""))
+    print("  cache.refresh.threads = %d" % self.CACHE_REFRESH_THREADS)
     print("  cache.dropfile = %s" % self.NoneIsBlank(self.CACHE_DROP_INVALID_FILE))
+    print("  cache.stream = %s" % self.BooleanIsYesNo(self.CACHE_STREAM))
+    print("  cache.stream.queue = %d" % self.CACHE_STREAM_QUEUE)
+    print("  cache.concurrent = %d" % self.CACHE_CONCURRENT)
+    print("  cache.journal = %s" % self.NoneIsBlank(self.CACHE_JOURNAL))
+    print("  cache.journal.maxage = %s" % self.CACHE_JOURNAL_MAXAGE)
+    print("  cache.resume = %s" % self.BooleanIsYesNo(self.CACHE_RESUME))
+    print("  cache.verify = %s" % self.BooleanIsYesNo(self.CACHE_VERIFY))
+    print("  cache.verify.batch = %d" % self.CACHE_VERIFY_BATCH)
+    print("  cache.lookup = %s" % self.CACHE_LOOKUP)
+    print("  cache.priority = %s" % self.NoneIsBlank(", ".join(self.CACHE_PRIORITY)))
+    print("  cache.priority.days = %d" % self.CACHE_PRIORITY_DAYS)
+    print("  cache.deadline = %s" % self.NoneIsBlank(self.CACHE_DEADLINE))
+    print("  cache.budget = %d" % self.CACHE_BUDGET)
     print("  prune.retain.types = %s" % self.NoneIsBlank(self.getListFromPattern(self.PRUNE_RETAIN_TYPES)))
     print("  prune.retain.previews = %s" % self.BooleanIsYesNo(self.PRUNE_RETAIN_PREVIEWS))
     print("  prune.retain.pictures = %s" % self.BooleanIsYesNo(self.PRUNE_RETAIN_PICTURES))
     print("  prune.retain.chapters = %s" % self.BooleanIsYesNo(self.PRUNE_RETAIN_CHAPTERS))
+    print("  prune.threads = %d" % self.PRUNE_THREADS)
+    print("  prune.spill = %d" % self.PRUNE_SPILL)
     print("  missing.ignore.patterns = %s" % self.NoneIsBlank(self.getListFromPattern(self.MISSING_IGNORE_PATTERNS)))
     print("  logfile = %s" % self.NoneIsBlank(self.LOGFILE))
     print("  logfile.verbose = %s" % self.BooleanIsYesNo(self.LOGVERBOSE))
@@ -836,6 +971,8 @@ class MyConfiguration(object):
       print("  allow.recacheall = yes")
     temp = " (%s)" % self.LASTRUNFILE_DATETIME if self.LASTRUNFILE and self.LASTRUNFILE_DATETIME else ""
     print("  lastrunfile = %s%s" % (self.NoneIsBlank(self.LASTRUNFILE), temp))
+    print("  lastrun.snapshot = %s" % self.NoneIsBlank(self.LASTRUN_SNAPSHOT))
+    print("  lastrun.snapshot.items = %d" % self.LASTRUN_SNAPSHOT_ITEMS)
     print("  orphan.limit.check = %s" % self.BooleanIsYesNo(self.ORPHAN_LIMIT_CHECK))
     print("  purge.minlen = %s" % self.PURGE_MIN_LEN)
     print("  picture.filetypes = %s" % self.NoneIsBlank(", ".join(self.PICTURE_FILETYPES_EX)))
@@ -1063,19 +1200,227 @@ class MyLogger():
     sys.stderr.flush()
     if self.LOGFILE: self.LOGFILE.flush()
 
+#
+# Client used to prime remote artwork URLs (download.prime), shared by all
+# image loader threads.
+#
+# Connections are pooled and kept alive per scheme/host/port, host names are
+# resolved once, and both http and https are supported. Availability is
+# determined with a HEAD request, or a single byte Range request should the host
+# not support HEAD, and is cached for a short period for each URL.
+#
+class MyPrimeClient(object):
+  USER_AGENT = "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:38.0) Gecko/20100101 Firefox/38.0"
+
+  # Seconds for which the availability of a URL is cached, and maximum number of URLs cached
+  CACHE_TTL = 300
+  CACHE_SIZE = 4096
+
+  # Maximum number of idle connections retained per host
+  POOL_SIZE = 4
+
+  def __init__(self, logger, timeout=15.0):
+    self.logger = logger
+    self.timeout = timeout
+
+    self.plock = threading.Lock()
+    self.pool = {}
+    self.addresses = {}
+    self.available = {}
+
+    self.context = None
+    if ssl and hasattr(ssl, "create_default_context"):
+      self.context = ssl.create_default_context()
+
+  # Return True if the remote URL is still available. A host that is throttling
+  # requests is assumed to still have the URL, and is reported to retrypolicy.
+  def isAvailable(self, url, retrypolicy=None):
+    m = re.match("^(https?)://([^/:]+)(?::([0-9]+))?(/.*)?$", url, re.IGNORECASE)
+    if not m: return True
+
+    now = time.time()
+    with self.plock:
+      cached = self.available.get(url, None)
+      if cached:
+        if cached[1] > now:
+          self.logger.log("Primed request of: URL [%s], cached result [%s]" % (url, cached[0]))
+          return cached[0]
+        del self.available[url]
+
+    scheme = m.group(1).lower()
+    host = m.group(2).lower()
+    port = int(m.group(3)) if m.group(3) else (443 if scheme == "https" else 80)
+    page = m.group(4) or "/"
+
+    if scheme == "https" and ssl is None: return True
+
+    try:
+      (status, reason, retryafter) = self.request(scheme, host, port, "HEAD", page)
+      if status in [httplib.METHOD_NOT_ALLOWED, httplib.NOT_IMPLEMENTED]:
+        (status, reason, retryafter) = self.request(scheme, host, port, "GET", page, {"Range": "bytes=0-0"})
+      self.logger.log("Primed request of: Domain [%s] with URL [%s], result [%d, %s]" % (host, page, status, reason))
+      if status in MyRetryPolicy.THROTTLED:
+        if retrypolicy: retrypolicy.throttle(host if not m.group(3) else "%s:%s" % (host, m.group(3)), status, retryafter)
+        return True
+      isAvailable = (status in [httplib.OK, httplib.PARTIAL_CONTENT] or 300 <= status < 400)
+    except Exception as e:
+      self.logger.log("Primed request of: Domain [%s] with URL [%s], exception [%s]" % (host, page, e))
+      isAvailable = False
+
+    with self.plock:
+      now = time.time()
+      # Once full, discard expired URLs - or all URLs, should none have expired
+      if len(self.available) >= self.CACHE_SIZE:
+        for u in [u for u in self.available if self.available[u][1] <= now]:
+          del self.available[u]
+        if len(self.available) >= self.CACHE_SIZE:
+          self.available.clear()
+      self.available[url] = (isAvailable, now + self.CACHE_TTL)
+
+    return isAvailable
+
+  # Send request using a pooled connection, retrying once with a new connection
+  # should a pooled connection have been closed by the remote host
+  def request(self, scheme, host, port, method, page, headers={}):
+    key = (scheme, host, port)
+    hdrs = {"User-agent": self.USER_AGENT}
+    hdrs.update(headers)
+
+    for attempt in [1, 2]:
+      (conn, pooled) = self.getConnection(key)
+      try:
+        conn.request(method, page, None, hdrs)
+        response = conn.getresponse()
+        # Read any (small) body so that the connection can be re-used
+        data = response.read(1024)
+        if response.will_close or len(data) == 1024:
+          conn.close()
+        else:
+          self.putConnection(key, conn)
+        return (response.status, response.reason, response.getheader("Retry-After"))
+      except (httplib.HTTPException, socket.error):
+        conn.close()
+        if not pooled or attempt == 2: raise
+
+  def getConnection(self, key):
+    with self.plock:
+      idle = self.pool.get(key, [])
+      if idle: return (idle.pop(), True)
+
+    (scheme, host, port) = key
+
+    if scheme == "https":
+      conn = httplib.HTTPSConnection(host, port, timeout=self.timeout)
+    else:
+      conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+    # Connect to the cached address, avoiding name resolution for every connection
+    sock = socket.create_connection(self.resolve(host, port), self.timeout)
+    if scheme == "https":
+      if self.context:
+        sock = self.context.wrap_socket(sock, server_hostname=host)
+      else:
+        sock = ssl.wrap_socket(sock)
+    conn.sock = sock
+
+    return (conn, False)
+
+  def putConnection(self, key, conn):
+    with self.plock:
+      idle = self.pool.setdefault(key, [])
+      if len(idle) < self.POOL_SIZE:
+        idle.append(conn)
+        return
+    conn.close()
+
+  def resolve(self, host, port):
+    with self.plock:
+      address = self.addresses.get((host, port), None)
+    if address is None:
+      info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+      address = info[0][4][:2]
+      with self.plock:
+        self.addresses[(host, port)] = address
+    return address
+
+#
+# Rules shared by both image loaders (MyImageLoader and MyAsyncImageLoader)
+# deciding when texture cache rows are deleted, how many times requests are
+# attempted, and when a remote URL is primed.
+#
+class MyDownloadRules(object):
+  # Shared by all image loaders, created when first required
+  PRIMER = None
+
+  @staticmethod
+  def getAttempts(retry):
+    return 1 if retry < 1 else retry
+
+  # Embedded images will never be available, so don't retry
+  @staticmethod
+  def getPrepareRetries(retry, retrypolicy, item):
+    return retry if retrypolicy.isRetryable(filename=item.decoded_filename) else 0
+
+  # The existing row is to be replaced by the download (unless removed before downloading)
+  @staticmethod
+  def isReplacing(config, item, force):
+    return not config.DOWNLOAD_PREDELETE and item.dbid != 0 and force
+
+  # If no URL, could be because thumbnail is missing but DB row exists - if thumbnail
+  # no longer available, then the row should be deleted before trying again to obtain URL
+  @staticmethod
+  def isMissingRow(config, item, force):
+    return MyDownloadRules.isReplacing(config, item, force) and \
+           config.HAS_THUMBNAILS_FS and not os.path.exists(config.getFilePath(item.cachedurl))
+
+  @staticmethod
+  def deleteMissingRow(database, logger, item):
+    logger.log("Deleting row with missing image from cache - id [%d], cachedurl [%s] for filename [%s]"
+               % (item.dbid, item.cachedurl, item.decoded_filename))
+    database.deleteItem(item.dbid, None)
+
+  @staticmethod
+  def deleteOldRow(database, logger, item):
+    logger.log("Deleting old image from cache with id [%d], cachedurl [%s] for filename [%s]"
+               % (item.dbid, item.cachedurl, item.decoded_filename))
+    database.deleteItem(item.dbid, item.cachedurl)
+
+  # If DOWNLOAD_PRIME is enabled, request the remote URL directly. If not available, don't bother
+  # retrying call to Files.PrepareDownload as it will surely fail.
+  @staticmethod
+  def isPrimeRequired(config, pdretry):
+    return pdretry > 0 and config.DOWNLOAD_PRIME
+
+  @staticmethod
+  def getPrimer(logger):
+    with lock:
+      if MyDownloadRules.PRIMER is None:
+        MyDownloadRules.PRIMER = MyPrimeClient(logger)
+    return MyDownloadRules.PRIMER
+
+  # The webserver failed to respond in a timely manner, or reported an error
+  @staticmethod
+  def isCongested(status):
+    return status is None or status == httplib.REQUEST_TIMEOUT or status >= 500
+
 #
 # Image loader thread class.
 #
 class MyImageLoader(threading.Thread):
-  def __init__(self, work_queue, other_queue, error_queue, complete_queue,
-                config, logger, totals, force=False, retry=0):
+
+  def __init__(self, work_queue, error_queue, complete_queue,
+                config, logger, totals, force=False, retry=0, producer=None, retrypolicy=None):
     threading.Thread.__init__(self)
 
+    # work_queue is a MyHostQueue, shared by all threads
     self.work_queue = work_queue
-    self.other_queue = other_queue
     self.error_queue = error_queue
     self.complete_queue = complete_queue
 
+    # producer is an Event that will be set once all work has been queued.
+    # Until then an empty work queue is not a reason to exit.
+    self.producer = producer
+
     self.config = config
     self.logger = logger
     self.database = MyDB(config, logger)
@@ -1084,6 +1429,13 @@ class MyImageLoader(threading.Thread):
 
     self.force = force
     self.retry = retry
+    self.retrypolicy = retrypolicy if retrypolicy else MyRetryPolicy(logger, totals, config.DOWNLOAD_RETRY_DELAY, config.DOWNLOAD_RETRY_MAXDELAY)
+
+    # Set when the webserver fails to respond in a timely manner, or reports an error
+    self.congested = False
+
+    # Size of the downloaded image, as reported by the webserver
+    self.nbytes = 0
 
     self.totals.init(self.name)
 
@@ -1091,52 +1443,59 @@ class MyImageLoader(threading.Thread):
     with self.database:
       while not stopped.is_set():
         try:
-          item = self.work_queue.get(block=False)
-          self.work_queue.task_done()
+          item = self.work_queue.get(block=True, timeout=0.25)
+        except Queue.Empty:
+          # Nothing can be started right now (hosts may be at their limit) - only
+          # finish once all work has been queued, and taken by one of the threads
+          if self.work_queue.empty() and (self.producer is None or self.producer.is_set()): break
+          continue
 
+        tStart = time.time()
+        self.congested = False
+        self.nbytes = 0
+
+        try:
           if not self.loadImage(item) and not item.missingOK:
             self.error_queue.put(item)
 
           self.complete_queue.put(item)
 
-        except Queue.Empty:
-          break
-
         except IOEndOfReplayLog:
           break
 
+        finally:
+          self.work_queue.done(item, time.time() - tStart, self.congested, self.nbytes)
+
     self.totals.stop()
     self.complete_queue.put(None)
 
-  def geturl(self, item):
-    PDRETRY = self.retry
+  def geturl(self, item, direct=False):
+    if direct:
+      return (MyUtility.getDownloadPath(item.filename), True)
 
-    # Call Files.PrepareDownload. If failure, retry up to retry times, waiting a short
-    # interval between each attempt.
+    PDRETRY = MyDownloadRules.getPrepareRetries(self.retry, self.retrypolicy, item)
+
+    # Call Files.PrepareDownload. If failure, retry up to retry times, waiting an
+    # increasing interval between each attempt.
     url = self.json.getDownloadURL(item.filename)
     rowexists = True
 
-    # If no URL, could be because thumbnail is missing but DB row exists - if thumbnail
-    # no longer available, then delete the row and try again to obtain URL
-    if url is None and not self.config.DOWNLOAD_PREDELETE and item.dbid != 0 and self.force:
-      if self.config.HAS_THUMBNAILS_FS and not os.path.exists(self.config.getFilePath(item.cachedurl)):
-        self.logger.log("Deleting row with missing image from cache - id [%d], cachedurl [%s] for filename [%s]"
-                      % (item.dbid, item.cachedurl, item.decoded_filename))
-        self.database.deleteItem(item.dbid, None)
-        rowexists = False
-
-    # If DOWNLOAD_PRIME is enabled, request the remote URL directly. If not available, don't bother
-    # retrying call to Files.PrepareDownload as it will surely fail.
-    if PDRETRY > 0 and url is None and self.config.DOWNLOAD_PRIME:
+    if url is None and MyDownloadRules.isMissingRow(self.config, item, self.force):
+      MyDownloadRules.deleteMissingRow(self.database, self.logger, item)
+      rowexists = False
+
+    if url is None and MyDownloadRules.isPrimeRequired(self.config, PDRETRY):
       isAvailable = self.prime_the_request(item.decoded_filename)
     else:
       isAvailable  = True
 
     # Retry call to Files.PrepareDownload - hopefully it will succeed eventually...
+    host = self.work_queue.getHost(item)
     while PDRETRY > 0 and url is None and isAvailable:
       self.logger.log("Retrying getDownloadURL(), %d attempts remaining" % PDRETRY)
-      # Introduce a short delay, unless we're playing back a log file...
-      if self.json.LOG_REPLAYFILE is None: time.sleep(0.5)
+      # Introduce a delay, unless we're playing back a log file...
+      if self.json.LOG_REPLAYFILE is None:
+        if not self.retrypolicy.wait(host, self.retry - PDRETRY + 1, self.json.WEB_LAST_STATUS, self.json.WEB_LAST_RETRYAFTER): break
       PDRETRY -= 1
       url = self.json.getDownloadURL(item.filename)
 
@@ -1145,6 +1504,10 @@ class MyImageLoader(threading.Thread):
   # Directly request the remote URL returning True if still available
   def prime_the_request(self, url):
     if url is None: return False
+
+    if not self.config.LOG_REPLAY_FILENAME:
+      return MyDownloadRules.getPrimer(self.logger).isAvailable(url, self.retrypolicy)
+
     if not url.startswith("http://"): return True
 
     domain = url.replace("http://", "").split("/")[0]
@@ -1162,41 +1525,64 @@ class MyImageLoader(threading.Thread):
     return isAvailable
 
   def loadImage(self, item):
-    ATTEMPT = 1 if self.retry < 1 else self.retry
+    ATTEMPT = MyDownloadRules.getAttempts(self.retry)
     PERFORM_DOWNLOAD = False
 
     self.totals.start(item.mtype, item.itype)
 
-    (url, rowexists) = self.geturl(item)
+    # A direct URL is only useful when the image is to be downloaded
+    direct = self.config.DOWNLOAD_DIRECT and self.config.DOWNLOAD_PAYLOAD
+
+    (url, rowexists) = self.geturl(item, direct)
 
     if url:
-      if not self.config.DOWNLOAD_PREDELETE:
-        if item.dbid != 0 and self.force:
-          if rowexists:
-            self.logger.log("Deleting old image from cache with id [%d], cachedurl [%s] for filename [%s]"
-                            % (item.dbid, item.cachedurl, item.decoded_filename))
-            self.database.deleteItem(item.dbid, item.cachedurl)
-          self.totals.bump("Deleted", item.itype)
-          PERFORM_DOWNLOAD = True
+      if MyDownloadRules.isReplacing(self.config, item, self.force):
+        if rowexists:
+          MyDownloadRules.deleteOldRow(self.database, self.logger, item)
+        self.totals.bump("Deleted", item.itype)
+        PERFORM_DOWNLOAD = True
       if self.config.DOWNLOAD_PAYLOAD or PERFORM_DOWNLOAD:
         self.logger.log("Proceeding with download of URL [%s]" % url)
     else:
       self.logger.log("Image not available for download - uncacheable (embedded?), or doesn't exist. Filename [%s]" % item.filename)
       ATTEMPT = 0
 
+    ATTEMPTS = ATTEMPT
+    host = self.work_queue.getHost(item)
+
     while ATTEMPT > 0 and (self.config.DOWNLOAD_PAYLOAD or PERFORM_DOWNLOAD):
+      status = None
       try:
         # Don't need to download the whole image for it to be cached so just grab the first 1KB
         PAYLOAD = self.json.sendWeb("GET", url, "loadImage", readAmount=1024, rawData=True)
+        status = self.json.WEB_LAST_STATUS
         if self.json.WEB_LAST_STATUS == httplib.OK:
           self.logger.log("Successfully downloaded image with size [%d] bytes, attempts required [%d], filename [%s]" \
                         % (len(PAYLOAD), (self.retry - ATTEMPT + 1), item.decoded_filename))
+          self.nbytes = self.json.WEB_LAST_LENGTH if self.json.WEB_LAST_LENGTH is not None else len(PAYLOAD)
           break
+        # Direct URL not recognised by the webserver - obtain the URL from Files.PrepareDownload
+        # without this counting as a failed attempt
+        if direct and self.json.WEB_LAST_STATUS == httplib.NOT_FOUND:
+          self.logger.log("Direct URL [%s] not found, using Files.PrepareDownload for filename [%s]" % (url, item.filename))
+          direct = False
+          (url, rowexists) = self.geturl(item)
+          if url is None:
+            self.logger.log("Image not available for download - uncacheable (embedded?), or doesn't exist. Filename [%s]" % item.filename)
+            ATTEMPT = 0
+            break
+          continue
+        if MyDownloadRules.isCongested(self.json.WEB_LAST_STATUS):
+          self.congested = True
       except:
-        pass
+        self.congested = True
       ATTEMPT -= 1
+      # Don't retry permanent failures (eg. not found)
+      if not self.retrypolicy.isRetryable(status, item.decoded_filename): ATTEMPT = 0
       self.logger.log("Failed to download image URL [%s], status [%d], " \
                    "attempts remaining [%d]" % (url, self.json.WEB_LAST_STATUS, ATTEMPT))
+      if ATTEMPT > 0 and self.json.LOG_REPLAYFILE is None:
+        if not self.retrypolicy.wait(host, ATTEMPTS - ATTEMPT, status, self.json.WEB_LAST_RETRYAFTER): ATTEMPT = 0
       if stopped.is_set(): ATTEMPT = 0
 
     if ATTEMPT == 0:
@@ -1204,16 +1590,438 @@ class MyImageLoader(threading.Thread):
         self.totals.bump("Error", item.itype)
     else:
       self.totals.bump("Cached", item.itype)
+      item.status = MyMediaItem.STATUS_CACHED
 
     self.totals.finish(item.mtype, item.itype)
 
     return ATTEMPT != 0
 
+#
+# Event-loop image loader (download.async).
+#
+# A single thread drives up to download.async concurrent requests of the Kodi
+# webserver using non-blocking sockets, performing the same steps as
+# MyImageLoader for each item - Files.PrepareDownload (unless download.direct),
+# priming of unavailable remote URLs, and download of the image - so that many
+# slow remote fetches can be in progress without a thread for each. Items are
+# taken from the same work queue (with per-host limits) and reported to the same
+# error and completion queues as MyImageLoader. Each concurrent request is
+# accounted for as a separate thread in the statistics.
+#
+# Blocking steps - priming a remote URL and deleting texture cache rows - are
+# handed to a few helper threads, each with its own database connection, and
+# the request is resumed by the event loop once the step has completed, so
+# that a slow remote host never stalls the other requests in progress.
+#
+class MyAsyncImageLoader(threading.Thread):
+  # Number of helper threads performing blocking steps
+  HELPERS = 4
+
+  def __init__(self, work_queue, error_queue, complete_queue,
+                config, logger, totals, force=False, retry=0, producer=None, retrypolicy=None, slots=32):
+    threading.Thread.__init__(self)
+
+    self.work_queue = work_queue
+    self.error_queue = error_queue
+    self.complete_queue = complete_queue
+    self.producer = producer
+
+    self.config = config
+    self.logger = logger
+    self.totals = totals
+
+    self.force = force
+    self.retry = retry
+    self.retrypolicy = retrypolicy if retrypolicy else MyRetryPolicy(logger, totals, config.DOWNLOAD_RETRY_DELAY, config.DOWNLOAD_RETRY_MAXDELAY)
+
+    self.timeout = 15.0
+    self.address = None
+
+    # Requests in progress keyed by socket, and requests waiting to be retried
+    self.active = {}
+    self.waiting = []
+
+    # Blocking steps queued for the helper threads, and completed steps to be resumed
+    self.helpers = []
+    self.blocking = Queue.Queue()
+    self.unblocked = Queue.Queue()
+    self.blocked = 0
+
+    self.slots = []
+    for i in range(slots):
+      slot = "%s-%d" % (self.name, i + 1)
+      self.slots.append(slot)
+      self.totals.init(slot)
+
+  def run(self):
+    while not stopped.is_set():
+      busy = (len(self.active) + len(self.waiting) + self.blocked) != 0
+
+      if self.slots:
+        try:
+          item = self.work_queue.get(block=not busy, timeout=None if busy else 0.25)
+          self.begin(item)
+          continue
+        except Queue.Empty:
+          pass
+
+      if not busy:
+        if self.work_queue.empty() and (self.producer is None or self.producer.is_set()): break
+        continue
+
+      self.poll(0.25)
+      self.retryWaiting()
+      self.resumeUnblocked()
+
+    for sock in list(self.active):
+      sock.close()
+
+    for t in self.helpers:
+      self.blocking.put(None)
+    for t in self.helpers:
+      t.join(1.0)
+
+    for slot in self.slots:
+      self.totals.init(slot)
+
+    self.complete_queue.put(None)
+
+  def begin(self, item):
+    r = {"item": item, "slot": self.slots.pop(), "tStart": time.time(), "congested": False,
+         "host": self.work_queue.getHost(item), "retryafter": None,
+         "direct": self.config.DOWNLOAD_DIRECT and self.config.DOWNLOAD_PAYLOAD,
+         "attempts": MyDownloadRules.getAttempts(self.retry),
+         "pdretry": MyDownloadRules.getPrepareRetries(self.retry, self.retrypolicy, item),
+         "primed": False, "deleted": False, "rowexists": True, "length": None, "bytes": 0}
+
+    self.totals.start(item.mtype, item.itype, r["slot"])
+
+    if r["direct"]:
+      self.prepared(r, MyUtility.getDownloadPath(item.filename))
+    else:
+      self.prepare(r)
+
+  # Call Files.PrepareDownload to obtain the download url
+  def prepare(self, r):
+    r["step"] = "prepare"
+    REQUEST = {"jsonrpc": "2.0", "method": "Files.PrepareDownload", "params": {"path": r["item"].filename}, "id": "preparedl"}
+    self.send(r, "POST", "/jsonrpc", json.dumps(REQUEST))
+
+  # Download url, unless the download is not required
+  def prepared(self, r, url):
+    item = r["item"]
+    r["url"] = url
+
+    if not MyDownloadRules.isReplacing(self.config, item, self.force):
+      self.download(r, False)
+    elif r["deleted"] or not r["rowexists"]:
+      if not r["deleted"]: self.totals.bump("Deleted", item.itype)
+      r["deleted"] = True
+      self.download(r, True)
+    else:
+      r["deleted"] = True
+      self.block(r, lambda database: MyDownloadRules.deleteOldRow(database, self.logger, item), self.deleted)
+
+  def deleted(self, r, result):
+    self.totals.bump("Deleted", r["item"].itype)
+    self.download(r, True)
+
+  def download(self, r, perform_download):
+    if self.config.DOWNLOAD_PAYLOAD or perform_download:
+      self.logger.log("Proceeding with download of URL [%s]" % r["url"])
+      r["step"] = "download"
+      self.send(r, "GET", r["url"])
+    else:
+      self.complete(r, True)
+
+  # Files.PrepareDownload response (None if no response)
+  def prepareResponse(self, r, status, body):
+    item = r["item"]
+
+    data = {}
+    if status == httplib.OK:
+      try:
+        data = json.loads(body.decode("utf-8"))
+      except ValueError:
+        pass
+
+    if data.get("result", None):
+      self.prepared(r, "/%s" % data["result"]["details"]["path"])
+      return
+
+    deleteRow = r["rowexists"] and MyDownloadRules.isMissingRow(self.config, item, self.force)
+    prime = not r["primed"] and MyDownloadRules.isPrimeRequired(self.config, r["pdretry"])
+
+    if not (deleteRow or prime):
+      self.prepareRetry(r, status, True)
+      return
+
+    if deleteRow: r["rowexists"] = False
+    if prime: r["primed"] = True
+
+    def deleteAndPrime(database):
+      if deleteRow:
+        MyDownloadRules.deleteMissingRow(database, self.logger, item)
+      if prime:
+        return MyDownloadRules.getPrimer(self.logger).isAvailable(item.decoded_filename, self.retrypolicy)
+      return True
+
+    self.block(r, deleteAndPrime, lambda r, isAvailable: self.prepareRetry(r, status, isAvailable is not False))
+
+  # Retry Files.PrepareDownload, unless out of attempts or the remote URL is not available
+  def prepareRetry(self, r, status, isAvailable):
+    if not isAvailable: r["pdretry"] = 0
+
+    if r["pdretry"] > 0:
+      self.logger.log("Retrying getDownloadURL(), %d attempts remaining" % r["pdretry"])
+      delay = self.retrypolicy.getDelay(r["host"], self.retry - r["pdretry"] + 1, status, r["retryafter"])
+      r["pdretry"] -= 1
+      self.waiting.append((time.time() + delay, r))
+    else:
+      self.logger.log("Image not available for download - uncacheable (embedded?), or doesn't exist. Filename [%s]" % r["item"].filename)
+      self.complete(r, False)
+
+  # Hand a blocking step to a helper thread, the request being resumed with the result of the step
+  def block(self, r, function, resume):
+    if len(self.helpers) < self.HELPERS and len(self.helpers) <= self.blocked:
+      t = threading.Thread(target=self.helper, name="%s-helper-%d" % (self.name, len(self.helpers) + 1))
+      t.setDaemon(True)
+      t.start()
+      self.helpers.append(t)
+
+    self.blocked += 1
+    self.blocking.put((r, function, resume))
+
+  def helper(self):
+    database = MyDB(self.config, self.logger)
+    with database:
+      while True:
+        job = self.blocking.get()
+        if job is None: break
+        (r, function, resume) = job
+        result = None
+        try:
+          result = function(database)
+        except Exception as e:
+          self.logger.log("Blocking step failed for filename [%s]: %s" % (r["item"].filename, e))
+        self.unblocked.put((r, resume, result))
+
+  def resumeUnblocked(self):
+    while True:
+      try:
+        (r, resume, result) = self.unblocked.get(block=False)
+      except Queue.Empty:
+        break
+      self.blocked -= 1
+      resume(r, result)
+
+  # Image download response (None if no response)
+  def downloadResponse(self, r, status, body):
+    item = r["item"]
+
+    if status == httplib.OK:
+      self.logger.log("Successfully downloaded image with size [%d] bytes, attempts required [%d], filename [%s]" \
+                      % (len(body), (self.retry - r["attempts"] + 1), item.decoded_filename))
+      r["bytes"] = r["length"] if r["length"] is not None else len(body)
+      self.complete(r, True)
+      return
+
+    # Direct URL not recognised by the webserver - obtain the URL from Files.PrepareDownload
+    if r["direct"] and status == httplib.NOT_FOUND:
+      self.logger.log("Direct URL [%s] not found, using Files.PrepareDownload for filename [%s]" % (r["url"], item.filename))
+      r["direct"] = False
+      self.prepare(r)
+      return
+
+    if MyDownloadRules.isCongested(status):
+      r["congested"] = True
+
+    r["attempts"] -= 1
+    # Don't retry permanent failures (eg. not found)
+    if not self.retrypolicy.isRetryable(status, item.decoded_filename): r["attempts"] = 0
+    self.logger.log("Failed to download image URL [%s], status [%d], " \
+                    "attempts remaining [%d]" % (r["url"], status if status is not None else -1, r["attempts"]))
+
+    if r["attempts"] > 0 and not stopped.is_set():
+      delay = self.retrypolicy.getDelay(r["host"], MyDownloadRules.getAttempts(self.retry) - r["attempts"], status, r["retryafter"])
+      self.waiting.append((time.time() + delay, r))
+    else:
+      self.complete(r, False)
+
+  def complete(self, r, success):
+    item = r["item"]
+
+    if not success:
+      if not item.missingOK:
+        self.totals.bump("Error", item.itype)
+    else:
+      self.totals.bump("Cached", item.itype)
+      item.status = MyMediaItem.STATUS_CACHED
+
+    self.totals.finish(item.mtype, item.itype, r["slot"])
+    self.slots.append(r["slot"])
+
+    if not success and not item.missingOK:
+      self.error_queue.put(item)
+
+    self.complete_queue.put(item)
+    self.work_queue.done(item, time.time() - r["tStart"], r["congested"], r["bytes"])
+
+  def retryWaiting(self):
+    now = time.time()
+    due = [w for w in self.waiting if w[0] <= now]
+    if due:
+      self.waiting = [w for w in self.waiting if w[0] > now]
+      for (t, r) in due:
+        if r["step"] == "prepare":
+          self.prepare(r)
+        else:
+          self.send(r, "GET", r["url"])
+
+  # Start a new request (one request per connection) of the Kodi webserver
+  def send(self, r, method, url, body=None):
+    headers = ["%s %s HTTP/1.1" % (method, url),
+               "Host: %s:%s" % (self.config.KODI_HOST, self.config.WEB_PORT),
+               "Connection: close"]
+    if self.config.WEB_AUTH_TOKEN:
+      headers.append("Authorization: Basic %s" % self.config.WEB_AUTH_TOKEN)
+    if body is not None:
+      headers.append("Content-Type: application/json")
+      headers.append("Content-Length: %d" % len(body))
+
+    r["out"] = ("%s\r\n\r\n" % "\r\n".join(headers)).encode("utf-8")
+    if body is not None: r["out"] += body.encode("utf-8")
+    r["in"] = b""
+    r["retryafter"] = None
+    r["connected"] = False
+    r["deadline"] = time.time() + self.timeout
+
+    try:
+      if self.address is None:
+        info = socket.getaddrinfo(self.config.KODI_HOST, int(self.config.WEB_PORT), 0, socket.SOCK_STREAM)
+        self.address = (info[0][0], info[0][4])
+
+      sock = socket.socket(self.address[0], socket.SOCK_STREAM)
+      sock.setblocking(0)
+      err = sock.connect_ex(self.address[1])
+      if err not in [0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK)]:
+        sock.close()
+        raise socket.error(err, os.strerror(err))
+    except socket.error as e:
+      self.logger.log("Unable to connect to webserver: %s" % e)
+      self.response(r, None, b"")
+      return
+
+    self.active[sock] = r
+
+  # Process socket events for all requests in progress
+  def poll(self, timeout):
+    if not self.active:
+      if self.waiting or self.blocked: time.sleep(0.05)
+      return
+
+    rlist = [sock for sock in self.active if self.active[sock]["connected"] and not self.active[sock]["out"]]
+    wlist = [sock for sock in self.active if not self.active[sock]["connected"] or self.active[sock]["out"]]
+
+    try:
+      (readable, writable, x) = select.select(rlist, wlist, [], timeout)
+    except (select.error, ValueError):
+      readable = writable = []
+
+    for sock in writable:
+      r = self.active[sock]
+      try:
+        if not r["connected"]:
+          err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+          if err != 0: raise socket.error(err, os.strerror(err))
+          r["connected"] = True
+        sent = sock.send(r["out"])
+        r["out"] = r["out"][sent:]
+      except socket.error:
+        self.close(sock, None)
+
+    for sock in readable:
+      r = self.active[sock]
+      try:
+        data = sock.recv(65536)
+      except socket.error:
+        self.close(sock, None)
+        continue
+
+      if data: r["in"] += data
+      (status, body, complete) = self.parse(r["in"], r["step"] == "download")
+      if complete or not data:
+        self.close(sock, status, body)
+
+    now = time.time()
+    for sock in [sock for sock in self.active if self.active[sock]["deadline"] < now]:
+      self.logger.log("** iotimeout occurred during web request **")
+      self.close(sock, httplib.REQUEST_TIMEOUT)
+
+  def close(self, sock, status, body=b""):
+    r = self.active.pop(sock)
+    try:
+      sock.close()
+    except socket.error:
+      pass
+    headers = r["in"].split(b"\r\n\r\n")[0] + b"\r\n"
+    m = re.search(b"\r\nretry-after:[ \t]*([^\r]*)\r\n", headers, re.IGNORECASE)
+    r["retryafter"] = m.group(1).decode("iso-8859-1") if m else None
+    m = re.search(b"\r\ncontent-length:[ \t]*([0-9]+)[ \t]*\r\n", headers, re.IGNORECASE)
+    r["length"] = int(m.group(1)) if m else None
+    self.response(r, status, body)
+
+  def response(self, r, status, body):
+    if r["step"] == "prepare":
+      self.prepareResponse(r, status, body)
+    else:
+      self.downloadResponse(r, status, body)
+
+  # Parse the response received so far, returning status, body and whether the response is
+  # complete. Only the first 1KB of an image is required for it to be cached.
+  def parse(self, data, partial):
+    hend = data.find(b"\r\n\r\n")
+    if hend == -1: return (None, b"", False)
+
+    headers = data[:hend].decode("iso-8859-1").split("\r\n")
+    try:
+      status = int(headers[0].split(" ")[1])
+    except (IndexError, ValueError):
+      return (None, b"", True)
+
+    length = None
+    chunked = False
+    for header in headers[1:]:
+      (key, sep, value) = header.partition(":")
+      key = key.strip().lower()
+      if key == "content-length":
+        # A malformed length fails the request, as does a malformed status line
+        try:
+          length = int(value.strip())
+        except ValueError:
+          return (None, b"", True)
+      elif key == "transfer-encoding" and "chunked" in value.lower():
+        chunked = True
+
+    body = data[hend + 4:]
+
+    if partial and (status != httplib.OK or len(body) >= 1024):
+      return (status, body[:1024], True)
+
+    if chunked:
+      decoded = MyUtility.dechunk(body)
+      return (status, decoded if decoded is not None else b"", decoded is not None)
+
+    if length is not None:
+      return (status, body[:length], len(body) >= length)
+
+    return (status, body, False)
+
 #
 # IMDB Thread
 #
 class MyIMDBLoader(threading.Thread):
-  def __init__(self, config, logger, input_queue, output_queue, plotFull, plotOutline, movies250, imdbfields):
+  def __init__(self, config, logger, input_queue, output_queue, plotFull, plotOutline, movies250, imdbfields, retrypolicy=None):
     threading.Thread.__init__(self)
 
     self.config = config
@@ -1236,6 +2044,7 @@ class MyIMDBLoader(threading.Thread):
 
     self.timeout = self.config.IMDB_TIMEOUT
     self.retry = self.config.IMDB_RETRY
+    self.retrypolicy = retrypolicy if retrypolicy else MyRetryPolicy(logger, delay=1.0)
 
   def run(self):
     while not stopped.is_set():
@@ -1300,6 +2109,15 @@ class MyIMDBLoader(threading.Thread):
               newimdb = MyUtility.getIMDBInfo("episode", imdbnumber=imdbnumber, title=show_title, year=show_year, season=season, episode=episode,
                                               plotFull=(self.plotFull and not ismultipartquery), plotOutline=(self.plotOutline and not ismultipartquery), qtimeout=self.timeout)
 
+            # Query failed - retry after a delay, unless the failure is permanent
+            if newimdb is not None and "tc.status" in newimdb:
+              (status, retryafter) = (newimdb["tc.status"], newimdb.get("tc.retryafter", None))
+              newimdb = None
+              if attempt >= self.retry or not self.retrypolicy.isRetryable(status): break
+              attempt += 1
+              if not self.retrypolicy.wait("www.omdbapi.com", attempt, status, retryafter): break
+              continue
+
             if newimdb is not None:
               newimdb = newimdb if newimdb.get("response", "False") == "True" else None
 
@@ -1934,6 +2752,28 @@ class MyDB(object):
 
     return rows[0] if rows != [] else None
 
+  def getRowCount(self):
+    if self.usejson: return None
+    return self.execute("SELECT COUNT(*) FROM texture").fetchone()[0]
+
+  # Rows matching any of the (decoded) urls, retrieved with a single query
+  def getRowsByURLs(self, urls):
+    if self.usejson:
+      return self.getRows(filter={"or": [{"field": "url", "operator": "is", "value": url} for url in urls]})
+    else:
+      return self.getRows(filter="WHERE t.url IN (%s)" % ", ".join(["'%s'" % url.replace("'", "''") for url in urls]))
+
+  # Rows matching any of the texture ids, retrieved batch ids at a time
+  def getRowsByIDs(self, ids, batch=100):
+    rows = []
+    for i in range(0, len(ids), batch):
+      chunk = ids[i:i + batch]
+      if self.usejson:
+        rows.extend(self.getRows(filter={"or": [{"field": "textureid", "operator": "is", "value": "%d" % id} for id in chunk]}))
+      else:
+        rows.extend(self.getRows(filter="WHERE t.id IN (%s)" % ", ".join(["%d" % id for id in chunk])))
+    return rows
+
   def removeNonAscii(self, s, replaceWith=""):
     if replaceWith == "":
       return  "".join([x if ord(x) < 128 else ("%%%02x" % ord(x)) for x in s])
@@ -1964,44 +2804,251 @@ class MyDB(object):
     else:
       return "WHERE cachedurl LIKE '%s/%%'" % folder
 
-# Raise this exception when we run out of replay log input
-class IOEndOfReplayLog(Exception):
-  def __init__(self, value):
-    self.value = value
-  def __str__(self):
-    return repr(self.value)
-
 #
-# Handle all JSON RPC communication.
+# Index of texture urls, cached filenames etc. used to match rows by key.
 #
-# Uses sockets except for those methods (Files.*) that must
-# use HTTP.
+# When hashed (and numpy is available) only a sorted uint64 array of 64-bit
+# key hashes is held, with a parallel array of row ids, which is much smaller
+# than a dict of the same keys and rows. Keys may be added in chunks (eg. one
+# texture folder at a time) so that all the rows are never held at once, with
+# finish() called once all keys have been added. A list of keys is located
+# with a single searchsorted, and the rows for the hash hits are then retrieved
+# by id, batch ids at a time, using fetch(ids) - returning a dict of id: (key,
+# value) - so that each hit can be confirmed against its key, and hash
+# collisions are harmless. Otherwise a regular dict of key: value is used.
 #
-class MyJSONComms(object):
-  def __init__(self, config, logger, connecttimeout=None):
-    self.config = config
-    self.logger = logger
-    self.connecttimeout = connecttimeout
-
-    self.mysocket = None
-    self.myweb = None
-    self.WEB_LAST_STATUS = -1
-    self.WEB_LAST_REASON = ""
-    self.config.WEB_SINGLESHOT = True
-    self.aUpdateCount = self.vUpdateCount = 0
-    self.jcomms2 = None
+class MyHashIndex(object):
+  def __init__(self, keys=None, values=None, ids=None, fetch=None, hashed=False, logger=None, batch=1000):
+    self.numpy = None
+    self.fetch = fetch
+    self.batch = batch
 
-    self.BUFFER_SIZE = 32768
+    if hashed and fetch:
+      try:
+        import numpy
+        self.numpy = numpy
+      except ImportError:
+        if logger: logger.log("WARNING: numpy module not imported - hashed index disabled")
+
+    if self.numpy:
+      self.dict = None
+      self.chunks = []
+      self.count = 0
+      self.hashes = self.ids = None
+    else:
+      self.dict = {}
 
-    self.QUIT_METHOD = self.QUIT_PARAMS = None
+    if keys is not None:
+      self.add(keys, values, ids)
+      self.finish()
 
-    self.LOG_REPLAYFILE = None
+  # Add keys, with their values (or the keys themselves) when not hashed, or their ids
+  # (or positions) when hashed
+  def add(self, keys, values=None, ids=None):
+    if self.dict is not None:
+      self.dict.update(zip(keys, keys if values is None else values))
+    else:
+      np = self.numpy
+      if ids is None:
+        ids = np.arange(self.count, self.count + len(keys), dtype=np.int64)
+      else:
+        ids = np.array(ids, dtype=np.int64)
+      self.chunks.append((self.getHashes(keys), ids))
+      self.count += len(keys)
 
-  def __enter__(self):
-    return self
+  def finish(self):
+    if self.dict is not None: return
 
-  def __exit__(self, atype, avalue, traceback):
-    return
+    np = self.numpy
+    if self.chunks:
+      hashes = np.concatenate([c[0] for c in self.chunks])
+      ids = np.concatenate([c[1] for c in self.chunks])
+    else:
+      hashes = np.array([], dtype=np.uint64)
+      ids = np.array([], dtype=np.int64)
+    self.chunks = []
+
+    order = np.argsort(hashes)
+    self.hashes = hashes[order]
+    self.ids = ids[order]
+
+  def isHashed(self):
+    return self.dict is None
+
+  # Python hashes are signed, so view them as unsigned 64-bit values
+  def getHashes(self, keys):
+    np = self.numpy
+    return np.array(list(map(hash, keys)), dtype=np.int64).view(np.uint64)
+
+  def __len__(self):
+    return len(self.dict) if self.dict is not None else len(self.hashes)
+
+  def __contains__(self, key):
+    return self.get(key) is not None
+
+  def get(self, key, default=None):
+    if self.dict is not None:
+      return self.dict.get(key, default)
+    return self.getMany([key], default)[0]
+
+  # Look up a list of keys, returning a list of values (or default when not found).
+  # Without values, a found key is returned in place of its value.
+  def getMany(self, keys, default=None):
+    if self.dict is not None:
+      return [self.dict.get(key, default) for key in keys]
+
+    results = [default] * len(keys)
+    if not keys or len(self.hashes) == 0: return results
+
+    np = self.numpy
+    hashes = self.hashes
+    last = len(hashes) - 1
+
+    wanted = self.getHashes(keys)
+    pos = np.minimum(np.searchsorted(hashes, wanted), last)
+    hits = np.flatnonzero(hashes[pos] == wanted).tolist()
+
+    # Every id with a matching hash is a candidate, including any collisions
+    candidates = []
+    count = 0
+    for i in hits:
+      p = int(pos[i])
+      ids = [int(self.ids[p])]
+      while p < last and hashes[p + 1] == hashes[p]:
+        p += 1
+        ids.append(int(self.ids[p]))
+      candidates.append((i, ids))
+      count += len(ids)
+
+      # Confirm the candidates once there are enough to fill a batch
+      if count >= self.batch:
+        self.confirm(keys, candidates, results)
+        candidates = []
+        count = 0
+
+    if candidates:
+      self.confirm(keys, candidates, results)
+
+    return results
+
+  def confirm(self, keys, candidates, results):
+    rows = self.fetch(sorted(set([id for (i, ids) in candidates for id in ids])))
+
+    for (i, ids) in candidates:
+      for id in ids:
+        row = rows.get(id, None)
+        if row is not None and row[0] == keys[i]:
+          results[i] = row[1]
+          break
+
+#
+# Sizes of cached files in the Thumbnails folder, keyed by cachedurl.
+#
+# The first few files are sized individually with a single stat() each. Once
+# more than threshold files have been sized, the entire Thumbnails folder is
+# listed just once - using os.scandir where available - and the remaining
+# files are sized from that inventory, rather than calling os.path.exists()
+# and os.path.getsize() for every file.
+#
+# With a threshold of None the inventory is never loaded and every file is
+# sized individually, for use when memory must remain bounded (prune.spill).
+#
+class MyThumbnailSizes(object):
+  def __init__(self, config, logger, threshold=1000):
+    self.config = config
+    self.logger = logger
+    self.threshold = threshold
+
+    self.count = 0
+    self.inventory = None
+
+  # Return size of the cached file, or None if it does not exist
+  def get(self, cachedurl):
+    if self.inventory is None:
+      self.count += 1
+      if self.threshold is None or self.count <= self.threshold:
+        try:
+          return os.stat(self.config.getFilePath(cachedurl)).st_size
+        except OSError:
+          return None
+      self.inventory = self.load()
+
+    return self.inventory.get(cachedurl, None)
+
+  def load(self):
+    path = self.config.getFilePath()
+    inventory = {}
+
+    if hasattr(os, "scandir"):
+      folders = [("", path)]
+      while folders:
+        (prefix, folder) = folders.pop()
+        try:
+          entries = list(os.scandir(folder))
+        except OSError:
+          continue
+        for entry in entries:
+          try:
+            if entry.is_dir(follow_symlinks=False):
+              folders.append(("%s%s/" % (prefix, entry.name), entry.path))
+            elif entry.is_file():
+              inventory["%s%s" % (prefix, entry.name)] = entry.stat().st_size
+          except OSError:
+            pass
+    else:
+      for (root, dirs, files) in os.walk(path):
+        prefix = os.path.relpath(root, path).replace(os.sep, "/")
+        prefix = "" if prefix == "." else "%s/" % prefix
+        for file in files:
+          try:
+            inventory["%s%s" % (prefix, file)] = os.path.getsize(os.path.join(root, file))
+          except OSError:
+            pass
+
+    self.logger.log("Loaded sizes of %d files from Thumbnails folder [%s]" % (len(inventory), path))
+
+    return inventory
+
+# Raise this exception when we run out of replay log input
+class IOEndOfReplayLog(Exception):
+  def __init__(self, value):
+    self.value = value
+  def __str__(self):
+    return repr(self.value)
+
+#
+# Handle all JSON RPC communication.
+#
+# Uses sockets except for those methods (Files.*) that must
+# use HTTP.
+#
+class MyJSONComms(object):
+  def __init__(self, config, logger, connecttimeout=None):
+    self.config = config
+    self.logger = logger
+    self.connecttimeout = connecttimeout
+
+    self.mysocket = None
+    self.myweb = None
+    self.WEB_LAST_STATUS = -1
+    self.WEB_LAST_REASON = ""
+    self.WEB_LAST_RETRYAFTER = None
+    self.WEB_LAST_LENGTH = None
+    self.config.WEB_SINGLESHOT = True
+    self.aUpdateCount = self.vUpdateCount = 0
+    self.jcomms2 = None
+
+    self.BUFFER_SIZE = 32768
+
+    self.QUIT_METHOD = self.QUIT_PARAMS = None
+
+    self.LOG_REPLAYFILE = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, atype, avalue, traceback):
+    return
 
   def __del__(self):
     if self.mysocket: self.mysocket.close()
@@ -2047,6 +3094,8 @@ class MyJSONComms(object):
       self.myweb = httplib.HTTPConnection("%s:%s" % (self.config.KODI_HOST, self.config.WEB_PORT), timeout=self.connecttimeout)
       self.WEB_LAST_STATUS = -1
       self.WEB_LAST_REASON = ""
+      self.WEB_LAST_RETRYAFTER = None
+      self.WEB_LAST_LENGTH = None
       if self.config.DEBUG: self.myweb.set_debuglevel(1)
     return self.myweb
 
@@ -2108,6 +3157,8 @@ class MyJSONComms(object):
         if match and not self.logreplay_ignore_thread(match.group(1)):
           self.WEB_LAST_STATUS = int(match.group(2))
           self.WEB_LAST_REASON = match.group(3)
+          self.WEB_LAST_RETRYAFTER = None
+          self.WEB_LAST_LENGTH = None
           return match.group(4).encode("utf-8")
       else:
         match = self.json_re_result.match(line)
@@ -2150,6 +3201,10 @@ class MyJSONComms(object):
         response = web.getresponse()
         self.WEB_LAST_STATUS = response.status
         self.WEB_LAST_REASON = response.reason
+        self.WEB_LAST_RETRYAFTER = response.getheader("Retry-After")
+        # Size of the response, which may be more than is read
+        length = response.getheader("Content-Length")
+        self.WEB_LAST_LENGTH = int(length) if length and length.strip().isdigit() else None
 
         if self.WEB_LAST_STATUS == httplib.UNAUTHORIZED:
           raise httplib.HTTPException("Remote web host requires webserver.username/webserver.password properties")
@@ -2168,6 +3223,8 @@ class MyJSONComms(object):
         self.logger.log("** iotimeout occurred during web request **")
         self.WEB_LAST_STATUS = httplib.REQUEST_TIMEOUT
         self.WEB_LAST_REASON = "Request Timeout"
+        self.WEB_LAST_RETRYAFTER = None
+        self.WEB_LAST_LENGTH = None
         self.myweb.close()
         self.myweb = None
         data = ""
@@ -2985,7 +4042,111 @@ class MyJSONComms(object):
 
   def getData(self, action, mediatype,
               filter = None, useExtraFields = False, secondaryFields = None,
-              tvshow = None, tvseason = None, channelgroupid = None, lastRun = False, subType = None, uniquecast = None):
+              tvshow = None, tvseason = None, channelgroupid = None, lastRun = False, subType = None, uniquecast = None,
+              callback = None):
+
+    (SECTION, TITLE, IDENTIFIER, REQUEST) = self.getDataRequest(action, mediatype, filter, useExtraFields, secondaryFields,
+                                                                tvshow, tvseason, channelgroupid, lastRun, subType)
+
+    dropped = self.planRequest(action, mediatype, REQUEST, secondaryFields)
+    sort = self.planSort(action, REQUEST)
+
+    loaded = [0]
+    if callback:
+      def chunkCallback(items):
+        loaded[0] += len(items)
+        callback(items, TITLE, IDENTIFIER)
+    else:
+      chunkCallback = None
+
+    data = self.getDataProxy(mediatype, REQUEST, trim_cast_thumbs=(action != "dump"), uniquecast=uniquecast, callback=chunkCallback)
+
+    if not callback and "result" in data:
+      loaded[0] = len(data["result"].get(SECTION, []))
+      if sort and SECTION in data["result"]:
+        self.sortItems(data["result"][SECTION], sort)
+
+    self.planLogged(action, REQUEST, dropped, loaded[0])
+
+    return (SECTION, TITLE, IDENTIFIER, data)
+
+  # Determine the minimal set of properties required by the action, removing from
+  # the request any property that will not be used.
+  # Return the list of properties removed from the request.
+  def planRequest(self, action, mediatype, REQUEST, secondaryFields=None):
+    properties = REQUEST.get("params", {}).get("properties", None)
+    if properties is None: return []
+
+    unused = []
+
+    if action == "cache":
+      # Only artwork, title/artist/album (naming) and file (extra artwork) are used when caching.
+      # cast and file are only added to the request by getDataRequest() when they will be used.
+      unused = ["tag", "track", "sorttitle", "set", "channeltype", "channel", "hidden", "locked", "lastplayed"]
+      if self.config.CACHE_PRIORITY:
+        unused.remove("lastplayed")
+      if mediatype.startswith("pvr."):
+        for p in ["channel", "channeltype"]: unused.remove(p)
+
+    elif action == "query":
+      # Artwork is only needed when referenced by the query
+      fields = secondaryFields.split(",") if secondaryFields else []
+      for p in ["art", "fanart", "thumbnail"]:
+        if p not in fields: unused.append(p)
+
+    elif action == "imdb":
+      unused = ["art"]
+
+    dropped = [p for p in properties if p in unused]
+    if dropped:
+      REQUEST["params"]["properties"] = [p for p in properties if p not in unused]
+
+    return dropped
+
+  def planLogged(self, action, REQUEST, dropped, items):
+    if dropped:
+      self.logger.log("Property planner: [%s] not required for %s by %s, omitted for %d items" %
+                      (", ".join(dropped), action, REQUEST["method"], items))
+
+  # Remove the server-side sort from the request when chunked.sort is disabled, so
+  # that Kodi applies limits in database order rather than re-sorting the entire
+  # table for each chunk.
+  # Return the sort to be applied client-side, or None if order is not relevant.
+  def planSort(self, action, REQUEST):
+    if self.config.CHUNKED_SORT: return None
+
+    sort = REQUEST.get("params", {}).pop("sort", None)
+
+    if sort is None or action in ["cache", "prune", "imdb", "watched"]:
+      return None
+
+    return sort
+
+  # Sort items client-side, approximating the equivalent Kodi sort method.
+  def sortItems(self, items, sort):
+    method = sort.get("method", "label")
+
+    def sortKey(item):
+      value = item.get(method, None)
+      # Numeric values, with any missing value sorted last by label - keys must
+      # be of the same type for every item
+      if method in ["track", "season", "episode"]:
+        return (value is None, value or 0, item.get("label", "").lower())
+      if method == "sorttitle" and not value:
+        value = item.get("title", None)
+      if value is None:
+        value = item.get("label", "")
+      if isinstance(value, list):
+        value = " / ".join(value)
+      return (0, value.lower())
+
+    items.sort(key=sortKey, reverse=(sort.get("order", "ascending") == "descending"))
+
+  # Build the library request for the specified action and mediatype.
+  # Return section, title and identifier names along with the request.
+  def getDataRequest(self, action, mediatype,
+              filter = None, useExtraFields = False, secondaryFields = None,
+              tvshow = None, tvseason = None, channelgroupid = None, lastRun = False, subType = None):
 
     EXTRA = mediatype
     SECTION = mediatype
@@ -3203,6 +4364,12 @@ class MyJSONComms(object):
     elif action == "cache":
       if mediatype in ["movies", "tags", "tvshows", "episodes"] and self.config.CACHE_CAST_THUMB:
         self.addProperties(REQUEST, "cast")
+      # Recency of the item (and its movie set) is used to prioritise downloads
+      if self.config.CACHE_PRIORITY:
+        if mediatype in ["movies", "tags", "tvshows", "episodes", "musicvideos"]:
+          self.addProperties(REQUEST, "dateadded, lastplayed")
+        if mediatype in ["movies", "tags"]:
+          self.addProperties(REQUEST, "setid")
       if self.config.CACHE_EXTRA:
         if mediatype in ["movies", "tags", "tvshows"]:
           self.addProperties(REQUEST, "file")
@@ -3210,13 +4377,13 @@ class MyJSONComms(object):
           self.addProperties(REQUEST, "fanart")
           self.addProperties(REQUEST, "thumbnail")
 
-    return (SECTION, TITLE, IDENTIFIER,
-            self.getDataProxy(mediatype, REQUEST, trim_cast_thumbs=(action != "dump"), uniquecast=uniquecast))
+    return (SECTION, TITLE, IDENTIFIER, REQUEST)
 
   # Load data chunked, or in one single query.
   # TV Shows, seasons and episodes are already "chunked" by definition.
   # If specified, remove cast members without thumbnails to reduce memory footprint.
-  def getDataProxy(self, mediatype, request, trim_cast_thumbs=True, idname=None, uniquecast=None):
+  # If a callback is specified, each chunk is passed to the callback rather than accumulated.
+  def getDataProxy(self, mediatype, request, trim_cast_thumbs=True, idname=None, uniquecast=None, callback=None):
     if not idname:
       idname = "lib%s" % mediatype.capitalize()
 
@@ -3224,7 +4391,7 @@ class MyJSONComms(object):
 
     if self.config.CHUNKED:
       silent = (mediatype in ["tvshows", "seasons", "episodes"])
-      data = self.chunkedLoad(mediatype, request, trim_cast_thumbs, idname=idname, silent=silent, uniquecast=uniquecast)
+      data = self.chunkedLoad(mediatype, request, trim_cast_thumbs, idname=idname, silent=silent, uniquecast=uniquecast, callback=callback)
     else:
       data = self.sendJSON(request, idname)
       if "result" in data and trim_cast_thumbs and "cast" in request.get("params",{}).get("properties",[]):
@@ -3232,12 +4399,18 @@ class MyJSONComms(object):
           if section != "limits":
             for item in data["result"][section]:
               self.removecastwithoutthumbs(item, uniquecast)
+      if callback and "result" in data:
+        for section in list(data["result"]):
+          if section != "limits":
+            callback(data["result"][section])
+            data["result"][section] = []
 
     return data
 
   # Load library data in chunks, using limits.
-  # Return resulting list of all requested items.
-  def chunkedLoad(self, mediatype, request, trim_cast_thumbs=True, idname=None, silent=False, uniquecast=None):
+  # Return resulting list of all requested items, or when a callback is
+  # specified pass each chunk to the callback as soon as it has been loaded.
+  def chunkedLoad(self, mediatype, request, trim_cast_thumbs=True, idname=None, silent=False, uniquecast=None, callback=None):
     if not idname:
       idname = "libChunked%s" % mediatype.capitalize()
 
@@ -3288,7 +4461,10 @@ class MyJSONComms(object):
         if trim_cast_thumbs and "cast" in request.get("params",{}).get("properties",[]):
           for item in data["result"][section]:
             self.removecastwithoutthumbs(item, uniquecast)
-        results.extend(data["result"][section])
+        if callback:
+          callback(data["result"][section])
+        else:
+          results.extend(data["result"][section])
 
       chunk_start = (chunk * CHUNK_SIZE)
 
@@ -3311,6 +4487,76 @@ class MyJSONComms(object):
             cast.append(i)
       mediaitem["cast"] = cast
 
+  # Return a signature for each item in the library of the specified mediatype, based
+  # on the minimal set of properties needed to detect new or changed items (and by
+  # omission, removed items) without loading the full library.
+  def getLibrarySignatures(self, mediatype):
+    if mediatype == "movies":
+      REQUEST = {"method": "VideoLibrary.GetMovies", "params": {"properties": ["art", "dateadded"]}}
+    elif mediatype == "sets":
+      REQUEST = {"method": "VideoLibrary.GetMovieSets", "params": {"properties": ["art"]}}
+    elif mediatype == "tvshows":
+      REQUEST = {"method": "VideoLibrary.GetTVShows", "params": {"properties": ["art", "dateadded", "episode"]}}
+    elif mediatype == "musicvideos":
+      REQUEST = {"method": "VideoLibrary.GetMusicVideos", "params": {"properties": ["art", "dateadded"]}}
+    elif mediatype == "albums":
+      REQUEST = {"method": "AudioLibrary.GetAlbums", "params": {"properties": ["fanart", "thumbnail"]}}
+    elif mediatype == "artists":
+      REQUEST = {"method": "AudioLibrary.GetArtists", "params": {"albumartistsonly": False, "properties": ["fanart", "thumbnail"]}}
+    else:
+      raise ValueError("Invalid mediatype for library signatures: [%s]" % mediatype)
+
+    IDENTIFIER = "%sid" % re.sub("(.*)s$", "\\1", mediatype)
+    properties = REQUEST["params"]["properties"]
+
+    data = self.getDataProxy(mediatype, REQUEST, trim_cast_thumbs=False, idname="libSignature%s" % mediatype.capitalize())
+
+    signatures = {}
+    for section in data.get("result", {}):
+      if section != "limits":
+        for item in data["result"][section]:
+          values = json.dumps([item.get(p, None) for p in properties], sort_keys=True)
+          signatures["%s" % item[IDENTIFIER]] = hashlib.md5(values.encode("utf-8")).hexdigest()
+
+    return signatures
+
+  # Load only those library items identified by ids. When there are relatively few items, retrieve
+  # each item individually, otherwise load the entire library and discard any unwanted items.
+  def getDataDelta(self, action, mediatype, ids, useExtraFields = False, secondaryFields = None, uniquecast = None):
+    (SECTION, TITLE, IDENTIFIER, REQUEST) = self.getDataRequest(action, mediatype, None, useExtraFields, secondaryFields)
+
+    dropped = self.planRequest(action, mediatype, REQUEST, secondaryFields)
+    self.planSort(action, REQUEST)
+
+    items = []
+    loaded = 0
+
+    if len(ids) <= self.config.LASTRUN_SNAPSHOT_ITEMS:
+      REQUEST["method"] = "%sDetails" % re.sub("(.*)s$", "\\1", REQUEST["method"])
+      DETAILS = "%sdetails" % IDENTIFIER[:-2]
+      properties = REQUEST["params"]["properties"]
+      for inum, id in enumerate(sorted(ids, key=int)):
+        self.logger.progress("Loading %s: %d of %d..." % (mediatype.capitalize(), inum + 1, len(ids)))
+        REQUEST["params"] = {IDENTIFIER: int(id), "properties": properties}
+        data = self.sendJSON(REQUEST, "lib%sDetails" % mediatype.capitalize(), checkResult=False)
+        if "result" in data and DETAILS in data["result"]:
+          items.append(data["result"][DETAILS])
+      if "cast" in properties:
+        for item in items:
+          self.removecastwithoutthumbs(item, uniquecast)
+      loaded = len(items)
+    else:
+      data = self.getDataProxy(mediatype, REQUEST, uniquecast=uniquecast)
+      for item in data.get("result", {}).get(SECTION, []):
+        loaded += 1
+        if "%s" % item[IDENTIFIER] in ids:
+          items.append(item)
+
+    self.planLogged(action, REQUEST, dropped, loaded)
+
+    return (SECTION, TITLE, IDENTIFIER,
+            {"result": {SECTION: items, "limits": {"start": 0, "end": len(items), "total": len(items)}}})
+
   # Return a list of all pictures (jpg/png/tbn etc.) from any "pictures" source
   def getPictures(self, addPreviews=False, addPictures=True):
     list = []
@@ -3521,13 +4767,25 @@ class MyTotals(object):
 
     self.ETIMES = {}
 
-    self.THREADS = {}
-
     self.THREADS_HIST = {}
     self.HISTORY = (time.time(), time.time(), 0)
+
+    # Counters and timings are recorded by each thread in a record of its own, without
+    # taking the global lock, and are combined with the totals by merge()
+    self.local = threading.local()
+    self.RECORDS = []
     self.PCOUNT = self.PMIN = self.PAVG = self.PMAX = 0
     self.MCOUNT = self.MMIN = self.MAVG = self.MMAX = 0
 
+    # Concurrent download levels chosen by the thread controller (final, min, max, maximum)
+    self.TLEVEL = None
+
+    # Number of retries and time spent waiting to retry, per host
+    self.RETRIES = {}
+
+    # Downloads, bytes and elapsed time, with rate and bandwidth limits, overall (None) and per host
+    self.THROUGHPUT = {}
+
     self.TOTALS = {}
     self.TOTALS["Skipped"] = {}
     self.TOTALS["Deleted"] = {}
@@ -3537,6 +4795,27 @@ class MyTotals(object):
     self.TOTALS["Ignored"] = {}
     self.TOTALS["Undefined"] = {}
 
+  def setThreadLevel(self, level, maximum):
+    with lock:
+      if self.TLEVEL is None:
+        self.TLEVEL = (level, level, level, maximum)
+      else:
+        (l, lmin, lmax, m) = self.TLEVEL
+        self.TLEVEL = (level, min(lmin, level), max(lmax, level), max(m, maximum))
+
+  def addRetry(self, host, delay):
+    with lock:
+      r = self.RETRIES.setdefault(host, [0, 0.0])
+      r[0] += 1
+      r[1] += delay
+
+  def addThroughput(self, host, count, nbytes, elapsed, rate, bandwidth):
+    with lock:
+      t = self.THROUGHPUT.setdefault(host, [0, 0, 0.0, rate, bandwidth])
+      t[0] += count
+      t[1] += nbytes
+      t[2] += elapsed
+
   def addSeasonAll(self):
     if not "Season-all" in self.TOTALS:
       self.TOTALS["Season-all"] = {}
@@ -3552,13 +4831,34 @@ class MyTotals(object):
   def TimeEnd(self, mediatype, item):
     self.TIMES[mediatype][item] = (self.TIMES[mediatype][item][0], time.time())
 
+  # Accumulate elapsed time for an item that is processed in several
+  # discrete steps (eg. parsing and matching of streamed library chunks)
+  def TimeAccumulate(self, mediatype, item, started):
+    if not mediatype in self.TIMES: self.TIMES[mediatype] = {}
+    (s, e) = self.TIMES[mediatype].get(item, (0, 0))
+    self.TIMES[mediatype][item] = (s, e + (time.time() - started))
+
+  # Elapsed time for item across all mediatypes. When mediatypes have been
+  # processed concurrently, any overlapping period is only counted once.
   def TimeDuration(self, item):
     tElapsed = 0
+    periods = []
     for m in self.TIMES:
       for i in self.TIMES[m]:
         if i == item:
           tuple = self.TIMES[m][i]
-          tElapsed += (tuple[1] - tuple[0])
+          # Accumulated time has no start time
+          if tuple[0] == 0:
+            tElapsed += tuple[1]
+          else:
+            periods.append(tuple)
+
+    tEnd = 0
+    for (s, e) in sorted(periods):
+      if s < tEnd: s = tEnd
+      if e > s: tElapsed += (e - s)
+      if e > tEnd: tEnd = e
+
     return tElapsed
 
   def gotTimeDuration(self, item):
@@ -3568,58 +4868,107 @@ class MyTotals(object):
           return True
     return False
 
-  def init(self, name=""):
+  # Counters and timings of the current thread, only ever updated by that thread
+  def getRecord(self):
+    record = getattr(self.local, "record", None)
+    if record is None:
+      record = {"threads": {}, "hist": {}, "etimes": {}, "totals": {},
+                "perf": [0, 0.0, 0, 0], "history": [0, 0]}
+      self.local.record = record
+      with lock:
+        self.RECORDS.append(record)
+    return record
+
+  # Combine the records of all threads with the totals. Records are emptied, so
+  # this should only be called once the threads have finished updating them.
+  def merge(self):
     with lock:
-      tname = threading.current_thread().name if name == "" else name
-      self.THREADS[tname] = 0
-      self.THREADS_HIST[tname] = (0, 0)
+      for record in self.RECORDS:
+        (totals, record["totals"]) = (record["totals"], {})
+        for action in totals:
+          if not action in self.TOTALS: self.TOTALS[action] = {}
+          for imgtype in totals[action]:
+            self.TOTALS[action][imgtype] = self.TOTALS[action].get(imgtype, 0) + totals[action][imgtype]
+
+        (etimes, record["etimes"]) = (record["etimes"], {})
+        for mediatype in etimes:
+          for imgtype in etimes[mediatype]:
+            times = self.ETIMES.setdefault(mediatype, {}).setdefault(imgtype, {})
+            for tname in etimes[mediatype][imgtype]:
+              (tstart, tend) = etimes[mediatype][imgtype][tname]
+              times[tname] = (times[tname][0], max(times[tname][1], tend)) if tname in times else (tstart, tend)
+
+        self.THREADS_HIST.update(record["hist"])
+
+        (pcount, pavg, pmin, pmax) = record["perf"]
+        record["perf"] = [0, 0.0, 0, 0]
+        self.PCOUNT += pcount
+        self.PAVG += pavg
+        if pcount != 0 and (self.PMIN == 0 or pmin < self.PMIN): self.PMIN = pmin
+        if pmax > self.PMAX: self.PMAX = pmax
+
+        (hend, hcount) = record["history"]
+        record["history"] = [0, 0]
+        (s, e, c) = self.HISTORY
+        self.HISTORY = (s, max(e, hend), c + hcount)
+
+  def init(self, name=""):
+    record = self.getRecord()
+    tname = threading.current_thread().name if name == "" else name
+    record["threads"][tname] = 0
+    record["hist"][tname] = (0, 0)
 
   # Record start time for an image type.
-  def start(self, mediatype, imgtype):
-    with lock:
-      tname = threading.current_thread().name
-      ctime = time.time()
-      self.THREADS[tname] = ctime
-      if not mediatype in self.ETIMES: self.ETIMES[mediatype] = {}
-      if not imgtype in self.ETIMES[mediatype]: self.ETIMES[mediatype][imgtype] = {}
-      if not tname in self.ETIMES[mediatype][imgtype]: self.ETIMES[mediatype][imgtype][tname] = (ctime, 0)
+  # tname identifies the thread (or concurrent request) when not the current thread.
+  def start(self, mediatype, imgtype, tname=None):
+    record = self.getRecord()
+    if tname is None: tname = threading.current_thread().name
+    ctime = time.time()
+    record["threads"][tname] = ctime
+    times = record["etimes"].setdefault(mediatype, {}).setdefault(imgtype, {})
+    if not tname in times: times[tname] = (ctime, 0)
 
   # Record current time for imgtype - this will allow stats to
   # determine cumulative time taken to download an image type.
-  def finish(self, mediatype, imgtype):
-    with lock:
-      tname = threading.current_thread().name
-      ctime = time.time()
-      self.setPerformance(ctime - self.THREADS[tname])
-      self.THREADS_HIST[tname] = (self.THREADS[tname], ctime)
-      self.THREADS[tname] = 0
-      self.ETIMES[mediatype][imgtype][tname] = (self.ETIMES[mediatype][imgtype][tname][0], ctime)
+  def finish(self, mediatype, imgtype, tname=None):
+    record = self.getRecord()
+    if tname is None: tname = threading.current_thread().name
+    ctime = time.time()
+    self.setPerformance(ctime - record["threads"][tname])
+    record["hist"][tname] = (record["threads"][tname], ctime)
+    record["threads"][tname] = 0
+    times = record["etimes"].setdefault(mediatype, {}).setdefault(imgtype, {})
+    times[tname] = (times[tname][0] if tname in times else ctime, ctime)
 
   def stop(self):
     self.init()
 
   # Increment counter for action/imgtype pairing
-  def bump(self, action, imgtype):
-    with lock:
-      if not action in self.TOTALS: self.TOTALS[action] = {}
-      if not imgtype in self.TOTALS[action]: self.TOTALS[action][imgtype] = 0
-      self.TOTALS[action][imgtype] += 1
+  def bump(self, action, imgtype, count=1):
+    totals = self.getRecord()["totals"]
+    if not action in totals: totals[action] = {}
+    totals[action][imgtype] = totals[action].get(imgtype, 0) + count
 
   # Calculate and store min/max/avg.
   def setPerformance(self, elapsed):
-    with lock:
-      (s, e, c) = self.HISTORY
-      self.HISTORY = (s, time.time(), c+1)
+    record = self.getRecord()
+    history = record["history"]
+    history[0] = time.time()
+    history[1] += 1
 
-      self.PCOUNT += 1
-      self.PAVG += elapsed
-      if self.PMIN == 0 or elapsed < self.PMIN: self.PMIN = elapsed
-      if elapsed > self.PMAX: self.PMAX = elapsed
+    perf = record["perf"]
+    perf[0] += 1
+    perf[1] += elapsed
+    if perf[2] == 0 or elapsed < perf[2]: perf[2] = elapsed
+    if elapsed > perf[3]: perf[3] = elapsed
 
   # Calculate average performance per second.
   def getPerformance(self, remaining):
     with lock:
       (s, e, c) = self.HISTORY
+      for record in self.RECORDS:
+        e = max(e, record["history"][0])
+        c += record["history"][1]
       tpersec = (c / (e - s)) if c != 0 else 1.0
       eta = self.secondsToTime(remaining / tpersec, withMillis=False)
       return " (%05.2f downloads per second, ETA: %s)" % (tpersec, eta)
@@ -3627,6 +4976,8 @@ class MyTotals(object):
   def libraryStats(self, item="", multi=[], filter="", lastRun=False, query=""):
     if multi: item = "/".join(multi)
 
+    self.merge()
+
     # Determine the artwork types that have been accumulated
     items = {}
     for a in self.TOTALS:
@@ -3680,9 +5031,10 @@ class MyTotals(object):
               if tuple[1] > itmax: itmax = tuple[1]
               if itype not in self.TOTALS[DOWNLOAD_LABEL]: self.TOTALS[DOWNLOAD_LABEL][itype] = 0
           self.TOTALS[DOWNLOAD_LABEL][itype] = (itmax - itmin) + (mtmax - mtmin)
-          if itmin < tmin or tmin == 0.0: tmin = itmin
+          # Ignore zero times (itype processed only by download threads, or only by the main thread)
+          if itmin != 0.0 and (itmin < tmin or tmin == 0.0): tmin = itmin
           if itmax > tmax: tmax = itmax
-          if mtmin < mmin or mmin == 0.0: mmin = mtmin
+          if mtmin != 0.0 and (mtmin < mmin or mmin == 0.0): mmin = mtmin
           if mtmax > mmax: mmax = mtmax
         self.TOTALS[DOWNLOAD_LABEL]["TOTAL"] += (tmax - tmin) + (mmax - mmin)
 
@@ -3734,6 +5086,14 @@ class MyTotals(object):
     print("")
     self.libraryStatsSummary()
 
+  def getThroughput(self, count, nbytes, elapsed, rate, bandwidth):
+    elapsed = elapsed if elapsed > 0 else 1.0
+    limits = []
+    if rate != 0: limits.append("%g downloads/s" % rate)
+    if bandwidth != 0: limits.append("%s KB/s" % format(bandwidth / 1024.0, ",.1f"))
+    return "%05.2f downloads/s, %s KB/s%s" % (count / elapsed, format(nbytes / 1024.0 / elapsed, ",.1f"),
+                                            " (limit %s)" % ", ".join(limits) if limits else "")
+
   def libraryStatsSummary(self):
     # Failed to load anything so don't display time stats that we don't have
     if not self.gotTimeDuration("Load"): return
@@ -3746,6 +5106,14 @@ class MyTotals(object):
         if not tname.startswith("Main"):
           tcount += 1
       print("  Threads Used: %d" % tcount)
+      if self.TLEVEL is not None:
+        print("  Thread Level: %d (min %d, max %d of %d)" % self.TLEVEL)
+      for host in sorted(self.RETRIES, key=lambda h: self.RETRIES[h][1], reverse=True):
+        print("    Retry Wait: %s, %d retries, %s" % (self.secondsToTime(self.RETRIES[host][1]), self.RETRIES[host][0], host))
+      if [t for t in self.THROUGHPUT.values() if t[3] != 0 or t[4] != 0]:
+        for host in [None] + sorted([h for h in self.THROUGHPUT if h is not None]):
+          if host in self.THROUGHPUT:
+            print("    Throughput: %s%s" % (self.getThroughput(*self.THROUGHPUT[host]), ", %s" % host if host else ""))
       print("   Min/Avg/Max: %05.2f / %05.2f / %05.2f downloads per second" % (self.MMIN, self.MCOUNT/mavg, self.MMAX))
       print("   Min/Avg/Max: %05.2f / %05.2f / %05.2f seconds per download" % (self.PMIN, self.PAVG/pcount, self.PMAX))
       print("")
@@ -3762,6 +5130,8 @@ class MyTotals(object):
 
     if len(self.THREADS_HIST) != 0:
       print("   Downloading: %s" % self.secondsToTime(self.TimeDuration("Download")))
+    if self.gotTimeDuration("Verify"):
+      print("     Verifying: %s" % self.secondsToTime(self.TimeDuration("Verify")))
 
     print(" TOTAL RUNTIME: %s" % self.secondsToTime(self.TimeDuration("Total")))
 
@@ -3788,27 +5158,50 @@ class MyTotals(object):
 # missingOK is used to specify that if an image cannot be loaded,
 # don't complain (ie. speculative loading, eg. season-all.tbn)
 #
+# There can be several hundred thousand items (cast thumbs, extrafanart etc.)
+# so use slots rather than a per-item dict, share a single copy of each
+# mediatype/imagetype string, and only decode the filename when needed.
+#
 class MyMediaItem(object):
-  # 0=Ignore/Skipped; 1=Missing, to be cached; 2=Stale, to be cached; 3=Queued for downloading
+  # 0=Ignore/Skipped; 1=Missing, to be cached; 2=Stale, to be cached; 3=Queued for downloading; 4=Downloaded
   STATUS_UNKNOWN = 0
   STATUS_IGNORE = 1
   STATUS_MISSING = 2
   STATUS_STALE = 3
   STATUS_QUEUED = 4
+  STATUS_CACHED = 5
+
+  __slots__ = ("status", "mtype", "itype", "name", "season", "episode", "filename", "_decoded_filename",
+               "dbid", "cachedurl", "libraryid", "missingOK", "rank")
+
+  # intern() doesn't accept unicode in Python2, so maintain our own
+  INTERNED = {}
 
   def __init__(self, mediaType, imageType, name, season, episode, filename, dbid, cachedurl, libraryid, missingOK):
     self.status = MyMediaItem.STATUS_UNKNOWN
-    self.mtype = mediaType
-    self.itype = imageType
+    self.mtype = MyMediaItem.INTERNED.setdefault(mediaType, mediaType)
+    self.itype = MyMediaItem.INTERNED.setdefault(imageType, imageType)
     self.name = name
     self.season = season
     self.episode = episode
     self.filename = filename
-    self.decoded_filename = MyUtility.normalise(self.filename, strip=True) if self.filename else self.filename
+    self._decoded_filename = None
     self.dbid = dbid
     self.cachedurl = cachedurl
     self.libraryid = libraryid
     self.missingOK = missingOK
+    self.rank = 0
+
+  @property
+  def decoded_filename(self):
+    if self._decoded_filename is None:
+      self._decoded_filename = MyUtility.normalise(self.filename, strip=True) if self.filename else self.filename
+    return self._decoded_filename
+
+  # Allow an identical decoded url (eg. from the texture cache index) to be shared
+  @decoded_filename.setter
+  def decoded_filename(self, value):
+    self._decoded_filename = value
 
   def __str__(self):
     season = "\"%s\"" % self.season if self.season else self.season
@@ -3823,6 +5216,10 @@ class MyMediaItem(object):
   def getTypeSingular(self):
     return self.mtype[:-1]
 
+  # Sort key when downloading by priority - listed artwork types first, then by rank (highest first)
+  def getPriority(self, itypes):
+    return (itypes.index(self.itype) if self.itype in itypes else len(itypes), -self.rank)
+
   def getFullName(self):
     if self.episode:
       if self.mtype == "tvshows":
@@ -3845,6 +5242,1125 @@ class MyMediaItem(object):
     else:
       return "%s" % self.name
 
+#
+# Token bucket, refilled at rate tokens per second up to the burst size.
+#
+# Download rates are limited by taking a token for each download, while bandwidth
+# is limited by charging the size of each download once it is known - the bucket
+# can go into debt, and no further downloads start until the debt is repaid.
+#
+class MyTokenBucket(object):
+  def __init__(self, rate, burst=None):
+    self.rate = rate
+    self.burst = burst if burst is not None else max(1.0, rate)
+    self.tokens = self.burst
+    self.stamp = time.time()
+
+  # Seconds until the bucket holds at least the required number of tokens
+  def getWait(self, now, required=1.0):
+    self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+    self.stamp = now
+    return 0 if self.tokens >= required else (required - self.tokens) / self.rate
+
+  def take(self, tokens=1.0):
+    self.tokens -= tokens
+
+#
+# Number of distinct items that may be downloaded during a run (cache.budget),
+# shared by the work queues of all media classes. An item already started
+# (eg. one queued again to be verified) may always be started again.
+#
+class MyCacheBudget(object):
+  def __init__(self, limit):
+    self.limit = limit
+    self.block = threading.Lock()
+    self.started = set()
+
+  # True once the budget has been used, and the item (if any) has not already been started
+  def isUsed(self, item=None):
+    with self.block:
+      if len(self.started) < self.limit: return False
+      return item is None or (item.mtype, item.filename) not in self.started
+
+  def start(self, item):
+    with self.block:
+      self.started.add((item.mtype, item.filename))
+
+#
+# Download work queue, partitioned by host.
+#
+# Each host has its own queue of pending items, an optional concurrency limit
+# (download.hosts, or 1 for any host matching singlethread.urls) and optional
+# request rate and bandwidth limits, implemented as token buckets, as are the
+# overall limits (download.rate and download.bandwidth). Download threads take the
+# next item from whichever host has pending work and spare capacity, taking
+# each host in turn, so that no thread is idle while there is work that could
+# be started, and a slow or limited host doesn't hold up any other host.
+#
+# Items without a remote host (local files etc.) are queued as host "local".
+#
+class MyHostQueue(object):
+  def __init__(self, config, maxsize=0):
+    self.config = config
+    self.maxsize = maxsize
+
+    self.cv = threading.Condition(threading.Lock())
+    self.hosts = {}
+    self.order = []
+    self.next = 0
+    self.pending = 0
+
+    # Number of items being processed, optionally limited by a controller
+    self.active = 0
+    self.controller = None
+
+    # Hosts throttled by the retry policy are not started until they're ready
+    self.retrypolicy = None
+
+    # Downloads are limited while Kodi is playing video
+    self.playback = None
+
+    # When downloading by priority each host has a heap of items, and the best
+    # item from any host is taken first
+    self.priority = config.CACHE_PRIORITY
+    self.seq = 0
+
+    # Items not started before the deadline, or once the budget (a MyCacheBudget)
+    # has been used, are deferred, counted by artwork type
+    self.deadline = config.CACHE_DEADLINE_TIME
+    self.budget = None
+    self.deferred = {}
+
+    # Overall rate and bandwidth limits
+    self.rate = config.DOWNLOAD_RATE
+    self.bandwidth = config.DOWNLOAD_BANDWIDTH
+    self.requests = MyTokenBucket(self.rate) if self.rate != 0 else None
+    self.bytes = MyTokenBucket(self.bandwidth, self.bandwidth) if self.bandwidth != 0 else None
+
+    # Observed throughput - downloads and bytes completed between the first start and last completion
+    self.done_count = 0
+    self.done_bytes = 0
+    self.first = self.last = None
+
+  def getHost(self, item):
+    m = re.match("^[a-zA-Z0-9+.-]+://([^/]+)", item.decoded_filename or "")
+    return m.group(1).split("@")[-1].lower() if m else "local"
+
+  def getLimits(self, host, item):
+    if host in self.config.DOWNLOAD_HOSTS:
+      return self.config.DOWNLOAD_HOSTS[host]
+
+    if self.config.SINGLETHREAD_URLS:
+      for site in self.config.SINGLETHREAD_URLS:
+        if site.search(item.decoded_filename):
+          return (1, 0, 0)
+
+    return (0, 0, 0)
+
+  def put(self, item, block=True, timeout=None):
+    host = self.getHost(item)
+
+    with self.cv:
+      if self.isCutoff(item):
+        self.defer(item)
+        return
+
+      if self.maxsize > 0:
+        endtime = time.time() + timeout if timeout is not None else None
+        while self.pending >= self.maxsize:
+          if not block: raise Queue.Full
+          if endtime is None:
+            self.cv.wait()
+          else:
+            remaining = endtime - time.time()
+            if remaining <= 0: raise Queue.Full
+            self.cv.wait(remaining)
+
+      h = self.hosts.get(host, None)
+      if h is None:
+        (limit, rate, bandwidth) = self.getLimits(host, item)
+        h = {"items": [] if self.priority else collections.deque(), "active": 0, "done": 0, "limit": limit,
+             "rate": rate, "requests": MyTokenBucket(rate) if rate != 0 else None,
+             "bandwidth": bandwidth, "bytes": MyTokenBucket(bandwidth, bandwidth) if bandwidth != 0 else None,
+             "ndone": 0, "nbytes": 0, "first": None, "last": None}
+        self.hosts[host] = h
+        self.order.append(host)
+
+      if self.priority:
+        self.seq += 1
+        heapq.heappush(h["items"], (item.getPriority(self.priority), self.seq, item))
+      else:
+        h["items"].append(item)
+      self.pending += 1
+      self.cv.notify_all()
+
+  # Take the next item that can be started, otherwise None along with the
+  # time until a rate or bandwidth limited host will have a token available
+  def take(self):
+    if self.isCutoff():
+      self.deferPending()
+      if self.pending == 0: return (None, None)
+
+    now = time.time()
+
+    if self.playback:
+      (limit, delay) = self.playback.getLimit(now)
+      if limit is not None:
+        if self.controller: self.controller.limit(limit)
+        if self.active >= limit: return (None, delay)
+
+    if self.controller and self.active >= self.controller.level:
+      return (None, None)
+
+    delay = None
+    best = None
+
+    if self.pending != 0:
+      delay = max(self.requests.getWait(now) if self.requests else 0,
+                  self.bytes.getWait(now, 0) if self.bytes else 0)
+      if delay > 0: return (None, delay)
+      delay = None
+
+    for i in range(len(self.order)):
+      inum = (self.next + i) % len(self.order)
+      h = self.hosts[self.order[inum]]
+
+      if not h["items"]: continue
+      if h["limit"] != 0 and h["active"] >= h["limit"]: continue
+
+      if self.retrypolicy:
+        wait = self.retrypolicy.getUntil(self.order[inum]) - now
+        if wait > 0:
+          if delay is None or wait < delay: delay = wait
+          continue
+
+      wait = max(h["requests"].getWait(now) if h["requests"] else 0,
+                 h["bytes"].getWait(now, 0) if h["bytes"] else 0)
+      if wait > 0:
+        if delay is None or wait < delay: delay = wait
+        continue
+
+      if not self.priority:
+        best = (inum, h)
+        break
+
+      if best is None or h["items"][0] < best[1]["items"][0]:
+        best = (inum, h)
+
+    if best is None:
+      return (None, delay)
+
+    (inum, h) = best
+    if h["requests"]: h["requests"].take()
+    if self.requests: self.requests.take()
+    if h["first"] is None: h["first"] = now
+    if self.first is None: self.first = now
+
+    self.next = (inum + 1) % len(self.order)
+    self.active += 1
+    h["active"] += 1
+    self.pending -= 1
+    self.cv.notify_all()
+    item = heapq.heappop(h["items"])[2] if self.priority else h["items"].popleft()
+    if self.budget: self.budget.start(item)
+    return (item, None)
+
+  # True once the deadline has passed, or the budget has been used (and the item,
+  # if any, cannot be started)
+  def isCutoff(self, item=None):
+    if self.budget and self.budget.isUsed(item): return True
+    return self.deadline is not None and time.time() >= self.deadline
+
+  def defer(self, item):
+    self.deferred[item.itype] = self.deferred.get(item.itype, 0) + 1
+
+  # Deadline has passed or budget used - discard all pending items that cannot be started
+  def deferPending(self):
+    if self.pending == 0: return
+    for host in self.order:
+      h = self.hosts[host]
+      kept = []
+      for entry in h["items"]:
+        item = entry[2] if self.priority else entry
+        if self.isCutoff(item):
+          self.defer(item)
+          self.pending -= 1
+        else:
+          kept.append(entry)
+      if len(kept) != len(h["items"]):
+        h["items"] = kept if self.priority else collections.deque(kept)
+    self.cv.notify_all()
+
+  # Number of items deferred by artwork type
+  def getDeferred(self):
+    with self.cv:
+      return dict(self.deferred)
+
+  def get(self, block=True, timeout=None):
+    with self.cv:
+      endtime = time.time() + timeout if timeout is not None else None
+      while True:
+        (item, delay) = self.take()
+        if item is not None: return item
+        if not block: raise Queue.Empty
+        if endtime is not None:
+          remaining = endtime - time.time()
+          if remaining <= 0: raise Queue.Empty
+          delay = remaining if delay is None or remaining < delay else delay
+        self.cv.wait(delay)
+
+  # Item taken from the queue has been processed, freeing capacity for the host.
+  # The elapsed time and congestion status are used to adjust the controller level,
+  # and the number of bytes downloaded is charged against any bandwidth limits.
+  def done(self, item, elapsed=0.0, congested=False, nbytes=0):
+    host = self.getHost(item)
+    with self.cv:
+      now = time.time()
+      h = self.hosts[host]
+      h["active"] -= 1
+      h["done"] += 1
+      h["ndone"] += 1
+      h["nbytes"] += nbytes
+      h["last"] = now
+      self.active -= 1
+      self.done_count += 1
+      self.done_bytes += nbytes
+      self.last = now
+      if nbytes != 0:
+        if h["bytes"]: h["bytes"].take(nbytes)
+        if self.bytes: self.bytes.take(nbytes)
+      # Downloads limited during playback aren't representative of the webserver capacity
+      if self.controller and not (self.playback and self.playback.getLimit(now)[0] is not None):
+        self.controller.update(elapsed, congested)
+      self.cv.notify_all()
+
+  def setController(self, controller):
+    with self.cv:
+      self.controller = controller
+
+  def setRetryPolicy(self, retrypolicy):
+    with self.cv:
+      self.retrypolicy = retrypolicy
+
+  def setPlaybackMonitor(self, playback):
+    with self.cv:
+      self.playback = playback
+
+  def setBudget(self, budget):
+    with self.cv:
+      self.budget = budget
+
+  def qsize(self):
+    with self.cv:
+      return self.pending
+
+  def empty(self):
+    return self.qsize() == 0
+
+  # Number of hosts with pending work
+  def hostcount(self):
+    with self.cv:
+      return len([h for h in self.hosts.values() if h["items"]])
+
+  def logStats(self, logger):
+    with self.cv:
+      for host in self.order:
+        h = self.hosts[host]
+        logger.log("Host download stats: [%s] items %d, bytes %d, concurrency limit %s, rate limit %s, bandwidth limit %s" %
+                   (host, h["done"], h["nbytes"], h["limit"] if h["limit"] != 0 else "none",
+                    "%s/s" % h["rate"] if h["rate"] != 0 else "none",
+                    "%d bytes/s" % h["bandwidth"] if h["bandwidth"] != 0 else "none"))
+
+  # Record observed throughput, overall and for each host with a rate or bandwidth limit,
+  # since throughput was last recorded
+  def addThroughput(self, totals):
+    with self.cv:
+      if self.first is not None and self.last is not None:
+        totals.addThroughput(None, self.done_count, self.done_bytes, self.last - self.first, self.rate, self.bandwidth)
+      self.done_count = self.done_bytes = 0
+      self.first = self.last = None
+      for host in self.order:
+        h = self.hosts[host]
+        if (h["rate"] != 0 or h["bandwidth"] != 0) and h["first"] is not None and h["last"] is not None:
+          totals.addThroughput(host, h["ndone"], h["nbytes"], h["last"] - h["first"], h["rate"], h["bandwidth"])
+        h["ndone"] = h["nbytes"] = 0
+        h["first"] = h["last"] = None
+
+#
+# Sort (key, data) string pairs by key with bounded memory. Once limit pairs are
+# held in memory they are sorted and written (spilled) to a temporary file, and
+# iterating merges the spilled files with any pairs still held in memory.
+# Pairs are added under a lock, so may be added from several threads. Keys and
+# data are held as unicode, and spilled as utf-8, so that pairs read back from a
+# file compare with those held in memory.
+#
+class MyExternalSort(object):
+  def __init__(self, limit, logger, name="sort"):
+    self.limit = limit
+    self.logger = logger
+    self.name = name
+
+    self.lock = threading.Lock()
+    self.items = []
+    self.files = []
+    self.count = 0
+
+  def __len__(self):
+    return self.count
+
+  def __setitem__(self, key, data):
+    self.add(key, data)
+
+  def add(self, key, data=""):
+    if key is None: return
+    key = MyUtility.toUnicode(key)
+    data = MyUtility.toUnicode(data)
+    with self.lock:
+      self.items.append((key, data))
+      self.count += 1
+      if len(self.items) >= self.limit:
+        self.spill()
+
+  def spill(self):
+    self.items.sort()
+    f = tempfile.TemporaryFile(mode="w+b")
+    outfile = codecs.getwriter("utf-8")(f)
+    for item in self.items:
+      outfile.write(u"%s\n" % json.dumps(item, ensure_ascii=False))
+    outfile.flush()
+    self.files.append(f)
+    self.logger.log("Spilled %d %s items to temporary file #%d" % (len(self.items), self.name, len(self.files)))
+    self.items = []
+
+  # Split lines on newline only (a codecs reader would also split on unicode line
+  # breaks, which json does not escape)
+  def readFile(self, f):
+    f.seek(0)
+    for line in f:
+      yield tuple(json.loads(line.decode("utf-8")))
+
+  def __iter__(self):
+    self.items.sort()
+    return heapq.merge(*([self.readFile(f) for f in self.files] + [iter(self.items)]))
+
+  def close(self):
+    for f in self.files:
+      f.close()
+    self.files = []
+    self.items = []
+
+#
+# Run tasks on a bounded pool of threads, each thread with its own JSON connection.
+#
+# A task is a function called with the connection of the thread running it, and
+# may itself add further tasks. With a single thread, or when replaying a log,
+# tasks are instead run in the calling thread using its connection as soon as
+# they are added, in the same order as a serial implementation. The first
+# exception raised by any task is raised again by run() once all threads have
+# finished.
+#
+class MyTaskPool(object):
+  def __init__(self, config, logger, jcomms, threadcount, name="Task"):
+    self.config = config
+    self.logger = logger
+    self.jcomms = jcomms
+    self.name = name
+
+    self.threadcount = 1 if config.LOG_REPLAY_FILENAME else threadcount
+    self.serial = (self.threadcount <= 1)
+
+    self.queue = Queue.Queue()
+    self.pending = 0
+    self.error = None
+
+  def add(self, function, *args):
+    if self.serial:
+      function(self.jcomms, *args)
+    else:
+      with lock:
+        self.pending += 1
+      self.queue.put((function, args))
+
+  def worker(self, jcomms):
+    while not stopped.is_set() and self.error is None:
+      try:
+        (function, args) = self.queue.get(timeout=0.1)
+      except Queue.Empty:
+        with lock:
+          if self.pending == 0: break
+        continue
+
+      try:
+        function(jcomms, *args)
+      except (Exception, SystemExit) as e:
+        self.logger.log("%s task failed in %s: %s" % (self.name, threading.current_thread().name, e))
+        with lock:
+          if self.error is None: self.error = e
+      finally:
+        with lock:
+          self.pending -= 1
+
+  def run(self):
+    if self.serial: return
+
+    self.logger.log("Creating %d %s thread(s) for %d initial task(s)" % (self.threadcount, self.name, self.pending))
+
+    THREADS = []
+    for i in range(self.threadcount):
+      t = threading.Thread(target=self.worker, args=(MyJSONComms(self.config, self.logger),), name="%s-%d" % (self.name, i + 1))
+      THREADS.append(t)
+      t.setDaemon(True)
+      t.start()
+
+    # Join with a timeout so that the main thread remains responsive to interrupts
+    for t in THREADS:
+      while t.is_alive():
+        t.join(1.0)
+
+    if self.error is not None: raise self.error
+
+#
+# AIMD (additive increase, multiplicative decrease) controller for the number
+# of concurrent downloads, as enabled by download.threads.auto.
+#
+# Starting with a single download, the level is increased by one after each
+# window of downloads completed without congestion, up to the maximum number of
+# download threads. The level is halved when the webserver times out or returns
+# server errors during a window, or when the average download latency of a window
+# is more than twice the best average latency observed.
+#
+class MyThreadController(object):
+  def __init__(self, maximum, logger, totals):
+    self.maximum = maximum if maximum > 1 else 1
+    self.logger = logger
+    self.totals = totals
+
+    self.level = 1
+    self.baseline = None
+    self.window = []
+
+    self.totals.setThreadLevel(self.level, self.maximum)
+
+  def update(self, elapsed, congested):
+    self.window.append((elapsed, congested))
+    if len(self.window) < max(4, self.level * 2): return
+
+    congestion = len([w for w in self.window if w[1]])
+    latency = sum([w[0] for w in self.window]) / len(self.window)
+    self.window = []
+
+    if self.baseline is None or latency < self.baseline:
+      self.baseline = latency
+
+    if congestion != 0 or latency > (self.baseline * 2):
+      level = self.level // 2 if self.level > 1 else 1
+    else:
+      level = self.level + 1 if self.level < self.maximum else self.maximum
+
+    if level != self.level:
+      self.logger.log("Thread controller: level %d -> %d (latency %.3fs, best %.3fs, congestion %d)" %
+                      (self.level, level, latency, self.baseline, congestion))
+      self.level = level
+
+    self.totals.setThreadLevel(self.level, self.maximum)
+
+  # Reduce the level (eg. during playback) - it will increase again once downloads are no longer limited
+  def limit(self, level):
+    level = level if level > 1 else 1
+    if level < self.level:
+      self.logger.log("Thread controller: level %d -> %d (limited)" % (self.level, level))
+      self.level = level
+      self.window = []
+      self.totals.setThreadLevel(self.level, self.maximum)
+
+#
+# Monitor Kodi playback, so that downloads can be limited (download.playback)
+# while video is playing, to avoid stuttering playback on the client.
+#
+# Notifications are received on a dedicated socket. Downloads are limited from
+# the start of video playback until download.playback.delay seconds after playback
+# has stopped (so as to ignore the gap between playlist items), but not while
+# playback is paused or the screensaver is active.
+#
+class MyPlaybackMonitor(threading.Thread):
+  def __init__(self, config, logger, level, delay=5.0):
+    threading.Thread.__init__(self, name="PlaybackMonitor")
+
+    self.config = config
+    self.logger = logger
+    self.level = level
+    self.delay = delay
+
+    self.cv = threading.Lock()
+    self.playing = False
+    self.paused = False
+    self.screensaver = False
+
+    # When limited, time that playback started, otherwise time until which downloads remain limited
+    self.since = None
+    self.until = None
+
+  def run(self):
+    try:
+      jcomms = MyJSONComms(self.config, self.logger)
+      self.getKodiStatus(jcomms)
+      jcomms.sendJSON({"method": "JSONRPC.Ping"}, "libPlayback", callback=self.notification, checkResult=False)
+    except Exception as e:
+      self.logger.log("Playback monitor: unable to monitor playback: %s" % str(e))
+
+    with self.cv:
+      self.playing = False
+      self.update()
+
+  def getKodiStatus(self, jcomms):
+    REQUEST = {"method": "XBMC.GetInfoBooleans", "params": {"booleans": ["System.ScreenSaverActive"]}}
+    data = jcomms.sendJSON(REQUEST, "libBooleans", checkResult=False)
+    screensaver = data.get("result", {}).get("System.ScreenSaverActive", False)
+
+    REQUEST = {"method": "Player.GetActivePlayers"}
+    data = jcomms.sendJSON(REQUEST, "libPlayers", checkResult=False)
+    players = [p for p in data.get("result", []) if p.get("type", None) == "video"]
+
+    paused = False
+    if players:
+      REQUEST = {"method": "Player.GetProperties", "params": {"playerid": players[0]["playerid"], "properties": ["speed"]}}
+      data = jcomms.sendJSON(REQUEST, "libPlayerProps", checkResult=False)
+      paused = (data.get("result", {}).get("speed", 1) == 0)
+
+    with self.cv:
+      self.screensaver = screensaver
+      self.playing = (players != [])
+      self.paused = paused
+      self.update()
+
+  def notification(self, id, method, params):
+    # Only interested in Notifications...
+    if id: return stopped.is_set()
+
+    data = params.get("data", None) if params else None
+    data = data if type(data) is dict else {}
+
+    with self.cv:
+      if method in ["Player.OnPlay", "Player.OnResume", "Player.OnAVStart"]:
+        # Player 1 is the video player - otherwise decide by type of item, eg. song
+        if "player" in data and "playerid" in data["player"]:
+          self.playing = (data["player"]["playerid"] == 1)
+        else:
+          self.playing = (data.get("item", {}).get("type", None) not in ["song", "picture"])
+        self.paused = False
+      elif method == "Player.OnPause":
+        self.paused = True
+      elif method == "Player.OnStop":
+        self.playing = self.paused = False
+      elif method == "GUI.OnScreensaverActivated":
+        self.screensaver = True
+      elif method == "GUI.OnScreensaverDeactivated":
+        self.screensaver = False
+      self.update()
+
+    return (method == "System.OnQuit" or stopped.is_set())
+
+  def update(self):
+    limited = (self.playing and not self.paused and not self.screensaver)
+    if limited and self.since is None:
+      self.since = time.time()
+      self.until = None
+      self.logger.log("Playback monitor: video playback started, %s" %
+                      ("pausing downloads" if self.level == 0 else "limiting downloads to %d" % self.level))
+    elif not limited and self.since is not None:
+      self.logger.log("Playback monitor: video playback stopped after %d seconds, downloads limited for a further %g seconds" %
+                      (time.time() - self.since, self.delay))
+      self.since = None
+      self.until = time.time() + self.delay
+
+  # The limit on concurrent downloads (None if not limited), and seconds until the limit will be lifted
+  def getLimit(self, now):
+    with self.cv:
+      if self.since is not None:
+        return (self.level, None)
+      if self.until is not None and now < self.until:
+        return (self.level, self.until - now)
+      return (None, None)
+
+#
+# Retry policy, shared by the download threads (or by the IMDb threads).
+#
+# The delay before each retry doubles with each attempt, up to a maximum, with
+# random jitter so that threads failing at the same time don't all retry at the
+# same time. When a host responds with 429 (Too Many Requests) or 503 (Service
+# Unavailable) and a Retry-After interval, no request of that host is retried
+# (or, for downloads, started) until the interval has passed. Permanent failures
+# such as 404 (Not Found), and embedded images, are never retried.
+#
+# The number of retries and total time spent waiting to retry is recorded per host.
+#
+class MyRetryPolicy(object):
+  PERMANENT = [httplib.BAD_REQUEST, httplib.UNAUTHORIZED, httplib.FORBIDDEN, httplib.NOT_FOUND,
+               httplib.METHOD_NOT_ALLOWED, httplib.GONE, httplib.NOT_IMPLEMENTED]
+  THROTTLED = [429, httplib.SERVICE_UNAVAILABLE]
+
+  def __init__(self, logger, totals=None, delay=0.5, maxdelay=30.0):
+    self.logger = logger
+    self.totals = totals
+    self.delay = delay if delay > 0 else 0.0
+    self.maxdelay = maxdelay if maxdelay > self.delay else self.delay
+
+    self.rlock = threading.Lock()
+    self.hosts = {}
+    self.until = {}
+
+  def isRetryable(self, status=None, filename=None):
+    if status in self.PERMANENT: return False
+    if filename and re.match("^(video|music)@", filename): return False
+    return True
+
+  # Record a Retry-After interval (seconds or HTTP date) received from host
+  def throttle(self, host, status, retryafter):
+    if status not in self.THROTTLED: return
+    seconds = self.parseRetryAfter(retryafter)
+    if seconds is None: return
+    seconds = min(seconds, self.maxdelay)
+    with self.rlock:
+      self.until[host] = max(self.until.get(host, 0), time.time() + seconds)
+    self.logger.log("Host [%s] is throttling requests (%d), retry after %.2f seconds" % (host, status, seconds))
+
+  # Time at which requests of host can resume, 0 if not throttled
+  def getUntil(self, host):
+    with self.rlock:
+      return self.until.get(host, 0)
+
+  # Delay before retry number attempt (1 for the first retry) of a request of host
+  def getDelay(self, host, attempt, status=None, retryafter=None):
+    self.throttle(host, status, retryafter)
+
+    delay = min(self.maxdelay, self.delay * (2 ** (attempt - 1)))
+    delay = random.uniform(delay / 2, delay)
+
+    delay = max(delay, self.getUntil(host) - time.time())
+
+    with self.rlock:
+      h = self.hosts.setdefault(host, [0, 0.0])
+      h[0] += 1
+      h[1] += delay
+    if self.totals: self.totals.addRetry(host, delay)
+
+    self.logger.log("Retrying request of host [%s] in %.2f seconds (retry %d, status %s)" % (host, delay, attempt, status))
+    return delay
+
+  # Wait before retrying, returning False if processing has been stopped
+  def wait(self, host, attempt, status=None, retryafter=None):
+    return not stopped.wait(self.getDelay(host, attempt, status, retryafter))
+
+  def logStats(self, logger):
+    with self.rlock:
+      for host in sorted(self.hosts):
+        logger.log("Host retry stats: [%s] retries %d, waiting %.2f seconds" % (host, self.hosts[host][0], self.hosts[host][1]))
+
+  @staticmethod
+  def parseRetryAfter(value):
+    if value is None: return None
+    value = value.strip()
+    if value.isdigit(): return int(value)
+    try:
+      return max(0, email.utils.mktime_tz(email.utils.parsedate_tz(value)) - time.time())
+    except (TypeError, ValueError, OverflowError):
+      return None
+
+#
+# Journal of the artwork queued for download by c/C (cache.journal), allowing an
+# interrupted run to be resumed (cache.resume) without reloading the library.
+#
+# Items are recorded by media class and url when queued, and marked as done once
+# processed by a download thread. The journal is marked as finished when the run
+# completes, unless items were deferred (cache.deadline or cache.budget) in which
+# case the run can be resumed to download the deferred items. Changes are
+# committed in batches, and when the journal is closed.
+#
+class MyCacheJournal(object):
+  COMMIT_ITEMS = 250
+  COMMIT_INTERVAL = 5.0
+
+  def __init__(self, config, logger, filename):
+    self.config = config
+    self.logger = logger
+    self.filename = filename
+
+    self.jlock = threading.Lock()
+    self.con = None
+    self.run = None
+    self.changes = 0
+    self.committed = time.time()
+    self.deferred = False
+
+  def open(self):
+    try:
+      import sqlite3
+    except ImportError:
+      self.logger.log("ERROR: SQLite3 module not imported - cache journal disabled")
+      return False
+
+    try:
+      self.con = sqlite3.connect(self.filename, timeout=10, check_same_thread=False)
+      self.con.execute("CREATE TABLE IF NOT EXISTS run (id INTEGER PRIMARY KEY, data TEXT)")
+      self.con.execute("CREATE TABLE IF NOT EXISTS item (mtype TEXT, url TEXT, done INTEGER, data TEXT, PRIMARY KEY (mtype, url))")
+      row = self.con.execute("SELECT data FROM run WHERE id = 1").fetchone()
+      self.run = json.loads(row[0]) if row else None
+    except sqlite3.Error as e:
+      self.logger.log("ERROR: Unable to open cache journal [%s]: %s" % (self.filename, e))
+      self.con = None
+      return False
+
+    return True
+
+  def close(self):
+    with self.jlock:
+      if self.con:
+        self.commit()
+        self.con.close()
+        self.con = None
+
+  # Start a new run, discarding the previous journal
+  def begin(self, option, multi, filter):
+    with self.jlock:
+      self.run = {"option": option, "multi": multi, "filter": filter, "finished": False}
+      self.con.execute("DELETE FROM item")
+      self.commit()
+
+  def finish(self):
+    with self.jlock:
+      if self.deferred:
+        self.logger.log("Cache journal [%s] has deferred items - run can be resumed" % self.filename)
+      else:
+        self.run["finished"] = True
+      self.commit()
+
+  def setDeferred(self):
+    with self.jlock:
+      self.deferred = True
+
+  # Unfinished run that can be resumed by option for the same media classes and filter,
+  # or None. The age of the journal is that of the last commit.
+  def getResumable(self, option, multi, filter):
+    if self.run is None or self.run.get("finished", True):
+      return None
+    if (self.run["option"], self.run["multi"], self.run["filter"]) != (option, multi, filter):
+      self.logger.log("Cache journal [%s] is for a different run: %s" % (self.filename, self.run))
+      return None
+    age = time.time() - self.run.get("updated", 0)
+    if age > self.config.CACHE_JOURNAL_MAXAGE * 3600:
+      self.logger.log("Cache journal [%s] is too old to resume (%d seconds)" % (self.filename, age))
+      return None
+    return self.run
+
+  def queued(self, item):
+    data = json.dumps([item.status, item.itype, item.name, item.season, item.episode,
+                       item.dbid, item.cachedurl, item.libraryid, item.missingOK])
+    with self.jlock:
+      self.con.execute("INSERT OR REPLACE INTO item (mtype, url, done, data) VALUES (?, ?, 0, ?)", (item.mtype, item.filename, data))
+      self.changed()
+
+  def completed(self, item):
+    with self.jlock:
+      self.con.execute("UPDATE item SET done = 1 WHERE mtype = ? AND url = ?", (item.mtype, item.filename))
+      self.changed()
+
+  # Media items not yet processed, in the order they were queued
+  def getUnfinished(self, mtype):
+    with self.jlock:
+      rows = self.con.execute("SELECT url, data FROM item WHERE mtype = ? AND done = 0 ORDER BY rowid", (mtype,)).fetchall()
+
+    items = []
+    for (url, data) in rows:
+      (status, itype, name, season, episode, dbid, cachedurl, libraryid, missingOK) = json.loads(data)
+      item = MyMediaItem(mtype, itype, name, season, episode, url, dbid, cachedurl, libraryid, missingOK)
+      item.status = status
+      items.append(item)
+    return items
+
+  def changed(self):
+    self.changes += 1
+    if self.changes >= self.COMMIT_ITEMS or time.time() >= (self.committed + self.COMMIT_INTERVAL):
+      self.commit()
+
+  def commit(self):
+    if self.run is not None:
+      self.run["updated"] = time.time()
+      self.con.execute("INSERT OR REPLACE INTO run (id, data) VALUES (1, ?)", (json.dumps(self.run),))
+    self.con.commit()
+    self.changes = 0
+    self.committed = time.time()
+
+#
+# Download scheduler, owning the work queue and download threads.
+#
+# Download threads run until the producer has been set (all work has been
+# queued) and the work queue is empty. A scheduler can be private to a single
+# media class, or shared by several media classes that are loaded
+# concurrently (cache.concurrent) in which case the number of download threads
+# is a global limit across all media classes.
+#
+# A bounded work queue (qsize) will block queueing of items until there is space.
+#
+class MyCacheScheduler(object):
+  def __init__(self, force, drop_items, qsize=0):
+    self.force = force
+    self.drop_items = drop_items
+
+    self.mediatype = None
+    self.itemCount = 0
+
+    # Set once all library data has been loaded and queued
+    self.producer = threading.Event()
+
+    self.work_queue = MyHostQueue(gConfig, maxsize=qsize)
+    self.error_queue = Queue.Queue()
+    self.complete_queue = Queue.Queue()
+
+    self.retrypolicy = MyRetryPolicy(gLogger, TOTALS, gConfig.DOWNLOAD_RETRY_DELAY, gConfig.DOWNLOAD_RETRY_MAXDELAY)
+    self.work_queue.setRetryPolicy(self.retrypolicy)
+    self.work_queue.setPlaybackMonitor(PLAYBACK)
+    self.work_queue.setBudget(BUDGET)
+
+    # Record queued and completed items when journalling
+    self.journal = JOURNAL
+
+    # Downloaded items, to be confirmed present in the texture cache
+    self.verify = [] if gConfig.CACHE_VERIFY and not gConfig.LOG_REPLAY_FILENAME else None
+
+    self.THREADS = []
+
+  def start(self, mediatype, threadcount):
+    self.mediatype = mediatype
+
+    TOTALS.TimeStart(self.mediatype, "Download")
+
+    self.startThreads(threadcount)
+
+  def startThreads(self, threadcount):
+    self.THREADS = []
+
+    # The event-loop loader performs all downloads on a single thread
+    if gConfig.DOWNLOAD_ASYNC > 0 and not gConfig.LOG_REPLAY_FILENAME:
+      if gConfig.DOWNLOAD_THREADS_AUTO:
+        self.work_queue.setController(MyThreadController(gConfig.DOWNLOAD_ASYNC, gLogger, TOTALS))
+      gLogger.log("Creating event-loop download thread for %d concurrent requests" % gConfig.DOWNLOAD_ASYNC)
+      t = MyAsyncImageLoader(self.work_queue, self.error_queue, self.complete_queue,
+                             gConfig, gLogger, TOTALS, self.force, gConfig.DOWNLOAD_RETRY, producer=self.producer,
+                             retrypolicy=self.retrypolicy, slots=gConfig.DOWNLOAD_ASYNC)
+      self.THREADS.append(t)
+      t.setDaemon(True)
+      t.start()
+      return
+
+    if gConfig.DOWNLOAD_THREADS_AUTO:
+      self.work_queue.setController(MyThreadController(threadcount, gLogger, TOTALS))
+
+    gLogger.log("Creating %d download thread(s)" % threadcount)
+    for i in range(threadcount):
+      t = MyImageLoader(self.work_queue, self.error_queue, self.complete_queue,
+                        gConfig, gLogger, TOTALS, self.force, gConfig.DOWNLOAD_RETRY, producer=self.producer,
+                        retrypolicy=self.retrypolicy)
+      self.THREADS.append(t)
+      t.setDaemon(True)
+
+    for t in self.THREADS: t.start()
+
+  # Queue item for download, blocking until there is space or processing has been stopped
+  def queue(self, item):
+    with lock:
+      self.itemCount += 1
+
+    if gLogger.VERBOSE and gLogger.LOGGING: gLogger.log("QUEUE ITEM: %s" % item)
+
+    if self.journal: self.journal.queued(item)
+
+    item.status = MyMediaItem.STATUS_QUEUED
+
+    while not stopped.is_set():
+      try:
+        self.work_queue.put(item, block=True, timeout=1.0)
+        break
+      except Queue.Full:
+        pass
+
+  # Item has been processed by a download thread
+  def completed(self, item):
+    if self.journal: self.journal.completed(item)
+    if self.verify is not None and item.status == MyMediaItem.STATUS_CACHED: self.verify.append(item)
+
+  # All work has been queued - wait for the downloads to complete
+  def finish(self):
+    # Discard items completed while the library was being loaded, so that they
+    # don't distort the download rate once progress is being monitored
+    itemsCompleted = 0
+    while True:
+      try:
+        qItem = self.complete_queue.get(block=False)
+        self.complete_queue.task_done()
+        self.completed(qItem)
+        itemsCompleted += 1
+      except Queue.Empty:
+        break
+
+    self.producer.set()
+
+    cacheImages_monitor(self.mediatype, len(self.THREADS), self.itemCount, self.work_queue,
+                        self.error_queue, self.complete_queue, itemsRemaining=(self.itemCount - itemsCompleted),
+                        completed=self.completed)
+
+    # Download once more any items that are not present in the texture cache
+    if self.verify and not stopped.is_set():
+      missing = self.verifyCached()
+      if missing:
+        gLogger.out("\nDownloading %d item(s) not found in texture cache...\n" % len(missing))
+        threadcount = len(self.THREADS)
+        # The original download threads have exited, and the work queue may be
+        # bounded - start the new threads before re-queueing, holding them open
+        # until every missing item has been queued
+        self.producer.clear()
+        self.startThreads(threadcount if threadcount <= len(missing) else len(missing))
+        for item in missing:
+          TOTALS.bump("Cached", item.itype, -1)
+          if self.journal: self.journal.queued(item)
+          item.status = MyMediaItem.STATUS_QUEUED
+          while not stopped.is_set():
+            try:
+              self.work_queue.put(item, block=True, timeout=1.0)
+              break
+            except Queue.Full:
+              pass
+        self.producer.set()
+        cacheImages_monitor(self.mediatype, len(self.THREADS), len(missing), self.work_queue,
+                            self.error_queue, self.complete_queue, completed=self.completed)
+
+      if self.verify and not stopped.is_set():
+        for item in self.verifyCached():
+          TOTALS.bump("Cached", item.itype, -1)
+          TOTALS.bump("Unverified", item.itype)
+          gLogger.log("UNVERIFIED ITEM: %s" % item)
+
+    cacheImages_errors(self.error_queue, self.drop_items)
+
+    self.retrypolicy.logStats(gLogger)
+
+    deferred = self.work_queue.getDeferred()
+    if deferred:
+      gLogger.log("Deadline or budget reached - deferred %d items" % sum(deferred.values()))
+      if self.journal: self.journal.setDeferred()
+      for itype in deferred:
+        for i in range(deferred[itype]): TOTALS.bump("Deferred", itype)
+
+  # Downloaded items that are not present in the texture cache, querying cache.verify.batch urls at a time
+  def verifyCached(self):
+    items = self.verify
+    self.verify = []
+
+    TOTALS.TimeStart(self.mediatype, "Verify")
+
+    missing = []
+    database = MyDB(gConfig, gLogger)
+    with database:
+      batch = gConfig.CACHE_VERIFY_BATCH if gConfig.CACHE_VERIFY_BATCH > 0 else 100
+      for i in range(0, len(items), batch):
+        gLogger.progress("Verifying downloaded items %d of %d..." % (min(i + batch, len(items)), len(items)))
+        chunk = items[i:i + batch]
+        found = set([row["url"] for row in database.getRowsByURLs(list(set([item.decoded_filename for item in chunk])))])
+        missing.extend([item for item in chunk if item.decoded_filename not in found])
+    gLogger.progress("")
+
+    TOTALS.TimeEnd(self.mediatype, "Verify")
+
+    gLogger.log("Verified %d downloaded item(s), %d not found in texture cache" % (len(items), len(missing)))
+    return missing
+
+#
+# Streaming cache pipeline (c/C with cache.stream enabled).
+#
+# Download threads are started before the library is loaded, and each chunk
+# of library data is then parsed, matched against the texture cache and
+# queued for download as soon as it has been loaded. The work queues are
+# bounded, so the library is never held in memory in its entirety.
+#
+# When a shared scheduler is specified, the downloads are monitored by the
+# owner of the scheduler once all media classes have been queued.
+#
+class MyCacheStream(object):
+  def __init__(self, mediatype, jcomms, database, force, drop_items, scheduler=None):
+    self.mediatype = mediatype
+    self.jcomms = jcomms
+    self.database = database
+    self.force = force
+
+    self.imagecache = {}
+    self.imagecache[""] = 0
+    self.dbfiles = {}
+
+    self.ITEMLIMIT = 0 if force else 100
+    self.itemCount = 0
+
+    self.shared = (scheduler is not None)
+    if not self.shared:
+      scheduler = MyCacheScheduler(force, drop_items, qsize=gConfig.CACHE_STREAM_QUEUE if gConfig.CACHE_STREAM_QUEUE > 0 else 0)
+    self.scheduler = scheduler
+
+  def start(self):
+    # Each chunk needs to be matched as soon as it arrives, so load the texture cache up front
+    tStart = time.time()
+    self.dbfiles = loadTextureIndex(self.database)
+    TOTALS.TimeAccumulate(self.mediatype, "Compare", tStart)
+
+    if not self.shared:
+      self.scheduler.start(self.mediatype, gConfig.DOWNLOAD_THREADS.get("download.threads.%s" % self.mediatype, gConfig.DOWNLOAD_THREADS_DEFAULT))
+
+  # Parse, match and queue a chunk of library items
+  def addData(self, data, title_name, id_name):
+    mediaitems = []
+
+    tStart = time.time()
+    parseURLData(self.jcomms, self.mediatype, mediaitems, self.imagecache, data, title_name, id_name)
+    TOTALS.TimeAccumulate(self.mediatype, "Parse", tStart)
+
+    tStart = time.time()
+    dbrows = self.dbfiles.getMany([item.decoded_filename for item in mediaitems])
+    stale = matchTextures_stale(self.jcomms, [item for item, dbrow in zip(mediaitems, dbrows) if dbrow], self.force, False)
+    for item, dbrow in zip(mediaitems, dbrows):
+      matchTextures_item_row(self.mediatype, self.jcomms, item, dbrow, self.force, False, stale)
+    TOTALS.TimeAccumulate(self.mediatype, "Compare", tStart)
+
+    workitems = []
+    for item in mediaitems:
+      if item.status in [MyMediaItem.STATUS_MISSING, MyMediaItem.STATUS_STALE]:
+        self.itemCount += 1
+        cacheImages_showItem(item, self.itemCount, self.ITEMLIMIT)
+        workitems.append(item)
+
+    if self.force and gConfig.DOWNLOAD_PREDELETE:
+      tStart = time.time()
+      TOTALS.init()
+      with self.database:
+        for item in workitems:
+          if item.dbid != 0:
+            cacheImages_predeleteItem(self.database, item)
+      TOTALS.stop()
+      TOTALS.TimeAccumulate(self.mediatype, "PreDelete", tStart)
+
+    for item in workitems:
+      self.scheduler.queue(item)
+
+    if workitems:
+      gLogger.log("Streamed %d of %d %s items for download, %d queued" % (len(workitems), len(mediaitems), self.mediatype, self.itemCount))
+
+  # All library data has been queued - wait for the downloads to complete, unless
+  # the scheduler is shared in which case the owner of the scheduler will wait
+  def finish(self):
+    # Nothing more to match against
+    self.dbfiles = self.imagecache = None
+
+    if not self.shared:
+      if self.itemCount != 0:
+        gLogger.out("\n")
+      self.scheduler.finish()
+
 #
 # Simple container for watched items.
 #
@@ -3921,6 +6437,15 @@ class MyUtility(object):
   RE_STACKING_A_D = re.compile("(.*?)([ _.-]*(?:cd|dvd|p(?:ar)?t|dis[ck])[ _.-]*[a-d])(.*?)(\.[^.]+)$", flags=re.IGNORECASE)
 
   RE_NOT_DIGITS = re.compile("[^0123456789]")
+  RE_NOT_ASCII = re.compile("[^\x00-\x7f]")
+
+  # Decoded forms of recently normalised quoted URLs, keyed by (value, strip, type)
+  # as Python2 str and unicode values compare equal but normalise differently.
+  # Two generations approximate an LRU without needing a lock: when the
+  # current generation fills it becomes the previous one, and entries found
+  # in the previous generation are promoted back into the current one.
+  NORMALISED_SIZE = 4096
+  NORMALISED = [{}, {}]
 
   # Convert quoted filename into consistent UTF-8
   # representation for both Python2 and Python3
@@ -3928,7 +6453,31 @@ class MyUtility(object):
   def normalise(value, strip=False):
     if not value: return value
 
-    v = urllib2.unquote(value)
+    # Without escapes the value is already in its decoded form, so skip unquote
+    if "%" not in value and (MyUtility.isPython3 or (isinstance(value, unicode) and not MyUtility.RE_NOT_ASCII.search(value))):
+      if strip and value.startswith("image://"):
+        return value[8:-1] if value[-1:] == "/" else value[8:]
+      return value
+
+    key = (value, strip, type(value))
+    current, previous = MyUtility.NORMALISED
+    v = current.get(key)
+    if v is None:
+      v = previous.get(key)
+      if v is None:
+        v = MyUtility._normalise(value, strip)
+      if len(current) >= MyUtility.NORMALISED_SIZE:
+        current = {}
+        MyUtility.NORMALISED = [current, MyUtility.NORMALISED[0]]
+      current[key] = v
+    return v
+
+  @staticmethod
+  def _normalise(value, strip):
+    if MyUtility.isPython3:
+      v = urllib2.unquote_to_bytes(value).decode("utf-8", "replace")
+    else:
+      v = urllib2.unquote(value)
 
     if strip:
       s = 8 if v.startswith("image://") else None
@@ -3946,6 +6495,32 @@ class MyUtility(object):
 
     return v
 
+  # Decode a complete chunked transfer-encoded body, or None if incomplete
+  @staticmethod
+  def dechunk(data):
+    body = b""
+    while True:
+      i = data.find(b"\r\n")
+      if i == -1: return None
+      try:
+        size = int(data[:i].split(b";")[0], 16)
+      except ValueError:
+        return body
+      if size == 0: return body
+      if len(data) < i + 2 + size + 2: return None
+      body += data[i + 2:i + 2 + size]
+      data = data[i + 2 + size + 2:]
+
+  # Webserver path used to download filename, equivalent to the path returned by Files.PrepareDownload
+  @staticmethod
+  def getDownloadPath(filename):
+    if filename.startswith("image://") or (filename.startswith("special://") and filename.endswith(".tbn")):
+      handler = "image"
+    else:
+      handler = "vfs"
+
+    return "/%s/%s" % (handler, MyUtility.denormalise(filename, prefix=False))
+
   # Quote unquoted filename
   @staticmethod
   def denormalise(value, prefix=True):
@@ -4232,10 +6807,14 @@ class MyUtility(object):
           gLogger.log("Exception during IMDb processing: reference [%s], key [%s]. msg [%s]" % (reference, key, str(e)))
           gLogger.log("OMDb API Query [%s?%s]" % (base_url, query_url))
       return newdata
+    except urllib2.HTTPError as e:
+      gLogger.log("HTTP error during IMDb processing: reference [%s], status [%d], msg [%s]" % (reference, e.code, str(e)))
+      gLogger.log("OMDb API Query [%s?%s]" % (base_url, query_url))
+      return {"tc.status": e.code, "tc.retryafter": e.headers.get("Retry-After", None) if e.headers else None}
     except Exception as e:
       gLogger.log("Exception during IMDb processing: reference [%s], timeout [%s], msg [%s]" % (reference, qtimeout, str(e)))
       gLogger.log("OMDb API Query [%s?%s]" % (base_url, query_url))
-      return {}
+      return {"tc.status": None}
 
   @staticmethod
   def nonestr(s):
@@ -4245,16 +6824,85 @@ class MyUtility(object):
 
   @staticmethod
   def is_cache_item_stale(config, jcomms, mediaitem):
+    if not MyUtility.is_cache_item_checkable(config, mediaitem): return False
+
+    file = jcomms.getFileDetails(mediaitem.decoded_filename, properties=["file", "lastmodified"])
+    if file and "lastmodified_timestamp" in file:
+      return (file["lastmodified_timestamp"] >= config.cache_refresh_date)
+
+    return False
+
+  @staticmethod
+  def is_cache_item_checkable(config, mediaitem):
     if config.cache_refresh_date is None: return False
     if mediaitem.decoded_filename.startswith("http://"): return False
 
     # Only check file details for the following media types
-    if mediaitem.mtype in ["movies", "tags", "sets", "tvshows", "seasons", "episodes", "albums", "artists", "songs"]:
-      file = jcomms.getFileDetails(mediaitem.decoded_filename, properties=["file", "lastmodified"])
-      if file and "lastmodified_timestamp" in file:
-        return (file["lastmodified_timestamp"] >= config.cache_refresh_date)
+    return mediaitem.mtype in ["movies", "tags", "sets", "tvshows", "seasons", "episodes", "albums", "artists", "songs"]
 
-    return False
+  # Return the set of decoded filenames for those mediaitems that are stale.
+  # Rather than looking up each item in turn, the items are grouped by parent
+  # directory and each directory is listed just once, with the listings
+  # retrieved concurrently by cache.refresh.threads threads (each with its
+  # own connection) and checked by the calling thread as they arrive.
+  @staticmethod
+  def getStaleItems(config, jcomms, mediaitems):
+    stale = set()
+
+    folders = {}
+    for item in mediaitems:
+      if MyUtility.is_cache_item_checkable(config, item):
+        folders.setdefault(os.path.dirname(item.decoded_filename), set()).add(item.decoded_filename)
+
+    if not folders: return stale
+
+    input_queue = Queue.Queue()
+    output_queue = Queue.Queue()
+    for path in folders:
+      input_queue.put(path)
+
+    def lister(jc):
+      while not stopped.is_set():
+        try:
+          path = input_queue.get(block=False)
+        except Queue.Empty:
+          break
+        output_queue.put((path, jc.getDirectoryList(path, mediatype="files", properties=["file", "lastmodified"])))
+        input_queue.task_done()
+
+    # Replayed logs must be read in order, so only use the caller's connection
+    THREADCOUNT = 1 if config.LOG_REPLAY_FILENAME else min(config.CACHE_REFRESH_THREADS, len(folders))
+    gLogger.log("Checking %d directories for stale artwork using %d thread(s)" % (len(folders), THREADCOUNT))
+
+    THREADS = []
+    if THREADCOUNT == 1:
+      lister(jcomms)
+    else:
+      for i in range(THREADCOUNT):
+        t = threading.Thread(target=lister, args=(MyJSONComms(config, gLogger),), name="StaleCheck-%d" % (i + 1))
+        THREADS.append(t)
+        t.setDaemon(True)
+        t.start()
+
+    done = 0
+    while done < len(folders):
+      try:
+        (path, data) = output_queue.get(timeout=1.0)
+      except Queue.Empty:
+        if [t for t in THREADS if t.is_alive()] == []: break
+        continue
+
+      done += 1
+      gLogger.progress("Checking for stale artwork: directory %d of %d..." % (done, len(folders)), every=25, finalItem=(done == len(folders)))
+
+      filenames = folders[path]
+      for file in data.get("result", {}).get("files", []):
+        if file["filetype"] == "file" and file.get("file", None) in filenames:
+          jcomms.setTimeStamp(file)
+          if file.get("lastmodified_timestamp", 0) >= config.cache_refresh_date:
+            stale.add(file["file"])
+
+    return stale
 
   @staticmethod
   def invalidateDirectoryCache(mediatype):
@@ -4436,7 +7084,7 @@ class MyUtility(object):
 #
 def jsonQuery(action, mediatype, filter="", force=False, extraFields=False, rescan=False, \
                       decode=False, ensure_ascii=True, nodownload=False, lastRun=False, \
-                      labels=None, query="", filename=None, wlBackup=True, drop_items=None):
+                      labels=None, query="", filename=None, wlBackup=True, drop_items=None, scheduler=None):
   if mediatype not in ["addons", "agenres", "vgenres", "albums", "artists", "songs", "musicvideos",
                        "movies", "sets", "tags", "tvshows", "pvr.tv", "pvr.radio"]:
     gLogger.err("ERROR: %s is not a valid media class" % mediatype, newLine=True)
@@ -4480,13 +7128,40 @@ def jsonQuery(action, mediatype, filter="", force=False, extraFields=False, resc
   # duplicates that can be discarded.
   UCAST = {}
 
+  # When a library snapshot from a previous run is available, lc/lnc will load only
+  # those items that are new or have changed since the snapshot, instead of those
+  # items added since the lastrunfile timestamp.
+  signatures = delta = None
+  if lastRun and action == "cache" and gConfig.LASTRUN_SNAPSHOT and filter == "" and \
+     mediatype in ["albums", "artists", "movies", "sets", "tvshows", "musicvideos"]:
+    gLogger.progress("Loading %s signatures..." % mediatype.capitalize())
+    signatures = jcomms.getLibrarySignatures(mediatype)
+    previous = loadLibrarySnapshot(mediatype)
+    if previous is not None:
+      delta = {}
+      for id in signatures:
+        if previous.get(id, None) != signatures[id]: delta[id] = True
+      removed = len([id for id in previous if id not in signatures])
+      gLogger.log("Library snapshot for %s: %d items, %d new or changed, %d removed" % (mediatype, len(signatures), len(delta), removed))
+    gLogger.progress("Loading %s..." % mediatype.capitalize())
+
+  loadLastRun = lastRun and delta is None
+
+  # When streaming, artwork is parsed, matched and queued for download as each
+  # chunk of library data is loaded, rather than once the entire library has been loaded
+  stream = None
+  if action == "cache" and gConfig.CACHE_STREAM and not nodownload and not lastRun and \
+     mediatype in ["albums", "artists", "songs", "musicvideos", "movies", "tags", "tvshows"]:
+    stream = MyCacheStream(mediatype, jcomms, database, force, drop_items, scheduler)
+    stream.start()
+
   if mediatype in ["pvr.tv", "pvr.radio"] and not gConfig.HAS_PVR:
     (section_name, title_name, id_name, data) = ("", "", "", [])
   elif mediatype == "vgenres":
     _data = []
     for subtype in ["movie", "tvshow", "musicvideo"]:
       (section_name, title_name, id_name, data) = jcomms.getData(action, mediatype, filter, extraFields,
-                                                                 lastRun=lastRun, secondaryFields=secondaryFields,
+                                                                 lastRun=loadLastRun, secondaryFields=secondaryFields,
                                                                  subType=subtype)
       filter_name = gConfig.FILTER_FIELD if gConfig.FILTER_FIELD else title_name
       if data and "result" in data and section_name in data["result"]:
@@ -4501,9 +7176,13 @@ def jsonQuery(action, mediatype, filter="", force=False, extraFields=False, resc
     title_name = "type"
     section_name = mediatype
     data["result"] = {section_name: _data}
+  elif delta is not None:
+    (section_name, title_name, id_name, data) = jcomms.getDataDelta(action, mediatype, delta, extraFields,
+                                                                    secondaryFields=secondaryFields, uniquecast=UCAST)
   else:
     (section_name, title_name, id_name, data) = jcomms.getData(action, mediatype, filter, extraFields,
-                                                               lastRun=lastRun, secondaryFields=secondaryFields, uniquecast=UCAST)
+                                                               lastRun=loadLastRun, secondaryFields=secondaryFields, uniquecast=UCAST,
+                                                               callback=stream.addData if stream and mediatype != "tvshows" else None)
 
   if data and "result" in data and section_name in data["result"]:
     data = data["result"][section_name]
@@ -4524,7 +7203,7 @@ def jsonQuery(action, mediatype, filter="", force=False, extraFields=False, resc
   if action == "dump" and data:
     if mediatype == "sets" and gConfig.ADD_SET_MEMBERS:
       gLogger.progress("Loading Sets members...")
-      (s, t, i, fdata) = jcomms.getData(action, "sets-members", filter, extraFields, lastRun=lastRun, secondaryFields=None)
+      (s, t, i, fdata) = jcomms.getData(action, "sets-members", filter, extraFields, lastRun=loadLastRun, secondaryFields=None)
       if fdata and "result" in fdata and s in fdata["result"]:
         set_files = {}
         for movie in fdata["result"][s]:
@@ -4539,7 +7218,7 @@ def jsonQuery(action, mediatype, filter="", force=False, extraFields=False, resc
 
     if mediatype == "albums" and gConfig.ADD_SONG_MEMBERS:
       gLogger.progress("Loading Song members...")
-      (s, t, i, fdata) = jcomms.getData(action, "song-members", filter, extraFields, lastRun=lastRun, secondaryFields=None)
+      (s, t, i, fdata) = jcomms.getData(action, "song-members", filter, extraFields, lastRun=loadLastRun, secondaryFields=None)
       if fdata and "result" in fdata and s in fdata["result"]:
         album_files = {}
         for album in fdata["result"][s]:
@@ -4556,7 +7235,7 @@ def jsonQuery(action, mediatype, filter="", force=False, extraFields=False, resc
   if mediatype in ["pvr.tv", "pvr.radio"]:
     pvrdata = []
     for cg in data:
-      (s1, t1, i1, data1) = jcomms.getData(action, "%s.channel" % mediatype, filter, extraFields, channelgroupid=cg["channelgroupid"], lastRun=lastRun, secondaryFields=secondaryFields)
+      (s1, t1, i1, data1) = jcomms.getData(action, "%s.channel" % mediatype, filter, extraFields, channelgroupid=cg["channelgroupid"], lastRun=loadLastRun, secondaryFields=secondaryFields)
       if "result" in data1:
         channels = []
         for channel in data1["result"].get(s1, []):
@@ -4573,10 +7252,14 @@ def jsonQuery(action, mediatype, filter="", force=False, extraFields=False, resc
       title = tvshow["title"]
       gLogger.progress("Loading TV show: %s..." % title)
 
-      (s2, t2, i2, data2) = jcomms.getData(action, "seasons", filter, extraFields, tvshow=tvshow, lastRun=lastRun, uniquecast=UCAST)
-      if not "result" in data2: return
+      (s2, t2, i2, data2) = jcomms.getData(action, "seasons", filter, extraFields, tvshow=tvshow, lastRun=loadLastRun, uniquecast=UCAST)
+      if not "result" in data2:
+        if stream: stream.finish()
+        return
       limits = data2["result"]["limits"]
-      if limits["total"] == 0: continue
+      if limits["total"] == 0:
+        if stream: stream.addData([tvshow], title_name, id_name)
+        continue
       tvshow[s2] = data2["result"][s2]
       for season in tvshow[s2]:
         seasonid = season["season"]
@@ -4588,15 +7271,28 @@ def jsonQuery(action, mediatype, filter="", force=False, extraFields=False, resc
 
         if gConfig.QUERY_EPISODES:
           (s3, t3, i3, data3) = jcomms.getData(action, "episodes", filter, extraFields, tvshow=tvshow, tvseason=season,
-                                               lastRun=lastRun, secondaryFields=secondaryFields, uniquecast=UCAST)
-          if not "result" in data3: return
+                                               lastRun=loadLastRun, secondaryFields=secondaryFields, uniquecast=UCAST)
+          if not "result" in data3:
+            if stream: stream.finish()
+            return
           limits = data3["result"]["limits"]
           if limits["total"] == 0: continue
           season[s3] = data3["result"][s3]
 
+      # Queue this TV show now that all of its seasons and episodes have been
+      # loaded, then discard the seasons and episodes as they're no longer needed
+      if stream:
+        stream.addData([tvshow], title_name, id_name)
+        del tvshow[s2]
+
   del UCAST
 
-  if lastRun and mediatype in ["movies", "tvshows"]:
+  if delta is not None:
+    for item in data:
+      gLogger.out("Recently added or changed %s: %s" % (mediatype[:-1], item.get(title_name, None)), newLine=True)
+
+    if len(data) != 0: gLogger.out("", newLine=True)
+  elif lastRun and mediatype in ["movies", "tvshows"]:
     # Create a new list containing only tvshows with episodes...
     if mediatype == "tvshows":
       newData = []
@@ -4623,9 +7319,14 @@ def jsonQuery(action, mediatype, filter="", force=False, extraFields=False, resc
 
   TOTALS.TimeEnd(mediatype, "Load")
 
-  if data != []:
+  if stream:
+    # TV shows are only streamed when loading seasons
+    if mediatype == "tvshows" and not gConfig.QUERY_SEASONS:
+      stream.addData(data, title_name, id_name)
+    stream.finish()
+  elif data != []:
     if action == "cache":
-      cacheImages(mediatype, jcomms, database, data, title_name, id_name, force, nodownload, drop_items)
+      cacheImages(mediatype, jcomms, database, data, title_name, id_name, force, nodownload, drop_items, scheduler)
     elif action == "qa":
       qaData(mediatype, jcomms, database, data, title_name, id_name, rescan)
     elif action == "dump":
@@ -4646,6 +7347,10 @@ def jsonQuery(action, mediatype, filter="", force=False, extraFields=False, resc
     else:
       raise ValueError("Unknown action [%s]" % action)
 
+  # Don't update the snapshot during a dry-run
+  if signatures is not None and not nodownload:
+    saveLibrarySnapshot(mediatype, signatures)
+
   # Free memory used to cache any GetDirectory() information
   MyUtility.invalidateDirectoryCache(mediatype)
 
@@ -4653,6 +7358,141 @@ def jsonQuery(action, mediatype, filter="", force=False, extraFields=False, resc
 
   TOTALS.TimeEnd(mediatype, "Total")
 
+#
+# Cache several media classes, loading up to cache.concurrent media classes at
+# a time. Artwork from all media classes is downloaded by a single shared
+# scheduler, limited to download.threads threads, which is monitored once all
+# media classes have been loaded and queued.
+#
+# Loader threads are named "Main..." so that any pre-deletion performed by
+# these threads is accounted for in the same way as the main thread.
+#
+def jsonQueryConcurrent(multi, filter="", force=False, lastRun=False, nodownload=False, drop_items=None):
+  TOTALS.TimeStart("concurrent", "Total")
+
+  scheduler = None
+  if not nodownload:
+    qsize = gConfig.CACHE_STREAM_QUEUE if gConfig.CACHE_STREAM and gConfig.CACHE_STREAM_QUEUE > 0 else 0
+    scheduler = MyCacheScheduler(force, drop_items, qsize=qsize)
+    scheduler.start("concurrent", gConfig.DOWNLOAD_THREADS_DEFAULT)
+
+  media_queue = Queue.Queue()
+  for mediatype in multi:
+    media_queue.put(mediatype)
+
+  def loader():
+    while not stopped.is_set():
+      try:
+        mediatype = media_queue.get(block=False)
+      except Queue.Empty:
+        break
+      gLogger.log("Concurrent loading of %s by %s" % (mediatype, threading.current_thread().name))
+      jsonQuery("cache", mediatype, filter=filter, force=force, lastRun=lastRun,
+                nodownload=nodownload, drop_items=drop_items, scheduler=scheduler)
+      media_queue.task_done()
+
+  THREADCOUNT = gConfig.CACHE_CONCURRENT if gConfig.CACHE_CONCURRENT < len(multi) else len(multi)
+  gLogger.log("Creating %d loader thread(s) for %d media classes" % (THREADCOUNT, len(multi)))
+
+  THREADS = []
+  for i in range(THREADCOUNT):
+    t = threading.Thread(target=loader, name="MainLoader-%d" % (i + 1))
+    THREADS.append(t)
+    t.setDaemon(True)
+    t.start()
+
+  # Join with a timeout so that the main thread remains responsive to interrupts
+  for t in THREADS:
+    while t.is_alive():
+      t.join(1.0)
+
+  if scheduler:
+    if scheduler.itemCount != 0:
+      gLogger.out("\n")
+    scheduler.finish()
+
+  TOTALS.TimeEnd("concurrent", "Total")
+
+#
+# Resume an interrupted c/C run, downloading only those items in the
+# journal that were not processed by the interrupted run.
+#
+def resumeCache(multi, force, drop_items):
+  for mediatype in multi:
+    TOTALS.TimeStart(mediatype, "Total")
+    TOTALS.TimeStart(mediatype, "Load")
+    workitems = JOURNAL.getUnfinished(mediatype)
+    TOTALS.TimeEnd(mediatype, "Load")
+
+    gLogger.out("Resuming %s: %d items remaining in journal [%s]\n" % (mediatype, len(workitems), JOURNAL.filename))
+    if workitems == []:
+      TOTALS.TimeEnd(mediatype, "Total")
+      continue
+
+    scheduler = MyCacheScheduler(force, drop_items)
+    for c, item in enumerate(workitems):
+      scheduler.queue(item)
+      gLogger.progress("Queueing work item: %d of %d" % (c + 1, len(workitems)), every=50, finalItem=(c + 1 == len(workitems)))
+
+    itemCount = len(workitems)
+    del workitems
+
+    tCount = gConfig.DOWNLOAD_THREADS.get("download.threads.%s" % mediatype, gConfig.DOWNLOAD_THREADS_DEFAULT)
+    scheduler.start(mediatype, tCount if tCount <= itemCount else itemCount)
+    scheduler.finish()
+
+    TOTALS.TimeEnd(mediatype, "Total")
+
+#
+# Rank of a library item when downloading by priority (cache.priority): items
+# played recently (or in a recently played movie set) rank above all others,
+# then by date added, most recent first.
+#
+def getPriorityRank(item, playedSets=None):
+  played = (item.get("lastplayed", "") >= gConfig.CACHE_PRIORITY_PLAYED)
+  if not played and playedSets:
+    played = (item.get("setid", 0) in playedSets)
+
+  digits = re.sub("[^0-9]", "", item.get("dateadded", "") or "")[:14]
+
+  return (10**14 if played else 0) + (int(digits) if digits else 0)
+
+#
+# Per-mediatype library snapshots, mapping library item id to item signature, as
+# used by lc/lnc to identify new or changed library items.
+#
+def loadLibrarySnapshot(mediatype):
+  if not os.path.exists(gConfig.LASTRUN_SNAPSHOT): return None
+
+  try:
+    with codecs.open(gConfig.LASTRUN_SNAPSHOT, "rb", encoding="utf-8") as infile:
+      return json.load(infile).get(mediatype, None)
+  except (IOError, ValueError) as e:
+    gLogger.log("Unable to read library snapshot [%s]: %s" % (gConfig.LASTRUN_SNAPSHOT, e))
+    return None
+
+def saveLibrarySnapshot(mediatype, signatures):
+  with lock:
+    snapshot = {}
+    if os.path.exists(gConfig.LASTRUN_SNAPSHOT):
+      try:
+        with codecs.open(gConfig.LASTRUN_SNAPSHOT, "rb", encoding="utf-8") as infile:
+          snapshot = json.load(infile)
+      except (IOError, ValueError):
+        pass
+
+    snapshot[mediatype] = signatures
+
+    # Replace the snapshot only once the new snapshot has been written in full
+    tmpfile = "%s.tmp" % gConfig.LASTRUN_SNAPSHOT
+    outfile = codecs.open(tmpfile, "wb", encoding="utf-8")
+    outfile.write(json.dumps(snapshot, sort_keys=True))
+    outfile.close()
+    if os.path.exists(gConfig.LASTRUN_SNAPSHOT): os.remove(gConfig.LASTRUN_SNAPSHOT)
+    os.rename(tmpfile, gConfig.LASTRUN_SNAPSHOT)
+
+    gLogger.log("Saved library snapshot for %s with %d items" % (mediatype, len(signatures)))
+
 #
 # Parse the supplied JSON data, turning it into a list of artwork urls
 # (mediaitems) that should be matched against the database (cached files)
@@ -4663,7 +7503,7 @@ def jsonQuery(action, mediatype, filter="", force=False, extraFields=False, resc
 # 1..n threads. Errors will be added to an error queue by the threads, and
 # subsueqently displayed to the user at the end.
 #
-def cacheImages(mediatype, jcomms, database, data, title_name, id_name, force, nodownload, drop_items):
+def cacheImages(mediatype, jcomms, database, data, title_name, id_name, force, nodownload, drop_items, scheduler=None):
 
   mediaitems = []
   imagecache = {}
@@ -4695,12 +7535,7 @@ def cacheImages(mediatype, jcomms, database, data, title_name, id_name, force, n
   for item in mediaitems:
     if item.status in [MyMediaItem.STATUS_MISSING, MyMediaItem.STATUS_STALE]:
       itemCount += 1
-      if ITEMLIMIT == -1 or itemCount < ITEMLIMIT:
-        reason = "Need to cache" if item.status == MyMediaItem.STATUS_MISSING else "Cache stale  "
-        MSG = "%s: [%-10s] for %s: %s\n" % (reason, item.itype.center(10), re.sub("(.*)s$", "\\1", item.mtype), item.getFullName())
-        gLogger.out(MSG)
-      elif itemCount == ITEMLIMIT:
-        gLogger.out("...and many more! (First %d items shown)\n" % ITEMLIMIT)
+      cacheImages_showItem(item, itemCount, ITEMLIMIT)
 
   if nodownload:
     TOTALS.addNotCached()
@@ -4711,107 +7546,87 @@ def cacheImages(mediatype, jcomms, database, data, title_name, id_name, force, n
   # Don't proceed beyond this point unless there is something to download...
   if itemCount == 0 or nodownload: return
 
-  # Queue up the items to be downloaded...
-  single_work_queue = Queue.Queue()
-  multiple_work_queue = Queue.Queue()
-  error_queue = Queue.Queue()
-  complete_queue = Queue.Queue()
-
   gLogger.out("\n")
 
-  # Identify unique itypes, so we can group items in the queue
+  # Group items by itype in the queue.
   # This is crucial to working out when the first/last item is loaded
-  # in order to calculate accurate elapsed times by itype
-  unique_items = {}
-  for item in mediaitems:
-    if not item.itype in unique_items:
-      unique_items[item.itype] = True
+  # in order to calculate accurate elapsed times by itype.
+  # When downloading by priority, queue the most important items first.
+  if gConfig.CACHE_PRIORITY:
+    sortkey = lambda item: item.getPriority(gConfig.CACHE_PRIORITY)
+  else:
+    sortkey = lambda item: item.itype
+  workitems = sorted([item for item in mediaitems if item.status in [MyMediaItem.STATUS_MISSING, MyMediaItem.STATUS_STALE]],
+                     key=sortkey)
+
+  # Don't need this data anymore, make it available for garbage collection
+  del mediaitems
 
   if force and gConfig.DOWNLOAD_PREDELETE:
     TOTALS.TimeStart(mediatype, "PreDelete")
     TOTALS.init()
     dbitems = 0
-    for item in mediaitems:
+    for item in workitems:
       if item.dbid != 0:
         dbitems += 1
     dbitem = 0
     with database:
-      for ui in sorted(unique_items):
-        for item in mediaitems:
-          if item.dbid != 0 and item.itype == ui:
-            dbitem += 1
-            gLogger.progress("Pre-deleting cached items %d of %d... rowid %d, cachedurl %s" % (dbitem, dbitems, item.dbid, item.cachedurl))
-            TOTALS.start(item.mtype, item.itype)
-            database.deleteItem(item.dbid, item.cachedurl)
-            TOTALS.bump("Deleted", item.itype)
-            TOTALS.finish(item.mtype, item.itype)
-            item.dbid = 0
-            item.cachedurl = ""
+      for item in workitems:
+        if item.dbid != 0:
+          dbitem += 1
+          gLogger.progress("Pre-deleting cached items %d of %d... rowid %d, cachedurl %s" % (dbitem, dbitems, item.dbid, item.cachedurl))
+          cacheImages_predeleteItem(database, item)
     TOTALS.stop()
     TOTALS.TimeEnd(mediatype, "PreDelete")
     gLogger.progress("")
 
-  c = sc = mc = 0
-  for ui in sorted(unique_items):
-    for item in mediaitems:
-      if item.status in [MyMediaItem.STATUS_MISSING, MyMediaItem.STATUS_STALE] and item.itype == ui:
-        c += 1
-
-        isSingle = False
-        if gConfig.SINGLETHREAD_URLS:
-          for site in gConfig.SINGLETHREAD_URLS:
-            if site.search(item.decoded_filename):
-              sc += 1
-              if gLogger.VERBOSE and gLogger.LOGGING: gLogger.log("QUEUE ITEM: single [%s], %s" % (site.pattern, item))
-              single_work_queue.put(item)
-              item.status = MyMediaItem.STATUS_QUEUED
-              isSingle = True
-              break
-
-        if not isSingle:
-          mc += 1
-          if gLogger.VERBOSE and gLogger.LOGGING: gLogger.log("QUEUE ITEM: %s" % item)
-          multiple_work_queue.put(item)
-          item.status = MyMediaItem.STATUS_QUEUED
-
-        gLogger.progress("Queueing work item: single thread %d, multi thread %d" % (sc, mc), every=50, finalItem=(c==itemCount))
-
-  # Don't need this data anymore, make it available for garbage collection
-  del mediaitems
-
-  TOTALS.TimeStart(mediatype, "Download")
-
-  THREADS = []
-
-  if not single_work_queue.empty():
-    gLogger.log("Creating 1 download thread for single access sites")
-    t = MyImageLoader(single_work_queue, multiple_work_queue, error_queue, complete_queue,
-                      gConfig, gLogger, TOTALS, force, gConfig.DOWNLOAD_RETRY)
-    THREADS.append(t)
-    t.setDaemon(True)
-
-  if not multiple_work_queue.empty():
-    tCount = gConfig.DOWNLOAD_THREADS["download.threads.%s" % mediatype]
-    THREADCOUNT = tCount if tCount <= mc else mc
-    gLogger.log("Creating %d download thread(s) for multi-access sites" % THREADCOUNT)
-    for i in range(THREADCOUNT):
-      t = MyImageLoader(multiple_work_queue, single_work_queue, error_queue, complete_queue,
-                        gConfig, gLogger, TOTALS, force, gConfig.DOWNLOAD_RETRY)
-      THREADS.append(t)
-      t.setDaemon(True)
-
-  # Start the threads...
-  for t in THREADS: t.start()
-
-  threadcount = len(THREADS)
-
+  # Queue up the items to be downloaded...
+  shared = (scheduler is not None)
+  if not shared:
+    scheduler = MyCacheScheduler(force, drop_items)
+
+  for c, item in enumerate(workitems):
+    scheduler.queue(item)
+    gLogger.progress("Queueing work item: %d of %d" % (c + 1, itemCount), every=50, finalItem=(c + 1 == itemCount))
+
+  del workitems
+
+  # Downloads will be monitored by the owner of the shared scheduler
+  if shared: return
+
+  tCount = gConfig.DOWNLOAD_THREADS.get("download.threads.%s" % mediatype, gConfig.DOWNLOAD_THREADS_DEFAULT)
+  scheduler.start(mediatype, tCount if tCount <= itemCount else itemCount)
+  scheduler.finish()
+
+# Output details of an item that is stale or missing from the cache, limited
+# to the first ITEMLIMIT items (unlimited when -1, nothing when 0)
+def cacheImages_showItem(item, itemCount, ITEMLIMIT):
+  if ITEMLIMIT == -1 or itemCount < ITEMLIMIT:
+    reason = "Need to cache" if item.status == MyMediaItem.STATUS_MISSING else "Cache stale  "
+    MSG = "%s: [%-10s] for %s: %s\n" % (reason, item.itype.center(10), re.sub("(.*)s$", "\\1", item.mtype), item.getFullName())
+    gLogger.out(MSG)
+  elif itemCount == ITEMLIMIT:
+    gLogger.out("...and many more! (First %d items shown)\n" % ITEMLIMIT)
+
+def cacheImages_predeleteItem(database, item):
+  TOTALS.start(item.mtype, item.itype)
+  database.deleteItem(item.dbid, item.cachedurl)
+  TOTALS.bump("Deleted", item.itype)
+  TOTALS.finish(item.mtype, item.itype)
+  item.dbid = 0
+  item.cachedurl = ""
+
+# Monitor download threads until all have finished.
+def cacheImages_monitor(mediatype, threadcount, itemCount, work_queue,
+                        error_queue, complete_queue, itemsRemaining=None, completed=None):
   updateInterval = 1.0
-  itemsRemaining = itemCount
+  if itemsRemaining is None: itemsRemaining = itemCount
   perfhistory = []
-  showProgress(threadcount, itemCount, single_work_queue.qsize(), multiple_work_queue.qsize(), error_queue.qsize(), itemsRemaining)
+  if itemCount != 0:
+    showProgress(threadcount, itemCount, work_queue.qsize(), work_queue.hostcount(), error_queue.qsize(), itemsRemaining)
   while threadcount > 0:
     pace = time.time()
-    completed = 0
+    ncompleted = 0
     while True:
       try:
         qItem = complete_queue.get(block=True, timeout=updateInterval)
@@ -4819,19 +7634,27 @@ def cacheImages(mediatype, jcomms, database, data, title_name, id_name, force, n
         if qItem is None:
           threadcount -= 1
         else:
-          completed += 1
+          if completed: completed(qItem)
+          ncompleted += 1
           itemsRemaining -= 1
         if (time.time() - pace) >= updateInterval or threadcount <= 0:
           break
       except Queue.Empty:
         break
-    showProgress(threadcount, itemCount, single_work_queue.qsize(), multiple_work_queue.qsize(), error_queue.qsize(),
-                  itemsRemaining, completed, time.time() - pace, perfhistory)
+    if itemCount != 0:
+      showProgress(threadcount, itemCount, work_queue.qsize(), work_queue.hostcount(), error_queue.qsize(),
+                    itemsRemaining, ncompleted, time.time() - pace, perfhistory)
 
   TOTALS.TimeEnd(mediatype, "Download")
 
-  gLogger.progress("", newLine=True, noBlank=True)
+  work_queue.logStats(gLogger)
+  work_queue.addThroughput(TOTALS)
 
+  if itemCount != 0:
+    gLogger.progress("", newLine=True, noBlank=True)
+
+# Output details of those items that could not be downloaded
+def cacheImages_errors(error_queue, drop_items):
   if not error_queue.empty():
     gLogger.out("\nThe following items could not be downloaded:\n\n")
     while not error_queue.empty():
@@ -4859,7 +7682,7 @@ def dump_drop_items(drop_items):
     outfile.write(json.dumps(drop_items.values(), indent=2, ensure_ascii=True, sort_keys=True))
     outfile.close()
 
-def showProgress(tRunning, maxItems, swqs, mwqs, ewqs, remaining=0, completed=0, interval=0.0, history=None):
+def showProgress(tRunning, maxItems, qsize, hosts, ewqs, remaining=0, completed=0, interval=0.0, history=None):
   c = 0
   i = 0.0
 
@@ -4894,9 +7717,9 @@ def showProgress(tRunning, maxItems, swqs, mwqs, ewqs, remaining=0, completed=0,
 
   msg = " (%05.2f downloads per second, ETA: %s)" % (itpersec, eta)
 
-  gLogger.progress("Caching artwork: %d item%s remaining of %d (qs: %d, qm: %d), %d error%s, %d thread%s active%s" % \
+  gLogger.progress("Caching artwork: %d item%s remaining of %d (queued: %d, hosts: %d), %d error%s, %d thread%s active%s" % \
                     (remaining, "s"[remaining==1:],
-                     maxItems, swqs, mwqs,
+                     maxItems, qsize, hosts,
                      ewqs, "s"[ewqs==1:],
                      tRunning, "s"[tRunning==1:],
                      msg))
@@ -4905,7 +7728,9 @@ def matchTextures(mediatype, mediaitems, jcomms, database, force, nodownload):
 
   TOTALS.TimeStart(mediatype, "Compare")
 
-  if gConfig.CHUNKED:
+  if matchTextures_targeted(mediaitems, database):
+    matchTextures_fast(mediatype, mediaitems, jcomms, database, force, nodownload, targeted=True)
+  elif gConfig.CHUNKED:
     matchTextures_chunked(mediatype, mediaitems, jcomms, database, force, nodownload)
   else:
     matchTextures_fast(mediatype, mediaitems, jcomms, database, force, nodownload)
@@ -4914,23 +7739,49 @@ def matchTextures(mediatype, mediaitems, jcomms, database, force, nodownload):
 
   return
 
-def matchTextures_fast(mediatype, mediaitems, jcomms, database, force, nodownload):
-  gLogger.progress("Loading Textures DB...")
+# Decide whether to query the texture cache for just the urls of the library
+# items (eg. a filtered or lc run) rather than loading every row. With SQLite
+# the texture cache is counted and urls are queried while there are fewer than
+# a quarter as many urls as rows; with JSON the row count is not available
+# without loading every row, so up to 1000 urls are queried.
+def matchTextures_targeted(mediaitems, database):
+  SQL_RATIO = 4
+  JSON_MAX = 1000
+
+  if gConfig.CACHE_LOOKUP == "all" or mediaitems == []: return False
+  if gConfig.CACHE_LOOKUP == "targeted": return True
+
+  if database.usejson:
+    targeted = (len(mediaitems) <= JSON_MAX)
+    gLogger.log("Texture cache lookup: %d library urls, %s" % (len(mediaitems), "targeted" if targeted else "loading all rows"))
+  else:
+    with database:
+      rowcount = database.getRowCount()
+    targeted = (len(mediaitems) * SQL_RATIO < rowcount)
+    gLogger.log("Texture cache lookup: %d library urls, %d texture rows, %s" %
+                (len(mediaitems), rowcount, "targeted" if targeted else "loading all rows"))
 
-  dbfiles = {}
-  with database:
-    for r in database.getRows(allfields=False):
-      dbfiles[r["url"]] = r
+  return targeted
 
-  gLogger.log("Loaded %d items from texture cache database" % len(dbfiles))
+def matchTextures_fast(mediatype, mediaitems, jcomms, database, force, nodownload, targeted=False):
+  if targeted:
+    dbfiles = loadTextureIndex(database, urls=[item.decoded_filename for item in mediaitems])
+  else:
+    dbfiles = loadTextureIndex(database)
 
   gLogger.progress("Matching library and texture items...")
 
-  itemCount = 0
+  # Rows of a hashed index are retrieved when matched, so match a batch of items at a time
+  BATCH = dbfiles.batch if dbfiles.isHashed() else len(mediaitems)
 
-  for item in mediaitems:
-    dbrow = dbfiles.get(item.decoded_filename, None)
-    matchTextures_item_row(mediatype, jcomms, item, dbrow, force, nodownload)
+  for i in range(0, len(mediaitems), BATCH or 1):
+    items = mediaitems[i:i + BATCH]
+    dbrows = dbfiles.getMany([item.decoded_filename for item in items])
+
+    stale = matchTextures_stale(jcomms, [item for item, dbrow in zip(items, dbrows) if dbrow], force, nodownload)
+
+    for item, dbrow in zip(items, dbrows):
+      matchTextures_item_row(mediatype, jcomms, item, dbrow, force, nodownload, stale)
 
   # Don't need this data anymore, make it available for garbage collection
   del dbfiles
@@ -4939,6 +7790,49 @@ def matchTextures_fast(mediatype, mediaitems, jcomms, database, force, nodownloa
 
   return
 
+# Determine in one pass which of the matched items are stale, when this
+# will be needed (ie. forced or nodownload with cache.refresh)
+def matchTextures_stale(jcomms, items, force, nodownload):
+  if gConfig.cache_refresh_date is None or not (force or nodownload): return None
+  return MyUtility.getStaleItems(gConfig, jcomms, items)
+
+# Load all texture cache rows, or only those rows for the specified urls, keyed by decoded url
+def loadTextureIndex(database, urls=None):
+  gLogger.progress("Loading Textures DB...")
+
+  dbfiles = MyHashIndex(fetch=lambda ids: loadTextureRows(database, ids, lambda r: r["url"]),
+                        hashed=gConfig.INDEX_HASHED, logger=gLogger)
+
+  def addRows(rows):
+    dbfiles.add([r["url"] for r in rows], rows, [r["textureid"] for r in rows])
+
+  with database:
+    if urls is not None:
+      BATCH = 100
+      urls = sorted(set(urls))
+      for i in range(0, len(urls), BATCH):
+        gLogger.progress("Loading Textures DB: %d of %d urls..." % (min(i + BATCH, len(urls)), len(urls)))
+        addRows(database.getRowsByURLs(urls[i:i + BATCH]))
+    elif dbfiles.isHashed():
+      # Only the hashes are retained, so load one folder at a time rather than every row at once
+      folders = database.getTextureFolders()
+      for fnum, folder in enumerate(folders):
+        gLogger.progress("Loading Textures DB: chunk %2d of %d..." % (fnum+1, len(folders)))
+        addRows(database.getRows(database.getTextureFolderFilter(folder), allfields=False))
+    else:
+      addRows(database.getRows(allfields=False))
+
+  dbfiles.finish()
+
+  gLogger.log("Loaded %d items from texture cache database" % len(dbfiles))
+
+  return dbfiles
+
+# Texture cache rows for the specified ids, as id: (key, row), used to confirm hashed index hits
+def loadTextureRows(database, ids, keyFunction):
+  with database:
+    return dict([(r["textureid"], (keyFunction(r), r)) for r in database.getRowsByIDs(ids)])
+
 def matchTextures_chunked(mediatype, mediaitems, jcomms, database, force, nodownload):
   ITEMLIMIT = -1 if nodownload else 100
 
@@ -4948,9 +7842,9 @@ def matchTextures_chunked(mediatype, mediaitems, jcomms, database, force, nodown
 
   # Build a URL based hash of indexes so that we can quickly access mediaitems
   # by index for a given URL
-  url_to_index = {}
-  for inum, item in enumerate(mediaitems):
-    url_to_index[item.decoded_filename] = inum
+  url_to_index = MyHashIndex([item.decoded_filename for item in mediaitems], list(range(len(mediaitems))),
+                             fetch=lambda ids: dict([(i, (mediaitems[i].decoded_filename, i)) for i in ids]),
+                             hashed=gConfig.INDEX_HASHED, logger=gLogger)
 
   dbindex = 0
   dbmax = 0
@@ -4969,25 +7863,33 @@ def matchTextures_chunked(mediatype, mediaitems, jcomms, database, force, nodown
       for r in database.getRows(database.getTextureFolderFilter(folder), allfields=False):
         dbfiles.append(r)
 
+      inums = url_to_index.getMany([dbrow["url"] for dbrow in dbfiles])
+
+      # Pair each unmatched item with its row, so that stale items can be identified in one pass
+      matches = []
+      matched_inums = set()
+      for dbrow, inum in zip(dbfiles, inums):
+        if inum is not None and inum not in matched_inums and mediaitems[inum].status == MyMediaItem.STATUS_UNKNOWN:
+          matched_inums.add(inum)
+          matches.append((mediaitems[inum], dbrow))
+
+      stale = matchTextures_stale(jcomms, [item for item, dbrow in matches], force, nodownload)
+
       dbindex = 0
-      dbmax = len(dbfiles)
+      dbmax = len(matches)
 
-      for dbrow in dbfiles:
+      for item, dbrow in matches:
         dbindex += 1
 
         gLogger.progress("Loading Textures DB: chunk %2d of %d [unmatched %d: matched %d, skipped %d] (%d of %d)" %
           (fnum+1, len(folders), unmatched, matched, skipped, dbindex, dbmax), every=50, finalItem=(dbindex==dbmax))
 
-        inum = url_to_index.get(dbrow["url"], None)
-        if inum is not None:
-          item = mediaitems[inum]
-          if item.status == MyMediaItem.STATUS_UNKNOWN:
-            unmatched -= 1
-            matchTextures_item_row(mediatype, jcomms, item, dbrow, force, nodownload)
-            if item.status == MyMediaItem.STATUS_IGNORE:
-              skipped += 1
-            else:
-              matched += 1
+        unmatched -= 1
+        matchTextures_item_row(mediatype, jcomms, item, dbrow, force, nodownload, stale)
+        if item.status == MyMediaItem.STATUS_IGNORE:
+          skipped += 1
+        else:
+          matched += 1
 
   # Any media library items that haven't been matched must also be processed
   for item in mediaitems:
@@ -4998,16 +7900,27 @@ def matchTextures_chunked(mediatype, mediaitems, jcomms, database, force, nodown
 
   return
 
-def matchTextures_item_row(mediatype, jcomms, item, dbrow, force, nodownload):
+def matchTextures_item_row(mediatype, jcomms, item, dbrow, force, nodownload, stale=None):
   if item.mtype == "tvshows" and item.season == "Season All": TOTALS.bump("Season-all", item.itype)
 
   # Don't need to cache file if it's already in the cache, unless forced...
   # Assign the texture cache database id and cachedurl so that removal will avoid having
   # to retrieve these items from the database.
   if dbrow:
+    # Share the url held by the texture cache row, rather than retaining a duplicate
+    item.decoded_filename = dbrow["url"]
+
+    # Use the stale set when already determined for a batch of items
+    if stale is not None:
+      isStale = (item.decoded_filename in stale)
+    elif force or nodownload:
+      isStale = MyUtility.is_cache_item_stale(gConfig, jcomms, item)
+    else:
+      isStale = False
+
     if force:
       if gConfig.cache_refresh_date:
-        if MyUtility.is_cache_item_stale(gConfig, jcomms, item):
+        if isStale:
           item.status = MyMediaItem.STATUS_STALE
         else:
           item.status = MyMediaItem.STATUS_IGNORE
@@ -5020,7 +7933,7 @@ def matchTextures_item_row(mediatype, jcomms, item, dbrow, force, nodownload):
       else:
         TOTALS.bump("Skipped", item.itype)
     else:
-      if nodownload and MyUtility.is_cache_item_stale(gConfig, jcomms, item):
+      if nodownload and isStale:
         item.status = MyMediaItem.STATUS_STALE
         TOTALS.bump("Stale Item", item.itype)
       else:
@@ -5036,14 +7949,23 @@ def matchTextures_item_row(mediatype, jcomms, item, dbrow, force, nodownload):
 # Iterate over all the elements, seeking out artwork to be stored in a list.
 # Use recursion to process season and episode sub-elements.
 #
-def parseURLData(jcomms, mediatype, mediaitems, imagecache, data, title_name, id_name, showName=None, season=None, pvrGroup=None):
+def parseURLData(jcomms, mediatype, mediaitems, imagecache, data, title_name, id_name, showName=None, season=None, pvrGroup=None, rank=0):
   gLogger.reset()
 
   SEASON_ALL = (showName is not None and season is None)
 
+  # Movie sets with a recently played movie
+  playedSets = {}
+  if gConfig.CACHE_PRIORITY:
+    for item in data:
+      if item.get("setid", 0) and item.get("lastplayed", "") >= gConfig.CACHE_PRIORITY_PLAYED:
+        playedSets[item["setid"]] = True
+
   for item in data:
     if title_name in item: title = item[title_name]
 
+    first = len(mediaitems)
+
     if showName:
       mediatype = "tvshows"
       name = showName
@@ -5099,10 +8021,15 @@ def parseURLData(jcomms, mediatype, mediaitems, imagecache, data, title_name, id
         if evaluateURL(file["type"], file["file"], imagecache):
           mediaitems.append(MyMediaItem(mediatype, file["type"], name, season, episode, file["file"], 0, None, item[id_name], False))
 
+    # Seasons and episodes are at least as important as their TV show
+    itemrank = max(rank, getPriorityRank(item, playedSets)) if gConfig.CACHE_PRIORITY else 0
+    if itemrank != 0:
+      for m in mediaitems[first:]: m.rank = itemrank
+
     if "seasons" in item:
-      parseURLData(jcomms, "seasons", mediaitems, imagecache, item["seasons"], "label", "season", showName=title)
+      parseURLData(jcomms, "seasons", mediaitems, imagecache, item["seasons"], "label", "season", showName=title, rank=itemrank)
     elif "episodes" in item:
-      parseURLData(jcomms, "episodes", mediaitems, imagecache, item["episodes"], "label", "episodeid", showName=showName, season=title)
+      parseURLData(jcomms, "episodes", mediaitems, imagecache, item["episodes"], "label", "episodeid", showName=showName, season=title, rank=itemrank)
       season = None
     elif "channels" in item:
       parseURLData(jcomms, "%s.channel" % mediatype, mediaitems, imagecache, item["channels"], "channel", "channelid", pvrGroup=title)
@@ -6055,11 +8982,12 @@ def _ProcessIMDB(mediatype, jcomms, data, plotFull, plotOutline, movies250, imdb
   if input_queue.qsize() == 0:
     return worklist
 
-  # Create threads to process input queue
+  # Create threads to process input queue, sharing a retry policy
+  retrypolicy = MyRetryPolicy(gLogger, delay=1.0)
   threadcount = input_queue.qsize() if input_queue.qsize() <= gConfig.IMDB_THREADS else gConfig.IMDB_THREADS
   threads = []
   for i in range(threadcount):
-    t = MyIMDBLoader(gConfig, gLogger, input_queue, output_queue, plotFull, plotOutline, movies250, imdbfields)
+    t = MyIMDBLoader(gConfig, gLogger, input_queue, output_queue, plotFull, plotOutline, movies250, imdbfields, retrypolicy)
     threads.append(t)
     t.setDaemon(True)
 
@@ -6155,6 +9083,8 @@ def _ProcessIMDB(mediatype, jcomms, data, plotFull, plotOutline, movies250, imdb
 
   gLogger.progress("")
 
+  retrypolicy.logStats(gLogger)
+
   return worklist
 
 def getIntFloatStr(aField, aValue):
@@ -6379,6 +9309,8 @@ def sqlExtract(ACTION="NONE", search="", filter="", delete=False, silent=False):
     if len(dbrows) != 0:
       rpcnt = rpcnt / len(dbrows)
 
+    sizes = MyThumbnailSizes(gConfig, gLogger)
+
     i = 0
     for row in dbrows:
       if ACTION == "NONE":
@@ -6387,13 +9319,12 @@ def sqlExtract(ACTION="NONE", search="", filter="", delete=False, silent=False):
         i += 1
         gLogger.progress("Parsing [%s] %2.0f%%..." % (row["cachedurl"], rpcnt * i), every = 50)
         if ACTION == "EXISTS":
-          if not os.path.exists(gConfig.getFilePath(row["cachedurl"])):
-            ROWS.append(row)
-          elif os.path.getsize(gConfig.getFilePath(row["cachedurl"])) == 0:
+          if not sizes.get(row["cachedurl"]):
             ROWS.append(row)
         elif ACTION == "STATS":
-          if os.path.exists(gConfig.getFilePath(row["cachedurl"])):
-            FSIZE += os.path.getsize(gConfig.getFilePath(row["cachedurl"]))
+          size = sizes.get(row["cachedurl"])
+          if size is not None:
+            FSIZE += size
             ROWS.append(row)
 
     gLogger.progress("")
@@ -6431,17 +9362,31 @@ def sqlDelete(ids=[]):
 def orphanCheck(removeOrphans=False):
   database = MyDB(gConfig, gLogger)
 
-  dbfiles = {}
-  ddsmap = {}
   orphanedfiles = []
 
   gLogger.progress("Loading texture cache...")
 
+  dbfiles = MyHashIndex(fetch=lambda ids: loadTextureRows(database, ids, lambda r: r["cachedurl"]),
+                        hashed=gConfig.INDEX_HASHED, logger=gLogger)
+  ddsmap = MyHashIndex(fetch=lambda ids: loadTextureRows(database, ids, lambda r: os.path.splitext(r["cachedurl"])[0]),
+                       hashed=gConfig.INDEX_HASHED)
+
+  def addRows(rows):
+    hashes = [r["cachedurl"] for r in rows]
+    ids = [r["textureid"] for r in rows]
+    dbfiles.add(hashes, ids=ids)
+    ddsmap.add([os.path.splitext(hash)[0] for hash in hashes], ids=ids)
+
   with database:
-    for r in database.getRows(allfields=False):
-      hash = r["cachedurl"]
-      dbfiles[hash] = r
-      ddsmap[os.path.splitext(hash)[0]] = hash
+    if dbfiles.isHashed():
+      # Only the hashes are retained, so load one folder at a time rather than every row at once
+      for folder in database.getTextureFolders():
+        addRows(database.getRows(database.getTextureFolderFilter(folder), allfields=False))
+    else:
+      addRows(database.getRows(allfields=False))
+
+  dbfiles.finish()
+  ddsmap.finish()
 
   gLogger.log("Loaded %d rows from texture cache" % len(dbfiles))
 
@@ -6449,6 +9394,7 @@ def orphanCheck(removeOrphans=False):
 
   path = gConfig.getFilePath()
 
+  scanned = []
   for (root, dirs, files) in os.walk(path):
     newroot = root.replace(path,"")
     basedir = os.path.basename(newroot)
@@ -6460,18 +9406,25 @@ def orphanCheck(removeOrphans=False):
 
       gLogger.progress("Scanning Thumbnails directory [%s]..." % hash, every=25)
 
-      hash_parts = os.path.splitext(hash)
+      scanned.append((newroot, file, hash))
 
+  # Look up the scanned files in batches (a single batch unless hashed)
+  BATCH = dbfiles.batch if dbfiles.isHashed() else len(scanned)
+
+  for i in range(0, len(scanned), BATCH or 1):
+    batch = scanned[i:i + BATCH]
+    rows = dbfiles.getMany([hash for (newroot, file, hash) in batch])
+    dds = ddsmap.getMany([os.path.splitext(hash)[0] if hash.endswith(".dds") else "" for (newroot, file, hash) in batch])
+
+    for (newroot, file, hash), row, ddsrow in zip(batch, rows, dds):
       # If it's a DDS file, it should be associated with another
       # file with the same hash, but different extension. Find
       # this other file in the ddsmap - if it's there, ignore
       # the DDS file, otherwise leave the DDS file to be reported
       # as an orphaned file.
-      if hash_parts[1] == ".dds" and ddsmap.get(hash_parts[0], None):
+      if hash.endswith(".dds") and ddsrow:
           continue
 
-      row = dbfiles.get(hash, None)
-
       if not row:
         filename = os.path.join(newroot, file)
         gLogger.log("Orphan file detected: [%s] with likely hash [%s]" % (filename, hash))
@@ -6512,8 +9465,6 @@ def pruneCache(remove_nonlibrary_artwork=False):
 
   localfiles = []
 
-  (libraryFiles, mediaFiles) = getAllFiles(keyFunction=getKeyFromFilename)
-
   re_search = []
   # addons
   re_search.append(re.compile(r"^.*[/\\]\.kodi[/\\]addons[/\\].*"))
@@ -6524,38 +9475,96 @@ def pruneCache(remove_nonlibrary_artwork=False):
 
   database = MyDB(gConfig, gLogger)
 
+  if gConfig.PRUNE_SPILL > 0:
+    pruneCache_merge(database, re_search, remove_nonlibrary_artwork)
+    return
+
+  (libraryFiles, mediaFiles) = getAllFiles(keyFunction=getKeyFromFilename)
+
   if gConfig.CHUNKED:
     pruneCache_chunked(database, libraryFiles, mediaFiles, localfiles, re_search)
   else:
     pruneCache_fast(database, libraryFiles, mediaFiles, localfiles, re_search)
 
-  # Prune, with optional remove...
-  if localfiles != []:
-    if remove_nonlibrary_artwork:
-      gLogger.out("Pruning cached images from texture cache...", newLine=True)
-    else:
-      gLogger.out("The following items are present in the texture cache but not the media library:", newLine=True)
-    gLogger.out("", newLine=True)
+  localfiles.sort(key=lambda row: row["url"])
 
+  pruneCache_output(database, localfiles, remove_nonlibrary_artwork)
+
+# Prune, with optional remove, the rows (in url order) that are not in the media library
+def pruneCache_output(database, localfiles, remove_nonlibrary_artwork, threshold=1000):
+  FCOUNT = 0
   FSIZE = 0
   GOTSIZE = gConfig.HAS_THUMBNAILS_FS
-  localfiles.sort(key=lambda row: row["url"])
+  sizes = MyThumbnailSizes(gConfig, gLogger, threshold=threshold)
 
   with database:
     for row in localfiles:
+      if FCOUNT == 0:
+        if remove_nonlibrary_artwork:
+          gLogger.out("Pruning cached images from texture cache...", newLine=True)
+        else:
+          gLogger.out("The following items are present in the texture cache but not the media library:", newLine=True)
+        gLogger.out("", newLine=True)
+
+      FCOUNT += 1
       database.dumpRow(row)
-      if GOTSIZE and os.path.exists(gConfig.getFilePath(row["cachedurl"])):
-        FSIZE += os.path.getsize(gConfig.getFilePath(row["cachedurl"]))
+      if GOTSIZE:
+        FSIZE += sizes.get(row["cachedurl"]) or 0
       if remove_nonlibrary_artwork:
         database.deleteItem(row["textureid"], row["cachedurl"], warnmissing=False)
 
   if GOTSIZE:
     gLogger.out("\nSummary: %s files; Total size: %s KB\n\n" \
-                  % (format(len(localfiles), ",d"),
+                  % (format(FCOUNT, ",d"),
                      format(int(FSIZE/1024), ",d")))
   else:
     gLogger.out("\nSummary: %s files\n\n" \
-                  % (format(len(localfiles), ",d")))
+                  % (format(FCOUNT, ",d")))
+
+# Prune with bounded memory: the library urls and the texture cache rows are each
+# sorted by url - spilling to temporary files once prune.spill items are held in
+# memory - and rows not in the library are then identified with a single merge join.
+def pruneCache_merge(database, re_search, remove_nonlibrary_artwork):
+  libraryFiles = MyExternalSort(gConfig.PRUNE_SPILL, gLogger, "library")
+  textureRows = MyExternalSort(gConfig.PRUNE_SPILL, gLogger, "texture")
+
+  try:
+    (libraryFiles, mediaFiles) = getAllFiles(keyFunction=getKeyFromFilename, afiles=libraryFiles)
+
+    with database:
+      folders = database.getTextureFolders()
+      for fnum, folder in enumerate(folders):
+        gLogger.progress("Loading Textures DB: chunk %2d of %d..." % (fnum+1, len(folders)))
+        for row in database.getRows(database.getTextureFolderFilter(folder), allfields=True):
+          textureRows.add(row["url"], json.dumps(row))
+
+    gLogger.progress("")
+    gLogger.log("Merging %d library urls with %d texture cache rows" % (len(libraryFiles), len(textureRows)))
+
+    # Size each pruned file individually, rather than holding an inventory of the Thumbnails folder
+    pruneCache_output(database, pruneCache_mergejoin(libraryFiles, mediaFiles, textureRows, re_search), remove_nonlibrary_artwork, threshold=None)
+  finally:
+    libraryFiles.close()
+    textureRows.close()
+
+# Yield, in url order, the texture cache rows that are not retained.
+# As with pruneCache_processrow(), a library url (which may have been added
+# more than once) is consumed by the first texture row that matches it, so any
+# duplicate rows for that url are pruned.
+def pruneCache_mergejoin(libraryFiles, mediaFiles, textureRows, re_search):
+  library = iter(libraryFiles)
+  libraryURL = next(library, (None,))[0]
+
+  for (URL, data) in textureRows:
+    while libraryURL is not None and libraryURL < URL:
+      libraryURL = next(library, (None,))[0]
+
+    inLibrary = (URL == libraryURL)
+    while libraryURL is not None and libraryURL == URL:
+      libraryURL = next(library, (None,))[0]
+
+    if not pruneCache_isRetained(URL, inLibrary, mediaFiles, re_search):
+      yield json.loads(data)
 
 
 def pruneCache_fast(database, libraryFiles, mediaFiles, localfiles, re_search):
@@ -6607,34 +9616,36 @@ def pruneCache_chunked(database, libraryFiles, mediaFiles, localfiles, re_search
 def pruneCache_processrow(row, libraryFiles, mediaFiles, localfiles, re_search):
 
   URL = row["url"]
-  isRetained = False
+
+  inLibrary = (URL in libraryFiles)
+  if inLibrary: del libraryFiles[URL]
+
+  if not pruneCache_isRetained(URL, inLibrary, mediaFiles, re_search):
+    localfiles.append(row)
+
+def pruneCache_isRetained(URL, inLibrary, mediaFiles, re_search):
 
   if gConfig.PRUNE_RETAIN_TYPES:
     for retain in gConfig.PRUNE_RETAIN_TYPES:
       if retain.search(URL):
         gLogger.log("Retained image due to rule [%s]" % retain.pattern)
-        isRetained = True
-        break
-    if isRetained: return
+        return True
 
-  if URL in libraryFiles:
-    del libraryFiles[URL]
-    return
+  if inLibrary:
+    return True
 
   if gConfig.PRUNE_RETAIN_CHAPTERS and URL.startswith("chapter://"):
     if getMediaForChapter(URL) in mediaFiles:
-      return
+      return True
 
   if re_search:
     # Ignore add-on/mirror related images
     for r in re_search:
       if r.search(URL):
-        isRetained = True
-        break
+        return True
 
   # Not an addon or mirror...
-  if not isRetained:
-    localfiles.append(row)
+  return False
 
 def getMediaForChapter(filename):
   offset = 1
@@ -6669,12 +9680,14 @@ def getKeyFromFilename(filename):
   if not filename: return filename
   return MyUtility.normalise(filename, strip=True)
 
-def getAllFiles(keyFunction):
+# Library artwork is added to afiles, which may be any object supporting
+# item assignment (eg. MyExternalSort), and media files to mfiles.
+def getAllFiles(keyFunction, afiles=None):
   jcomms = MyJSONComms(gConfig, gLogger)
+  pool = MyTaskPool(gConfig, gLogger, jcomms, gConfig.PRUNE_THREADS, name="Inventory")
 
-  afiles = {}
+  if afiles is None: afiles = {}
   mfiles = {}
-  UCAST = {}
 
   REQUEST = [
               {"method":"AudioLibrary.GetAlbums",
@@ -6724,14 +9737,17 @@ def getAllFiles(keyFunction):
                "params":{"properties":["name", "thumbnail", "fanart"]}}
             ]
 
-  for r in REQUEST:
+  # Library items of each media class
+  def loadMediaClass(jcomms, r):
     mediatype = re.sub(".*\.Get(.*)","\\1",r["method"])
 
     if gConfig.CACHE_EXTRA and mediatype == "Movies":
       jcomms.addProperties(r, "file")
 
+    jcomms.planSort("prune", r)
+
     gLogger.progress("Loading %s..." % mediatype)
-    data = jcomms.getDataProxy(mediatype, r, uniquecast=UCAST)
+    data = jcomms.getDataProxy(mediatype, r, uniquecast={})
 
     for items in data.get("result", {}):
       if items != "limits":
@@ -6762,110 +9778,128 @@ def getAllFiles(keyFunction):
 
         if title != "": gLogger.progress("Parsing %s: %s..." % (mediatype, title))
 
-    # Free memory used to cache any GetDirectory() information
-    MyUtility.invalidateDirectoryCache(mediatype)
+  # TV shows, with the seasons and episodes of each show loaded as a separate task
+  def loadTVShows(jcomms):
+    gLogger.progress("Loading TV shows...")
 
-  gLogger.progress("Loading TV shows...")
+    REQUEST = {"method":"VideoLibrary.GetTVShows",
+               "params": {"sort": {"order": "ascending", "method": "title"},
+                          "properties":["title", "cast", "art"]}}
 
-  REQUEST = {"method":"VideoLibrary.GetTVShows",
-             "params": {"sort": {"order": "ascending", "method": "title"},
-                        "properties":["title", "cast", "art"]}}
+    if gConfig.CACHE_EXTRA:
+      jcomms.addProperties(REQUEST, "file")
+    jcomms.planSort("prune", REQUEST)
 
-  if gConfig.CACHE_EXTRA:
-    jcomms.addProperties(REQUEST, "file")
+    tvdata = jcomms.getDataProxy("tvshows", REQUEST, uniquecast={})
 
-  tvdata = jcomms.getDataProxy("tvshows", REQUEST, uniquecast=UCAST)
+    if "result" in tvdata and "tvshows" in tvdata["result"]:
+      for tvshow in tvdata["result"]["tvshows"]:
+        pool.add(loadTVShow, tvshow)
 
-  if "result" in tvdata and "tvshows" in tvdata["result"]:
-    for tvshow in tvdata["result"]["tvshows"]:
-      gLogger.progress("Loading TV show: %s..." % tvshow["title"])
-      tvshowid = tvshow["tvshowid"]
+  def loadTVShow(jcomms, tvshow):
+    gLogger.progress("Loading TV show: %s..." % tvshow["title"])
+    tvshowid = tvshow["tvshowid"]
 
-      for a in tvshow.get("art", {}):
-        afiles[keyFunction(tvshow["art"][a])] = a
+    # Unique cast thumbnails of this show, not shared with any other task
+    UCAST = {}
 
-      for c in tvshow.get("cast", []):
-        if "thumbnail" in c:
-          afiles[keyFunction(c["thumbnail"])] = "cast.thumb"
+    for a in tvshow.get("art", {}):
+      afiles[keyFunction(tvshow["art"][a])] = a
 
-      for file in jcomms.getExtraArt(tvshow):
-        afiles[keyFunction(file["file"])] = file["type"]
+    for c in tvshow.get("cast", []):
+      if "thumbnail" in c:
+        afiles[keyFunction(c["thumbnail"])] = "cast.thumb"
 
-      REQUEST = {"method":"VideoLibrary.GetSeasons",
-                 "params":{"tvshowid": tvshowid,
-                           "sort": {"order": "ascending", "method": "season"},
-                           "properties":["season", "art"]}}
+    for file in jcomms.getExtraArt(tvshow):
+      afiles[keyFunction(file["file"])] = file["type"]
 
-      seasondata = jcomms.getDataProxy("seasons", REQUEST, uniquecast=UCAST)
+    REQUEST = {"method":"VideoLibrary.GetSeasons",
+               "params":{"tvshowid": tvshowid,
+                         "sort": {"order": "ascending", "method": "season"},
+                         "properties":["season", "art"]}}
+    jcomms.planSort("prune", REQUEST)
 
-      if "seasons" in seasondata["result"]:
-        SEASON_ALL = True
-        for season in seasondata["result"]["seasons"]:
-          seasonid = season["season"]
-          if seasonid < 0:
-            gLogger.err("WARNING: TV show [%s] has invalid season (%d) - ignored" % (tvshow["title"], seasonid), newLine=True)
-            continue
+    seasondata = jcomms.getDataProxy("seasons", REQUEST, uniquecast=UCAST)
 
-          gLogger.progress("Loading TV show: %s, season %d..." % (tvshow["title"], seasonid))
+    if "seasons" in seasondata["result"]:
+      SEASON_ALL = True
+      for season in seasondata["result"]["seasons"]:
+        seasonid = season["season"]
+        if seasonid < 0:
+          gLogger.err("WARNING: TV show [%s] has invalid season (%d) - ignored" % (tvshow["title"], seasonid), newLine=True)
+          continue
 
-          for a in season.get("art", {}):
-            if SEASON_ALL and a in ["poster", "tvshow.poster", "tvshow.fanart", "tvshow.banner"]:
-              SEASON_ALL = False
-              (poster_url, fanart_url, banner_url) = jcomms.getSeasonAll(season["art"][a])
-              if poster_url: afiles[keyFunction(poster_url)] = "poster"
-              if fanart_url: afiles[keyFunction(fanart_url)] = "fanart"
-              if banner_url: afiles[keyFunction(banner_url)] = "banner"
-            afiles[keyFunction(season["art"][a])] = a
+        gLogger.progress("Loading TV show: %s, season %d..." % (tvshow["title"], seasonid))
 
-          REQUEST = {"method":"VideoLibrary.GetEpisodes",
-                     "params":{"tvshowid": tvshowid, "season": seasonid,
-                               "properties":["cast", "art", "file"]}}
+        for a in season.get("art", {}):
+          if SEASON_ALL and a in ["poster", "tvshow.poster", "tvshow.fanart", "tvshow.banner"]:
+            SEASON_ALL = False
+            (poster_url, fanart_url, banner_url) = jcomms.getSeasonAll(season["art"][a])
+            if poster_url: afiles[keyFunction(poster_url)] = "poster"
+            if fanart_url: afiles[keyFunction(fanart_url)] = "fanart"
+            if banner_url: afiles[keyFunction(banner_url)] = "banner"
+          afiles[keyFunction(season["art"][a])] = a
 
-          episodedata = jcomms.getDataProxy("episodes", REQUEST, uniquecast=UCAST)
+        REQUEST = {"method":"VideoLibrary.GetEpisodes",
+                   "params":{"tvshowid": tvshowid, "season": seasonid,
+                             "properties":["cast", "art", "file"]}}
 
-          for episode in episodedata["result"]["episodes"]:
-            episodeid = episode["episodeid"]
+        episodedata = jcomms.getDataProxy("episodes", REQUEST, uniquecast=UCAST)
 
-            mfiles[episode["file"]] = "media"
+        for episode in episodedata["result"]["episodes"]:
+          episodeid = episode["episodeid"]
 
-            for a in episode.get("art", {}):
-              afiles[keyFunction(episode["art"][a])] = a
+          mfiles[episode["file"]] = "media"
 
-            for c in episode.get("cast", []):
-              if "thumbnail" in c:
-                afiles[keyFunction(c["thumbnail"])] = "cast.thumb"
+          for a in episode.get("art", {}):
+            afiles[keyFunction(episode["art"][a])] = a
 
-      # Free memory used to cache any GetDirectory() information
-      MyUtility.invalidateDirectoryCache("TVShows")
+          for c in episode.get("cast", []):
+            if "thumbnail" in c:
+              afiles[keyFunction(c["thumbnail"])] = "cast.thumb"
 
-  # Pictures
-  gLogger.progress("Loading Pictures...")
-  pictures = jcomms.getPictures(addPreviews=gConfig.PRUNE_RETAIN_PREVIEWS, addPictures=gConfig.PRUNE_RETAIN_PICTURES)
-  for picture in pictures:
-    afiles[keyFunction(picture["thumbnail"])] = "thumbnail"
-  del pictures
-  # Free memory used to cache any GetDirectory() information
-  MyUtility.invalidateDirectoryCache("Pictures")
+  def loadPictures(jcomms):
+    gLogger.progress("Loading Pictures...")
+    pictures = jcomms.getPictures(addPreviews=gConfig.PRUNE_RETAIN_PREVIEWS, addPictures=gConfig.PRUNE_RETAIN_PICTURES)
+    for picture in pictures:
+      afiles[keyFunction(picture["thumbnail"])] = "thumbnail"
+    del pictures
 
-  # PVR Channels
-  if gConfig.HAS_PVR:
+  # PVR channel groups, with the channels of each group loaded as a separate task
+  def loadPVRChannelGroups(jcomms, channelType):
     gLogger.progress("Loading PVR channels...")
+    REQUEST = {"method":"PVR.GetChannelGroups",
+               "params":{"channeltype": channelType}}
+    pvrdata = jcomms.sendJSON(REQUEST, "libPVR", checkResult=False)
+    if "result" in pvrdata:
+      for channelgroup in pvrdata["result"].get("channelgroups", []):
+        pool.add(loadPVRChannels, channelgroup["channelgroupid"])
+
+  def loadPVRChannels(jcomms, channelgroupid):
+    REQUEST = {"method":"PVR.GetChannels",
+               "params":{"channelgroupid": channelgroupid,
+                         "properties": ["channeltype", "channel", "thumbnail"]}}
+    channeldata = jcomms.sendJSON(REQUEST, "libPVR", checkResult=False)
+    if "result" in channeldata:
+      for channel in channeldata["result"].get("channels", []):
+        afiles[keyFunction(channel["thumbnail"])] = "pvr.thumb"
+
+  for r in REQUEST:
+    pool.add(loadMediaClass, r)
+
+  pool.add(loadTVShows)
+
+  pool.add(loadPictures)
+
+  if gConfig.HAS_PVR:
     for channelType in ["tv", "radio"]:
-      REQUEST = {"method":"PVR.GetChannelGroups",
-                 "params":{"channeltype": channelType}}
-      pvrdata = jcomms.sendJSON(REQUEST, "libPVR", checkResult=False)
-      if "result" in pvrdata:
-        for channelgroup in pvrdata["result"].get("channelgroups", []):
-          REQUEST = {"method":"PVR.GetChannels",
-                     "params":{"channelgroupid": channelgroup["channelgroupid"],
-                               "properties": ["channeltype", "channel", "thumbnail"]}}
-          channeldata = jcomms.sendJSON(REQUEST, "libPVR", checkResult=False)
-          if "result" in channeldata:
-            for channel in channeldata["result"].get("channels", []):
-              afiles[keyFunction(channel["thumbnail"])] = "pvr.thumb"
-
-    # Free memory used to cache any GetDirectory() information
-    MyUtility.invalidateDirectoryCache("PVR")
+      pool.add(loadPVRChannelGroups, channelType)
+
+  pool.run()
+
+  # Free memory used to cache any GetDirectory() information, once all
+  # tasks (which share the directory cache) have finished
+  MyUtility.invalidateDirectoryCache("Library")
 
   return (afiles, mfiles)
 
@@ -7740,10 +10774,11 @@ def findexepath(cmd, path):
 
 def loadConfig(argv):
   global DBVERSION, MYWEB, MYSOCKET, MYDB
-  global TOTALS
+  global TOTALS, JOURNAL, PLAYBACK, BUDGET
   global gConfig, gLogger
 
   DBVERSION = MYWEB = MYSOCKET = MYDB = None
+  JOURNAL = PLAYBACK = BUDGET = None
 
   gConfig = MyConfiguration(argv)
   gLogger = MyLogger()
@@ -8278,6 +11313,8 @@ def autoUpdate(argv):
     os.execl(sys.executable, sys.executable, *args)
 
 def main(argv):
+  global JOURNAL, PLAYBACK, BUDGET
+
   loadConfig(argv)
 
   if len(argv) == 0: usage(1)
@@ -8386,11 +11423,37 @@ def main(argv):
       _multi_call.append(argv[1])
 
     if _multi_call != []:
-      for _media in _multi_call:
-        jsonQuery(_action, mediatype=_media, filter=_filter,
-                  force=_force, lastRun=_lastRun, nodownload=_nodownload,
-                  rescan=_rescan, decode=_decode, ensure_ascii=_ensure_ascii,
-                  extraFields=_extraFields, query=_query, drop_items=_drop_items)
+      if _action == "cache" and not _nodownload and gConfig.DOWNLOAD_PLAYBACK is not None and not gConfig.LOG_REPLAY_FILENAME:
+        PLAYBACK = MyPlaybackMonitor(gConfig, gLogger, gConfig.DOWNLOAD_PLAYBACK, gConfig.DOWNLOAD_PLAYBACK_DELAY)
+        PLAYBACK.setDaemon(True)
+        PLAYBACK.start()
+
+      # Budget of items downloaded by this run
+      if _action == "cache" and not _nodownload and gConfig.CACHE_BUDGET > 0:
+        BUDGET = MyCacheBudget(gConfig.CACHE_BUDGET)
+
+      if _action == "cache" and not _nodownload and gConfig.CACHE_JOURNAL:
+        JOURNAL = MyCacheJournal(gConfig, gLogger, gConfig.CACHE_JOURNAL)
+        if not JOURNAL.open(): JOURNAL = None
+
+      try:
+        if JOURNAL and gConfig.CACHE_RESUME and JOURNAL.getResumable(argv[0], _multi_call, _filter):
+          resumeCache(_multi_call, force=_force, drop_items=_drop_items)
+        else:
+          if JOURNAL: JOURNAL.begin(argv[0], _multi_call, _filter)
+          if _action == "cache" and gConfig.CACHE_CONCURRENT > 1 and len(_multi_call) > 1:
+            jsonQueryConcurrent(_multi_call, filter=_filter, force=_force, lastRun=_lastRun,
+                                nodownload=_nodownload, drop_items=_drop_items)
+          else:
+            for _media in _multi_call:
+              jsonQuery(_action, mediatype=_media, filter=_filter,
+                        force=_force, lastRun=_lastRun, nodownload=_nodownload,
+                        rescan=_rescan, decode=_decode, ensure_ascii=_ensure_ascii,
+                        extraFields=_extraFields, query=_query, drop_items=_drop_items)
+        if JOURNAL and not stopped.is_set(): JOURNAL.finish()
+      finally:
+        # Retain progress of an interrupted run
+        if JOURNAL: JOURNAL.close()
       if _action == "cache": dump_drop_items(_drop_items)
       if _stats: TOTALS.libraryStats(multi=_multi_call, filter=_filter, lastRun=_lastRun, query=_query)
     else: